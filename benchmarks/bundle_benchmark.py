@@ -0,0 +1,78 @@
+"""
+Benchmark of the float16 result bundle (sdm_unips/result_bundle.py) against the 8-bit PNG maps: time to
+write the maps, time to load them as float tensors as relighting.py does, and the error of each format
+against the float32 maps.
+
+python benchmarks/bundle_benchmark.py --size 4096
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+
+import cv2
+import numpy as np
+import torch
+
+import result_bundle
+from synthetic_data import synthetic_maps
+
+
+def write_pngs(folder, maps):
+    for name, value in maps.items():
+        cv2.imwrite(str(folder / f"{name}.png"), 255 * value[:, :, ::-1])
+
+
+def load_pngs(folder):
+    return {name: torch.from_numpy(cv2.imread(str(folder / f"{name}.png"))[:, :, ::-1].astype(np.float32) / 255.0)
+            for name in result_bundle.MAP_NAMES}
+
+
+def load_bundle(folder):
+    bundle = result_bundle.open_bundle(folder)
+    return {name: torch.from_numpy(value).float() for name, value in bundle.maps.items()}
+
+
+def max_error(maps, loaded):
+    return max(float(np.abs(loaded[name].numpy()[..., :value.shape[2]] - value).max()) for name, value in maps.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the float16 result bundle with the PNG maps.")
+    parser.add_argument('--size', type=int, default=2048, help='side of the synthetic square maps')
+    args = parser.parse_args()
+
+    nml, base, rough, metallic = synthetic_maps(args.size, torch.device("cpu"))
+    to_image = lambda x: x[0].permute(1, 2, 0).numpy().repeat(3 // x.shape[1], axis=2)
+    maps = {"normal": (to_image(nml) + 1) / 2, "baseColor": to_image(base), "roughness": to_image(rough), "metallic": to_image(metallic)}
+
+    folder = Path(tempfile.mkdtemp(prefix="sdm_bundle_"))
+    try:
+        start = time.perf_counter()
+        write_pngs(folder, maps)
+        png_write = time.perf_counter() - start
+        start = time.perf_counter()
+        result_bundle.write(folder / result_bundle.BUNDLE_NAME, maps)
+        bundle_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        from_pngs = load_pngs(folder)
+        png_load = time.perf_counter() - start
+        start = time.perf_counter()
+        from_bundle = load_bundle(folder)
+        bundle_load = time.perf_counter() - start
+
+        print(f"PNG   : write {png_write:7.3f} sec, load {png_load:7.3f} sec, max error {max_error(maps, from_pngs):.2e}")
+        print(f"bundle: write {bundle_write:7.3f} sec, load {bundle_load:7.3f} sec, max error {max_error(maps, from_bundle):.2e}, "
+              f"load speedup x{png_load / bundle_load:.1f}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Local check of the work sharing of run_sdm_multifolder.py (cheminova/work_claims.py) with several independent
+processes on one machine. Every worker process is started separately (as on separate cluster nodes) and runs
+the claim protocol of process_acquisition_folders() with its own --shard over the same folder names, with a
+job that only sleeps and logs the folders it finished. One worker crashes in the middle of a folder; its claim
+goes stale and is taken over by another worker. The check fails unless every folder is finished exactly once.
+
+The --shard partition is checked as well: every folder belongs to exactly one shard.
+
+python benchmarks/claims_check.py --workers 4 --folders 40 --job_time 0.2
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cheminova"))
+
+from job_scheduler import run_jobs, print_summary
+from work_claims import ClaimDirectory, parse_shard, shard_of, shard_jobs, run_claimed
+
+
+def fake_job(name, log_path, job_time, crash_folder, context):
+    """
+    Sleeps like a folder being processed, then logs it; kills its process on 'crash_folder'.
+    """
+    time.sleep(job_time / 2)
+    if name == crash_folder:
+        os._exit(3)  # No outcome, no release: the claim is left behind as by a crashed node
+    time.sleep(job_time / 2)
+    with open(log_path, "a") as f:
+        f.write(f"{name} {os.getpid()}\n")
+
+
+def folder_names(count):
+    return [f"capture_{i:04d}" for i in range(count)]
+
+
+def run_worker(args):
+    claims = ClaimDirectory(args.claim_dir, args.claim_timeout)
+    jobs = [(name, (name, args.log, args.job_time, args.crash_folder)) for name in folder_names(args.folders)]
+    # As run_sdm_multifolder.py --shard i/N --claim_dir: own shard first, then the other shards
+    shard_names = {name for name, _ in shard_jobs(jobs, parse_shard(args.shard))}
+    jobs = [job for job in jobs if job[0] in shard_names] + [job for job in jobs if job[0] not in shard_names]
+
+    def run(jobs):
+        return run_jobs([(name, (claims, fake_job, name, *job_args)) for name, job_args in jobs], run_claimed)
+
+    results = run(jobs)
+    results += claims.take_over_stale(jobs, run)
+    print_summary(results)
+
+
+def check_shards(names, count):
+    shards = [{name for name, _ in shard_jobs([(name, None) for name in names], (i, count))} for i in range(count)]
+    assert sum(len(shard) for shard in shards) == len(names) and set().union(*shards) == set(names), "shards overlap or miss folders"
+    print(f"{count} shards of {[len(shard) for shard in shards]} folders: every folder in exactly one shard")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the claim protocol of run_sdm_multifolder.py with several local processes.")
+    parser.add_argument('--workers', type=int, default=4, help='independent worker processes')
+    parser.add_argument('--folders', type=int, default=40)
+    parser.add_argument('--job_time', type=float, default=0.2, help='seconds per folder')
+    parser.add_argument('--claim_timeout', type=float, default=2.0, help='seconds without heartbeat before a claim is stale')
+    # Internal: run one worker
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--claim_dir', help=argparse.SUPPRESS)
+    parser.add_argument('--log', help=argparse.SUPPRESS)
+    parser.add_argument('--shard', help=argparse.SUPPRESS)
+    parser.add_argument('--crash_folder', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    names = folder_names(args.folders)
+    check_shards(names, args.workers)
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_claims_"))
+    try:
+        claim_dir, log = work_dir / "claims", work_dir / "finished.log"
+        common = [sys.executable, __file__, "--worker", "--claim_dir", str(claim_dir), "--log", str(log),
+                  "--folders", str(args.folders), "--job_time", str(args.job_time), "--claim_timeout", str(args.claim_timeout)]
+        start = time.perf_counter()
+        # Worker 0 (shard 0/N) crashes on the first folder of its shard; the others pull all the folders
+        crash_folder = next(name for name in names if shard_of(name, args.workers) == 0)
+        processes = [subprocess.Popen(common + ["--shard", f"0/{args.workers}", "--crash_folder", crash_folder], stdout=subprocess.DEVNULL)]
+        time.sleep(args.job_time / 4)  # Let it claim that folder
+        processes += [subprocess.Popen(common + ["--shard", f"{i}/{args.workers}"], stdout=subprocess.DEVNULL)
+                      for i in range(1, args.workers)]
+        codes = [process.wait() for process in processes]
+        elapsed = time.perf_counter() - start
+        print(f"{args.workers} workers exited with {codes} in {elapsed:.1f} sec "
+              f"(serial: {args.folders * args.job_time:.1f} sec)")
+
+        finished = [line.split()[0] for line in log.read_text().splitlines()]
+        duplicates = sorted({name for name in finished if finished.count(name) > 1})
+        missing = sorted(set(names) - set(finished))
+        ClaimDirectory(claim_dir, args.claim_timeout).print_progress(names)
+        assert not duplicates, f"folders processed more than once: {duplicates}"
+        assert not missing, f"folders never finished: {missing}"
+        print(f"OK: {len(names)} folders finished exactly once, the crashed claim was taken over")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
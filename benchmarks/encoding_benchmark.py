@@ -0,0 +1,72 @@
+"""
+Benchmark of the frame encoders: the serial writers of relighting.py (one cv2.VideoWriter, one imageio GIF
+writer) versus frame_encoder.encode() with several worker processes. The frames are rendered once from
+synthetic maps and kept in memory, so only the encoding is timed. The parallel GIF is checked to hold all
+the frames.
+
+python benchmarks/encoding_benchmark.py --size 512 --num_frames 360 --workers 2 4 8
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+
+import torch
+from PIL import Image
+
+import relighting
+import frame_encoder
+from synthetic_data import synthetic_maps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare serial and parallel encoding of the relighting frames.")
+    parser.add_argument('--size', type=int, default=512, help='side of the synthetic square frames')
+    parser.add_argument('--num_frames', type=int, default=360)
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--formats', nargs='+', default=['gif', 'avi'], choices=['gif', 'avi'])
+    args = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    nml, base, rough, metallic = synthetic_maps(args.size, device)
+    unit_vectors = relighting.numpy_to_pytorch(relighting.generate_points_with_same_incident_angle(args.num_frames))
+    frames = relighting.render_frames(nml, base, rough, metallic, unit_vectors, 24, device)
+
+    output_dir = Path(tempfile.mkdtemp(prefix="sdm_encoding_"))
+    try:
+        for output_format in args.formats:
+            output_file = str(output_dir / f"serial.{output_format}")
+            start = time.perf_counter()
+            if output_format == 'avi':
+                relighting.create_video(frames, output_file)
+            else:
+                relighting.create_gif_from_numpy_arrays(frames, output_file, 0.05)
+            serial_time = time.perf_counter() - start
+            print(f"\n{output_format} serial    : {serial_time:8.3f} sec ({len(frames) / serial_time:7.1f} frames/sec)")
+
+            output_file = str(output_dir / f"parallel.{output_format}")
+            if not frame_encoder.can_encode(output_file):
+                print(f"{output_format} parallel  : ffmpeg not found, skipped")
+                continue
+            for workers in args.workers:
+                start = time.perf_counter()
+                frame_encoder.encode(frames, output_file, workers=workers)
+                parallel_time = time.perf_counter() - start
+                print(f"{output_format} {workers:2d} workers: {parallel_time:8.3f} sec ({len(frames) / parallel_time:7.1f} frames/sec), "
+                      f"speedup x{serial_time / parallel_time:.2f}")
+            if output_format == 'gif':
+                with Image.open(output_file) as gif:
+                    # PIL merges identical consecutive frames, so there may be fewer
+                    assert 0 < gif.n_frames <= len(frames), f"the parallel GIF has {gif.n_frames} frames"
+                    print(f"parallel GIF: {gif.n_frames} frames")
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
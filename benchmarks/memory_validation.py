@@ -0,0 +1,112 @@
+"""
+Validation of the memory model of sdm_unips/memory_model.py: main.py is run in a new process for a grid of
+image counts, resolutions and settings on synthetic data, and its peak RSS is compared with the estimate.
+Without a checkpoint the networks keep their random initial weights, which does not change the memory.
+With --fit, the coefficients of the model are refitted on the measurements and saved for
+main.py --auto --memory_calibration.
+
+python benchmarks/memory_validation.py --resolutions 256 512 --image_counts 4 10 --fit memory_calibration.json
+"""
+
+import re
+import sys
+import json
+import shutil
+import argparse
+import itertools
+import tempfile
+import subprocess
+from pathlib import Path
+
+from run_benchmarks import REPOSITORY_DIR, has_checkpoint
+from synthetic_data import write_synthetic_dataset
+import memory_model
+
+# Runs main.py in the child process, optionally without loading the checkpoint
+CHILD = """
+import sys
+sys.path.insert(0, {sdm_unips!r})
+import main as sdm_main
+if {random_weights!r}:
+    from modules.builder import builder
+    builder.builder.load_models = lambda self, model, dirpath: model
+sdm_main.main(sys.argv[1:])
+"""
+
+
+def measure_peak_rss(arguments, random_weights):
+    """
+    Peak RSS (bytes) of one run of main.py.
+    """
+    child = CHILD.format(sdm_unips=str(REPOSITORY_DIR / "sdm_unips"), random_weights=random_weights)
+    output = subprocess.run([sys.executable, "-c", child, *arguments], capture_output=True, text=True)
+    match = re.search(r"Peak RSS: ([\d.]+) MB", output.stdout)
+    if output.returncode != 0 or match is None:
+        print(output.stdout[-2000:], output.stderr[-2000:])
+        raise RuntimeError(f"main.py failed with code {output.returncode}")
+    return float(match.group(1)) * 1024**2
+
+
+def print_comparison(measurements, coefficients, title):
+    print(f"\n{title}")
+    print(f"{'Images':>6} {'Res':>6} {'Canon':>6} {'Samples':>8} {'Scalable':>8} {'Estimate (GB)':>14} {'Measured (GB)':>14} {'Error':>8}")
+    errors = []
+    for settings, terms, measured in measurements:
+        estimate = sum(coefficients[name] * value for name, value in terms.items())
+        errors.append(abs(estimate - measured) / measured)
+        print(f"{settings['images']:>6} {settings['resolution']:>6} {settings['canonical_resolution']:>6} "
+              f"{settings['pixel_samples']:>8} {str(settings['scalable']):>8} {estimate / 1024**3:>14.2f} "
+              f"{measured / 1024**3:>14.2f} {100 * errors[-1]:>7.1f}%")
+    print(f"Mean absolute error: {100 * sum(errors) / len(errors):.1f}%, max: {100 * max(errors):.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory model with the measured peak RSS of main.py.")
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--image_counts', type=int, nargs='+', default=[4, 10])
+    parser.add_argument('--canonical_resolutions', type=int, nargs='+', default=[128, 256])
+    parser.add_argument('--pixel_samples', type=int, nargs='+', default=[2500, 10000])
+    parser.add_argument('--scalable', type=int, nargs='+', default=[0, 1], help='1 for --scalable, 0 without')
+    parser.add_argument('--target', default='normal', choices=['normal', 'brdf', 'normal_and_brdf'])
+    parser.add_argument('--checkpoint', type=Path, default=REPOSITORY_DIR / "checkpoint")
+    parser.add_argument('--memory_calibration', type=Path, default=None, help='coefficients to validate (default: the built-in ones)')
+    parser.add_argument('--fit', type=Path, default=None, help='refit the coefficients on the measurements and save them to this file')
+    args = parser.parse_args()
+
+    random_weights = not has_checkpoint(args.checkpoint, args.target)
+    coefficients = memory_model.load_coefficients(args.memory_calibration)
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_memory_"))
+    measurements = []
+    try:
+        for size, num_images in itertools.product(args.resolutions, args.image_counts):
+            test_dir = work_dir / f"test_{size}_{num_images}"
+            write_synthetic_dataset(test_dir / "synthetic.data", size, num_images)
+            for canonical_resolution, pixel_samples, scalable in itertools.product(args.canonical_resolutions, args.pixel_samples, args.scalable):
+                arguments = ["--session_name", str(work_dir / "session"), "--test_dir", str(test_dir),
+                             "--checkpoint", str(args.checkpoint), "--target", args.target,
+                             "--max_image_num", str(num_images), "--max_image_res", str(size),
+                             "--canonical_resolution", str(canonical_resolution), "--pixel_samples", str(pixel_samples)]
+                if scalable:
+                    arguments.append("--scalable")
+                measured = measure_peak_rss(arguments, random_weights)
+                shutil.rmtree(work_dir / "session", ignore_errors=True)
+                settings = {"images": num_images, "resolution": size, "canonical_resolution": canonical_resolution,
+                            "pixel_samples": pixel_samples, "scalable": bool(scalable)}
+                terms = memory_model.features(num_images, size, size, size, canonical_resolution, pixel_samples,
+                                              bool(scalable), args.target)
+                measurements.append((settings, terms, measured))
+                print(f"{settings}: {measured / 1024**3:.2f} GB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_comparison(measurements, coefficients, "Memory model" + (f" ({args.memory_calibration})" if args.memory_calibration else ""))
+
+    if args.fit is not None:
+        fitted = memory_model.fit_coefficients([(terms, measured) for _, terms, measured in measurements], coefficients)
+        with open(args.fit, "w") as f:
+            json.dump(fitted, f, indent=2)
+        print_comparison(measurements, fitted, f"Refitted memory model (saved to {args.fit})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark of the multi-view mode of main.py (sdm_unips/multi_view.py) on a synthetic multi-view object laid
+out like cheminova/organize_DiLiGenT-MV_to_SMD.py (view_XX/SDM_in.data): the views are run one main.py
+session per view with a resident model, as run_sdm_multifolder.py --in_process does, then with --multi_view.
+Reports the time per view of both and checks that every view has its results. Without a checkpoint, the
+network keeps its random initial weights, which does not change the time.
+
+python benchmarks/multi_view_benchmark.py --size 256 --num_images 10 --num_views 8 --max_views_per_group 4
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+from run_benchmarks import REPOSITORY_DIR, build_benchmark_model
+
+import main as sdm_main
+from synthetic_data import write_synthetic_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-view sessions with the multi-view mode of main.py.")
+    parser.add_argument('--size', type=int, default=256, help='side of the synthetic square images')
+    parser.add_argument('--num_images', type=int, default=10)
+    parser.add_argument('--num_views', type=int, default=8)
+    parser.add_argument('--max_views_per_group', type=int, default=None)
+    parser.add_argument('--memory_budget_gb', type=float, default=None)
+    parser.add_argument('--checkpoint', type=Path, default=REPOSITORY_DIR / "checkpoint")
+    parser.add_argument('--target', default='normal', choices=['normal', 'brdf', 'normal_and_brdf'])
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_multi_view_"))
+    try:
+        object_dir = work_dir / "object"
+        views = [f"view_{i:02d}" for i in range(1, args.num_views + 1)]
+        for seed, view in enumerate(views):
+            write_synthetic_dataset(object_dir / view / "SDM_in.data", args.size, args.num_images, seed=seed)
+
+        common = ["--checkpoint", str(args.checkpoint), "--target", args.target, "--max_image_num", str(args.num_images),
+                  "--max_image_res", str(args.size), "--scalable"]
+        model, weights = build_benchmark_model(sdm_main.parse_args(common))
+        print(f"{args.num_views} views of {args.num_images} images of {args.size} x {args.size} pixels ({weights} weights)")
+
+        start = time.perf_counter()
+        for view in views:
+            view_args = sdm_main.parse_args(common + ["--session_name", str(work_dir / "per_view" / view),
+                                                      "--test_dir", str(object_dir / view)])
+            sdm_main.run_session(model, view_args)
+        per_view_time = (time.perf_counter() - start) / len(views)
+
+        multi_view_args = sdm_main.parse_args(common + ["--session_name", str(work_dir / "multi_view"), "--test_dir", str(object_dir),
+                                                        "--multi_view"]
+                                              + (["--max_views_per_group", str(args.max_views_per_group)] if args.max_views_per_group else [])
+                                              + (["--memory_budget_gb", str(args.memory_budget_gb)] if args.memory_budget_gb else []))
+        start = time.perf_counter()
+        count = sdm_main.run_multi_view(model, multi_view_args)
+        multi_view_time = (time.perf_counter() - start) / count
+
+        missing = [view for view in views if not any((work_dir / "multi_view" / "results" / view).glob("*.png"))]
+        assert not missing, f"no results for the views {missing}"
+        print(f"\nper-view sessions: {per_view_time:8.3f} sec per view")
+        print(f"multi-view       : {multi_view_time:8.3f} sec per view, speedup x{per_view_time / multi_view_time:.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark of the background writes of main.py (sdm_unips/output_writer.py): a sequence of jobs, each computing
+for --compute_time seconds (standing for the forward pass, which releases the GIL like torch does) then writing
+the four result maps of a synthetic object as PNG, as the builder does with cv2.imwrite. The maps are written
+directly (as before) then through output_writer.redirect() to an output folder, where the maps of a job are
+encoded while the next job computes. Reports the time per job of both and checks that every map is complete
+and that no temporary file is left behind.
+
+python benchmarks/output_writer_benchmark.py --size 2048 --jobs 8 --compute_time 0.5
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+
+import cv2
+import numpy as np
+
+import output_writer
+from synthetic_data import synthetic_maps
+
+MAP_NAMES = ("normal", "baseColor", "roughness", "metallic")
+
+
+def result_maps(size, seed):
+    """
+    The four maps of a synthetic object as 8-bit BGR images, as the builder writes them.
+    """
+    maps = synthetic_maps(size, "cpu", seed)
+    images = [(0.5 * (maps[0] + 1)).clamp(0, 1)] + [m.clamp(0, 1) for m in maps[1:]]
+    return [(255 * m[0].expand(3, -1, -1).permute(1, 2, 0).numpy()[:, :, ::-1]).astype(np.uint8) for m in images]
+
+
+def run_jobs(results_dir, maps, jobs, compute_time):
+    for job in range(jobs):
+        time.sleep(compute_time)
+        job_dir = results_dir / f"job_{job:02d}.data"
+        job_dir.mkdir(parents=True, exist_ok=True)
+        for name, img in zip(MAP_NAMES, maps):
+            cv2.imwrite(str(job_dir / f"{name}.png"), img)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare direct and background writes of the result maps.")
+    parser.add_argument('--size', type=int, default=2048, help='side of the square maps')
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--compute_time', type=float, default=0.5, help='seconds of computation per job')
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_output_writer_"))
+    try:
+        maps = result_maps(args.size, seed=0)
+
+        start = time.perf_counter()
+        run_jobs(work_dir / "direct" / "results", maps, args.jobs, args.compute_time)
+        direct_time = (time.perf_counter() - start) / args.jobs
+
+        output_dir = work_dir / "output"
+        start = time.perf_counter()
+        writes = output_writer.PendingWrites()
+        with output_writer.redirect(work_dir / "session" / "results", writes, output_dir, single=False):
+            run_jobs(work_dir / "session" / "results", maps, args.jobs, args.compute_time)
+        writes.wait()
+        background_time = (time.perf_counter() - start) / args.jobs
+
+        for job in range(args.jobs):
+            for name, img in zip(MAP_NAMES, maps):
+                written = cv2.imread(str(output_dir / f"job_{job:02d}.data" / f"{name}.png"))
+                assert written is not None and np.array_equal(written, img), f"job {job}: {name}.png differs"
+        leftovers = [name for _, _, files in os.walk(work_dir) for name in files if ".tmp" in name]
+        assert not leftovers, f"temporary files left behind: {leftovers}"
+
+        print(f"{args.jobs} jobs of {args.compute_time:.2f} sec computation and 4 maps of {args.size} x {args.size} pixels")
+        print(f"direct writes    : {direct_time:8.3f} sec per job")
+        print(f"background writes: {background_time:8.3f} sec per job, speedup x{direct_time / background_time:.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark of the relighting renderer: per-light loop (as relighting.py used to do) versus
+batched rendering of chunks of light directions with render_frames(). Tiled rendering (--memory_limit_mb) is
+checked separately by benchmarks/tiled_relighting_check.py.
+The precomputed engine (relighting_engine.py) is compared with render() on the same frames, and timed on
+--dome_lights random lights. Sparse rendering of the foreground pixels (foreground.py) is compared with
+dense rendering on a circular mask.
+
+python benchmarks/relighting_benchmark.py --size 512 --chunk_sizes 1 8 24 72
+"""
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+# relighting.py imports 'modules' relative to the sdm_unips folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+
+import numpy as np
+import torch
+
+import relighting
+import foreground
+from modules.utils.render import render
+from synthetic_data import synthetic_maps, random_lights, circular_mask
+
+
+def render_frames_loop(nml, base, rough, metallic, unit_vectors, device, sleep=0.0):
+    """
+    Reference implementation: the original one-light-per-iteration loop of relighting.py.
+    """
+    img_stack = []
+    for k in range(unit_vectors.shape[0]):
+        time.sleep(sleep)
+        l = torch.Tensor(unit_vectors[k,:]).reshape(1,3,1)
+        nl, fd, fr = render(nml.to(device), l.to(device), base.to(device), rough.to(device), metallic.to(device), emit = 4.0, device = device)
+        rendered = nl * (fd + fr)
+        rendered = torch.clamp(rendered.cpu().permute(0,2,3,1).squeeze(), min=0, max=1).numpy()
+        img_stack.append((255.0 * rendered).astype(np.uint8))
+    return img_stack
+
+
+def max_frame_difference(frames_a, frames_b):
+    return max(int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max()) for a, b in zip(frames_a, frames_b))
+
+
+def bench_precomputed_engine(nml, base, rough, metallic, unit_vectors, reference, chunk_size, device, dome_lights):
+    """
+    Times the precomputed engine on the lights of the other renderers and on 'dome_lights' random lights.
+    """
+    start = time.perf_counter()
+    precomputed = relighting.precomputed_relighter(nml, base, rough, metallic, unit_vectors, chunk_size, device)
+    if precomputed is None:
+        print("precomputed    : differs from render(), not used")
+        return
+    relighter, chunk_size = precomputed
+    frames = list(relighting.iter_precomputed_frames(relighter, unit_vectors, chunk_size))
+    engine_time = time.perf_counter() - start
+    print(f"precomputed    : {engine_time:8.3f} sec ({len(frames) / engine_time:7.1f} frames/sec), "
+          f"max frame difference {max_frame_difference(reference, frames)}")
+
+    dome = relighting.numpy_to_pytorch(random_lights(dome_lights, seed=0))
+    start = time.perf_counter()
+    count = sum(len(frames) for _, frames in relighter.render_chunks(dome, chunk_size))
+    dome_time = time.perf_counter() - start
+    print(f"{count} lights    : {dome_time:8.3f} sec ({count / dome_time:7.1f} frames/sec)")
+
+
+def bench_sparse(nml, base, rough, metallic, unit_vectors, reference, chunk_size, device):
+    """
+    Renders the foreground pixels of a circular mask only and compares the frames with the dense ones.
+    """
+    mask = circular_mask(nml.shape[-1]) > 0
+    index = foreground.ForegroundIndex(mask)
+    start = time.perf_counter()
+    packed = [index.pack(x) for x in (nml, base, rough, metallic)]
+    frames = list(index.iter_unpacked(relighting.iter_frames(*packed, unit_vectors, chunk_size, device)))
+    sparse_time = time.perf_counter() - start
+    masked_reference = [frame * mask[:, :, None] for frame in reference]
+    print(f"sparse ({100 * index.fraction:4.1f}%) : {sparse_time:8.3f} sec ({len(frames) / sparse_time:7.1f} frames/sec), "
+          f"max frame difference in the mask {max_frame_difference(masked_reference, frames)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched relighting against the per-light loop.")
+    parser.add_argument('--size', type=int, default=512, help='side of the synthetic square maps')
+    parser.add_argument('--num_lights', type=int, default=72)
+    parser.add_argument('--chunk_sizes', type=int, nargs='+', default=[1, 8, 24, 72])
+    parser.add_argument('--dome_lights', type=int, default=1000, help='number of random lights rendered with the precomputed engine')
+    parser.add_argument('--sleep', type=float, default=0.0, help='per-frame sleep of the reference loop (the original script used 0.1)')
+    args = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    nml, base, rough, metallic = synthetic_maps(args.size, device)
+    unit_vectors = relighting.numpy_to_pytorch(relighting.generate_points_with_same_incident_angle(args.num_lights))
+
+    start = time.perf_counter()
+    reference = render_frames_loop(nml, base, rough, metallic, unit_vectors, device, sleep=args.sleep)
+    loop_time = time.perf_counter() - start
+    print(f"per-light loop : {loop_time:8.3f} sec ({args.num_lights / loop_time:7.1f} frames/sec)")
+
+    for chunk_size in args.chunk_sizes:
+        start = time.perf_counter()
+        frames = relighting.render_frames(nml, base, rough, metallic, unit_vectors, chunk_size, device)
+        batched_time = time.perf_counter() - start
+        print(f"chunk_size {chunk_size:4d}: {batched_time:8.3f} sec ({args.num_lights / batched_time:7.1f} frames/sec), "
+              f"speedup x{loop_time / batched_time:.2f}, max frame difference {max_frame_difference(reference, frames)}")
+
+    bench_sparse(nml, base, rough, metallic, unit_vectors, reference, max(args.chunk_sizes), device)
+    bench_precomputed_engine(nml, base, rough, metallic, unit_vectors, reference, max(args.chunk_sizes), device, args.dome_lights)
+
+
+if __name__ == '__main__':
+    main()
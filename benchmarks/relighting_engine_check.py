@@ -0,0 +1,52 @@
+"""
+Check of the precomputed relighting engine (sdm_unips/relighting_engine.py) against render(): synthetic maps
+(several seeds, including a very glossy one) are compared with PrecomputedRelighter.check() under random
+lights, and the check fails (non-zero exit code) unless the per-pixel difference of every map stays below
+relighting.ENGINE_TOLERANCE, i.e. unless relighting.py --engine precomputed would actually use the engine.
+
+python benchmarks/relighting_engine_check.py --size 128 --num_lights 16 --seeds 0 1 2
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+# relighting.py imports 'modules' relative to the sdm_unips folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+
+import torch
+
+import relighting
+import relighting_engine
+from synthetic_data import synthetic_maps, random_lights
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the precomputed relighting engine reproduces render().")
+    parser.add_argument('--size', type=int, default=128, help='side of the synthetic square maps')
+    parser.add_argument('--num_lights', type=int, default=16)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2])
+    args = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    lights = relighting.numpy_to_pytorch(random_lights(args.num_lights, seed=0))
+
+    failures = []
+    for seed in args.seeds:
+        nml, base, rough, metallic = synthetic_maps(args.size, device, seed=seed)
+        # The glossy variant is nearly a mirror: the sharpest highlights of the GGX term
+        for name, roughness in (("", rough), (", glossy", 0.05 * rough)):
+            relighter = relighting_engine.PrecomputedRelighter(nml, base, roughness, metallic, device)
+            error = relighter.check(nml, base, roughness, metallic, lights)
+            print(f"seed {seed}{name}: max difference with render() {255 * error:.3f} levels of 255")
+            if error > relighting.ENGINE_TOLERANCE:
+                failures.append(f"seed {seed}{name}")
+
+    if failures:
+        sys.exit(f"FAILED: the precomputed engine differs from render() on {', '.join(failures)} "
+                 f"(tolerance {255 * relighting.ENGINE_TOLERANCE:.2f} levels)")
+    print(f"OK: the precomputed engine reproduces render() within {255 * relighting.ENGINE_TOLERANCE:.2f} levels of 255")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+CPU-runnable benchmark suite. Synthetic '.data' folders (see synthetic_data.py) are generated at several
+resolutions and image counts, then the following stages are timed:
+
+- loading: dataio reading and decoding the images (main.load_test_data),
+- model_build and inference: builder construction and run() (which also writes the result PNGs);
+  without a checkpoint, the network keeps its random initial weights,
+- result_writing: encoding the four result maps as PNG,
+- relighting: relighting.relight() of the results,
+- organize_*: the cheminova organize scripts in every placement mode.
+
+Results are written to JSON so that runs can be compared across commits:
+
+python benchmarks/run_benchmarks.py --resolutions 128 256 --image_counts 10 --output bench.json
+python benchmarks/run_benchmarks.py --resolutions 128 256 --image_counts 10 --compare bench.json
+"""
+
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+from pathlib import Path
+
+REPOSITORY_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPOSITORY_DIR / "sdm_unips"))
+
+import cv2
+import numpy as np
+import torch
+
+import main as sdm_main
+import relighting
+from synthetic_data import write_synthetic_dataset, synthetic_maps
+
+
+def load_script(path, name):
+    """
+    Import a script by path (the organize scripts are not importable by name).
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def has_checkpoint(checkpoint, target):
+    subfolders = {'normal': ['normal'], 'brdf': ['brdf'], 'normal_and_brdf': ['normal', 'brdf']}[target]
+    return all(any((checkpoint / subfolder).glob("*.pytmodel")) for subfolder in subfolders)
+
+
+def build_benchmark_model(args):
+    """
+    Build the model from the checkpoint if there is one, otherwise keep the randomly initialised weights.
+    """
+    if has_checkpoint(args.checkpoint, args.target):
+        return sdm_main.build_model(args), "checkpoint"
+    from modules.builder import builder
+    load_models = builder.builder.load_models
+    builder.builder.load_models = lambda self, model, dirpath: model
+    try:
+        return sdm_main.build_model(args), "random"
+    finally:
+        builder.builder.load_models = load_models
+
+
+def bench_pipeline(work_dir, size, num_images, options, record):
+    """
+    loading, model_build, inference, result_writing and relighting of one synthetic dataset.
+    """
+    test_dir = work_dir / f"test_{size}_{num_images}"
+    write_synthetic_dataset(test_dir / "synthetic.data", size, num_images)
+    params = {"resolution": size, "images": num_images}
+
+    args = sdm_main.parse_args([
+        "--session_name", str(work_dir / f"session_{size}_{num_images}"),
+        "--test_dir", str(test_dir),
+        "--checkpoint", str(options.checkpoint),
+        "--target", options.target,
+        "--max_image_num", str(num_images),
+        "--max_image_res", str(size),
+        "--canonical_resolution", str(options.canonical_resolution),
+        "--pixel_samples", str(options.pixel_samples),
+    ] + (["--scalable"] if options.scalable else []))
+
+    test_data, seconds = timed(sdm_main.load_test_data, args, preload=True)
+    record("loading", params, seconds)
+    test_data = test_data[0]
+
+    results_dir = Path(args.session_name) / "results" / "synthetic.data"
+    try:
+        (model, weights), seconds = timed(build_benchmark_model, args)
+        record("model_build", params, seconds, weights=weights)
+        _, seconds = timed(sdm_main.run_session, model, args, test_data)
+        record("inference", params, seconds, weights=weights)
+    except Exception as e:
+        print(f"inference skipped: {type(e).__name__}: {e}")
+        record("inference", params, None, error=f"{type(e).__name__}: {e}")
+
+    if not (results_dir / "normal.png").exists() or not (results_dir / "baseColor.png").exists():
+        # Relight the ground truth maps instead
+        results_dir.mkdir(parents=True, exist_ok=True)
+        for name in ["normal", "baseColor", "roughness", "metallic"]:
+            gt_name = "Normal_gt.png" if name == "normal" else f"{name}_gt.png"
+            shutil.copy(test_dir / "synthetic.data" / gt_name, results_dir / f"{name}.png")
+
+    nml, base, rough, metallic = synthetic_maps(size, torch.device("cpu"))
+    maps = [(255 * (0.5 * (nml + 1))[0].permute(1, 2, 0).numpy()).astype(np.uint8),
+            (255 * base[0].permute(1, 2, 0).numpy()).astype(np.uint8),
+            (255 * rough[0, 0].numpy()).astype(np.uint8),
+            (255 * metallic[0, 0].numpy()).astype(np.uint8)]
+    write_dir = work_dir / f"write_{size}_{num_images}"
+    write_dir.mkdir()
+    _, seconds = timed(lambda: [cv2.imwrite(str(write_dir / f"{i}.png"), m) for i, m in enumerate(maps)])
+    record("result_writing", params, seconds)
+
+    _, seconds = timed(relighting.relight, str(results_dir), output_format="avi")
+    record("relighting", params, seconds, frames=72)
+
+
+def bench_organize(work_dir, size, num_source_images, num_images, record):
+    """
+    The organize scripts on a synthetic RTI capture, in every placement mode.
+    """
+    organize_rti = load_script(REPOSITORY_DIR / "cheminova" / "organize_data_to_SDM.py", "organize_data_to_SDM")
+    organize_mv = load_script(REPOSITORY_DIR / "cheminova" / "organize_DiLiGenT-MV_to_SMD.py", "organize_DiLiGenT_MV_to_SMD")
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (size, size, 3), dtype=np.uint8)
+    rti_dir = work_dir / "organize" / "capture" / "object" / "rti"
+    view_dir = work_dir / "organize_mv" / "view_01"
+    rti_dir.mkdir(parents=True)
+    view_dir.mkdir(parents=True)
+    for i in range(num_source_images):
+        cv2.imwrite(str(rti_dir / f"image_{i:04d}.jpg"), image)
+        cv2.imwrite(str(view_dir / f"{i:03d}.png"), image)
+
+    params = {"resolution": size, "images": num_images, "source_images": num_source_images}
+    for mode in organize_rti.PLACEMENT_MODES:
+        _, seconds = timed(organize_rti.process_rti_folders, work_dir / "organize", num_images, False, mode)
+        record(f"organize_rti_{mode}", params, seconds)
+        _, seconds = timed(organize_mv.process_viewpoint_folders, work_dir / "organize_mv", num_images, False, mode)
+        record(f"organize_mv_{mode}", params, seconds)
+
+
+def compare(results, previous_path):
+    """
+    Print the ratio of every timing to the same benchmark in a previous JSON file.
+    """
+    with open(previous_path) as f:
+        previous = json.load(f)
+    key = lambda r: (r["stage"], json.dumps(r["params"], sort_keys=True))
+    previous_seconds = {key(r): r["seconds"] for r in previous["results"]}
+    print(f"\nComparison with {previous_path} (commit {previous.get('commit')})")
+    for r in results:
+        before = previous_seconds.get(key(r))
+        if before and r["seconds"]:
+            print(f"{r['stage']:<24} {json.dumps(r['params']):<60} {before:9.3f} -> {r['seconds']:9.3f} sec (x{before / r['seconds']:.2f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading, inference, writing, relighting and organizing on synthetic data.")
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[128, 256])
+    parser.add_argument('--image_counts', type=int, nargs='+', default=[10])
+    parser.add_argument('--checkpoint', type=Path, default=REPOSITORY_DIR / "checkpoint")
+    parser.add_argument('--target', default='normal_and_brdf', choices=['normal', 'brdf', 'normal_and_brdf'])
+    parser.add_argument('--canonical_resolution', type=int, default=128)
+    parser.add_argument('--pixel_samples', type=int, default=2000)
+    parser.add_argument('--scalable', action='store_true')
+    parser.add_argument('--organize_source_images', type=int, default=50)
+    parser.add_argument('--output', type=Path, default=None, help='JSON file of the results (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', type=Path, default=None, help='JSON file of a previous run to compare with')
+    parser.add_argument('--keep_data', action='store_true', help='keep the synthetic data and outputs')
+    options = parser.parse_args()
+
+    results = []
+    def record(stage, params, seconds, **extra):
+        results.append({"stage": stage, "params": params, "seconds": seconds, **extra})
+        if seconds is not None:
+            print(f"{stage:<24} {json.dumps(params):<60} {seconds:9.3f} sec")
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_bench_"))
+    try:
+        for size in options.resolutions:
+            for num_images in options.image_counts:
+                bench_pipeline(work_dir, size, num_images, options, record)
+        bench_organize(work_dir, max(options.resolutions), options.organize_source_images, max(options.image_counts), record)
+    finally:
+        if options.keep_data:
+            print(f"Benchmark data kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": "cuda" if torch.cuda.is_available() else "cpu",
+        "threads": torch.get_num_threads(),
+        "results": results,
+    }
+    output = options.output or REPOSITORY_DIR / "benchmarks" / "results" / f"{(commit or 'unknown')[:12]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Normal map error versus the number of selected images K, for the two selection modes of the organize scripts:
+equally spaced images (index stride over the sorted file names) and the most diverse lighting
+(sdm_unips/image_selection.py). A synthetic object is rendered under an RTI-like light dome (rings of lights
+from low to high elevation, in acquisition order), K images are selected with both strategies, and the
+normals are recovered from them with:
+
+- Lambertian least-squares photometric stereo with the known lights (always; a cheap proxy of how well the
+  subset constrains the normals),
+- SDM-UniPS (with --sdm_unips, which needs the checkpoint).
+
+python benchmarks/selection_benchmark.py --size 256 --counts 4 6 8 10 16
+"""
+
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+from run_benchmarks import REPOSITORY_DIR, load_script
+
+import cv2
+import numpy as np
+
+import main as sdm_main
+import cpu_inference
+from data_manifest import place_file
+from image_selection import select_diverse_images
+from synthetic_data import write_synthetic_dataset
+
+organize_rti = load_script(REPOSITORY_DIR / "cheminova" / "organize_data_to_SDM.py", "organize_data_to_SDM")
+
+
+def rti_dome(rings=((10, 24), (25, 20), (40, 16), (55, 12), (70, 8), (85, 4))):
+    """
+    Light directions (N, 3) of a dome of rings (elevation in degrees, number of lights), ring after ring.
+    """
+    lights = []
+    for elevation, count in rings:
+        azimuth = np.linspace(0, 2 * np.pi, count, endpoint=False)
+        elevation = np.radians(elevation)
+        lights += [np.stack((np.cos(azimuth) * np.cos(elevation), np.sin(azimuth) * np.cos(elevation),
+                             np.full(count, np.sin(elevation))), axis=-1)]
+    return np.concatenate(lights)
+
+
+def image_number(path):
+    """
+    i of 'L (i).PNG'.
+    """
+    return int(path.stem.split("(")[1].rstrip(")"))
+
+
+def least_squares_error(data_dir, selected, lights):
+    """
+    Mean angular error (degrees) of Lambertian least-squares photometric stereo on the selected images.
+    """
+    normal_gt, mask = cpu_inference.read_normal_map(data_dir / "Normal_gt.png")
+    mask &= cv2.imread(str(data_dir / "mask.png"), cv2.IMREAD_GRAYSCALE) > 0
+    intensities = np.stack([cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)[mask].astype(np.float32) for path in selected])
+    directions = lights[[image_number(path) - 1 for path in selected]]
+    g, *_ = np.linalg.lstsq(directions, intensities, rcond=None)
+    normals = g.T / (np.linalg.norm(g.T, axis=1, keepdims=True) + 1e-12)
+    cosine = np.clip((normals * normal_gt[mask]).sum(axis=1), -1, 1)
+    return float(np.degrees(np.arccos(cosine)).mean())
+
+
+def sdm_unips_error(work_dir, data_dir, selected, name, model, options):
+    """
+    Mean angular error (degrees) of SDM-UniPS on the selected images.
+    """
+    sdm_in = work_dir / name / "selected.data"
+    sdm_in.mkdir(parents=True)
+    for i, path in enumerate(selected, 1):
+        place_file(path, sdm_in / f"L ({i}).PNG", 'symlink')
+    shutil.copy(data_dir / "mask.png", sdm_in / "mask.png")
+    args = sdm_main.parse_args(["--session_name", str(work_dir / f"session_{name}"), "--test_dir", str(work_dir / name),
+                                "--checkpoint", str(options.checkpoint), "--target", "normal",
+                                "--max_image_num", str(len(selected)), "--max_image_res", str(options.size)])
+    sdm_main.run_session(model, args)
+    return cpu_inference.mean_angular_error(data_dir / "Normal_gt.png", work_dir / f"session_{name}" / "results" / "selected.data" / "normal.png")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the normal error of equally spaced and diverse image selections.")
+    parser.add_argument('--size', type=int, default=256, help='side of the synthetic square images')
+    parser.add_argument('--counts', type=int, nargs='+', default=[4, 6, 8, 10, 16], help='numbers of selected images K')
+    parser.add_argument('--sdm_unips', action='store_true', help='also run SDM-UniPS on every selection (needs the checkpoint)')
+    parser.add_argument('--checkpoint', type=Path, default=REPOSITORY_DIR / "checkpoint")
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_selection_"))
+    try:
+        lights = rti_dome()
+        data_dir = work_dir / "capture.data"
+        write_synthetic_dataset(data_dir, args.size, len(lights), lights=lights)
+        # As in the organize scripts
+        images = sorted(path for path in data_dir.iterdir() if path.name.startswith("L ("))
+
+        model = None
+        if args.sdm_unips:
+            model = sdm_main.build_model(sdm_main.parse_args(["--checkpoint", str(args.checkpoint), "--target", "normal"]))
+
+        print(f"\n{len(images)} images; mean angular error (degrees)")
+        print(f"{'K':>4} {'LS stride':>10} {'LS diverse':>11}" + (f" {'SDM stride':>11} {'SDM diverse':>12}" if model else ""))
+        for k in args.counts:
+            selections = {"stride": organize_rti.select_equally_spaced_images(images, k),
+                          "diverse": select_diverse_images(images, k, data_dir / "mask.png")}
+            row = [least_squares_error(data_dir, selections[name], lights) for name in ("stride", "diverse")]
+            if model is not None:
+                row += [sdm_unips_error(work_dir, data_dir, selections[name], f"{name}_{k}", model, args) for name in ("stride", "diverse")]
+            print(f"{k:>4} " + " ".join(f"{value:>10.2f} " for value in row))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Check that the results of main.py take the sparse path of relighting.py (foreground.py): a synthetic dataset
+with a circular mask.png is run by main.py, both into the session folder and into an --output_dir (as
+run_sdm_multifolder.py does), and the check fails (non-zero exit code) unless every result folder holds the
+mask.png of the dataset and relighting.py renders its foreground pixels only. Without a checkpoint, the
+network keeps its random initial weights, which does not change the outputs that are checked.
+
+python benchmarks/sparse_relighting_check.py --size 128 --num_images 8
+"""
+
+import sys
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+from run_benchmarks import REPOSITORY_DIR, build_benchmark_model
+
+import cv2
+import numpy as np
+
+import main as sdm_main
+import relighting
+from synthetic_data import write_synthetic_dataset
+
+
+def check_result_folder(result_folder, input_mask):
+    """
+    Problems of one result folder (empty if it takes the sparse path).
+    """
+    mask_path = result_folder / "mask.png"
+    if not mask_path.is_file():
+        return [f"{result_folder}: no mask.png"]
+    problems = []
+    if not np.array_equal(cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE), input_mask):
+        problems.append(f"{mask_path} differs from the input mask")
+    height, width = cv2.imread(str(result_folder / "normal.png")).shape[:2]
+    index = relighting.sparse_index(result_folder, (height, width))
+    if index is None:
+        problems.append(f"{result_folder}: relighting.py would render every pixel")
+    else:
+        print(f"{result_folder}: {100 * index.fraction:.1f}% of the pixels rendered")
+        relighting.relight(str(result_folder), output_format="avi")
+        if not (result_folder / "output.avi").is_file():
+            problems.append(f"{result_folder}: no output.avi")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that relighting.py renders the results of main.py sparsely.")
+    parser.add_argument('--size', type=int, default=128, help='side of the synthetic square images')
+    parser.add_argument('--num_images', type=int, default=8)
+    parser.add_argument('--checkpoint', type=Path, default=REPOSITORY_DIR / "checkpoint")
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_sparse_"))
+    try:
+        test_dir = work_dir / "rti"
+        write_synthetic_dataset(test_dir / "SDM_in.data", args.size, args.num_images)
+        input_mask = cv2.imread(str(test_dir / "SDM_in.data" / "mask.png"), cv2.IMREAD_GRAYSCALE)
+
+        common = ["--checkpoint", str(args.checkpoint), "--target", "normal_and_brdf", "--test_dir", str(test_dir),
+                  "--max_image_num", str(args.num_images), "--max_image_res", str(args.size), "--scalable"]
+        model, weights = build_benchmark_model(sdm_main.parse_args(common))
+        print(f"{args.num_images} images of {args.size} x {args.size} pixels ({weights} weights)")
+
+        session = work_dir / "session"
+        sdm_main.run_session(model, sdm_main.parse_args(common + ["--session_name", str(session)]))
+        output_dir = test_dir / "SDM_out"
+        sdm_main.run_session(model, sdm_main.parse_args(common + ["--session_name", str(work_dir / "session_out"),
+                                                                  "--output_dir", str(output_dir)]))
+
+        result_folders = [folder for folder in (session / "results").iterdir() if folder.is_dir()] + [output_dir]
+        problems = [problem for folder in result_folders for problem in check_result_folder(folder, input_mask)]
+        if problems:
+            sys.exit("FAILED:\n" + "\n".join(problems))
+        print(f"OK: the {len(result_folders)} result folders hold the input mask and are relit sparsely")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Time to first pixel of sdm_unips/main.py with and without the precompiled model artifact: the model is built
+from the checkpoint (--use_compiled off), exported (--export_model), then loaded from the artifact
+(--use_compiled). Every run is a new process on the same small synthetic dataset, so the times include the
+Python and torch imports. A checkpoint is required (the artifact holds the loaded weights).
+
+python benchmarks/startup_benchmark.py --checkpoint ./checkpoint --target normal --repeat 3
+"""
+
+import re
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from synthetic_data import write_synthetic_dataset
+
+REPOSITORY_DIR = Path(__file__).resolve().parent.parent
+MAIN = REPOSITORY_DIR / "sdm_unips" / "main.py"
+
+
+def run_main(arguments):
+    """
+    Run main.py and return its time to first pixel and time to model ready (sec).
+    """
+    output = subprocess.run([sys.executable, str(MAIN), *arguments], capture_output=True, text=True)
+    if output.returncode != 0:
+        print(output.stdout[-2000:], output.stderr[-2000:])
+        raise RuntimeError(f"main.py failed with code {output.returncode}")
+    match = re.search(r"Time to first pixel: ([\d.]+) sec \(model ready after ([\d.]+) sec", output.stdout)
+    return float(match.group(1)), float(match.group(2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first pixel of main.py with and without the model artifact.")
+    parser.add_argument('--checkpoint', type=Path, default=REPOSITORY_DIR / "checkpoint")
+    parser.add_argument('--target', default='normal', choices=['normal', 'brdf', 'normal_and_brdf'])
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--num_images', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="sdm_startup_"))
+    try:
+        write_synthetic_dataset(work_dir / "test" / "synthetic.data", args.size, args.num_images)
+        common = ["--test_dir", str(work_dir / "test"), "--checkpoint", str(args.checkpoint.resolve()),
+                  "--target", args.target, "--max_image_num", str(args.num_images), "--scalable"]
+
+        timings = {}
+        for label, extra in [("checkpoint", []), ("artifact", ["--use_compiled"])]:
+            if label == "artifact":
+                subprocess.run([sys.executable, str(MAIN), "--export_model", *common], check=True)
+            timings[label] = [run_main(["--session_name", str(work_dir / f"session_{label}_{i}"), *common, *extra])
+                              for i in range(args.repeat)]
+
+        print('================================================================')
+        for label, runs in timings.items():
+            first_pixel = min(run[0] for run in runs)
+            model_ready = min(run[1] for run in runs)
+            print(f"{label:<12} time to first pixel {first_pixel:8.3f} sec, model ready after {model_ready:8.3f} sec (best of {len(runs)})")
+        before, after = min(r[0] for r in timings["checkpoint"]), min(r[0] for r in timings["artifact"])
+        print(f"Speedup of the time to first pixel: x{before / after:.2f}")
+        print('================================================================')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
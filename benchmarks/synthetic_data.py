@@ -0,0 +1,108 @@
+"""
+Synthetic photometric stereo data for the benchmarks: random smooth normal/BRDF maps rendered with
+modules.utils.render.render under known directional lights, written as '*.data' folders that
+sdm_unips/main.py can load.
+
+python benchmarks/synthetic_data.py --output_dir ./synthetic --resolutions 256 512 --image_counts 10 32
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+# relighting.py imports 'modules' relative to the sdm_unips folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import relighting
+
+
+def synthetic_maps(size, device, seed=0):
+    """
+    Random but smooth normal/BRDF maps of shape (1, C, size, size).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    low = max(2, size // 16)
+    nml = torch.randn(1, 3, low, low, generator=generator)
+    nml[:, 2] = nml[:, 2].abs() + 1.0
+    nml = F.normalize(F.interpolate(nml, size=(size, size), mode='bilinear', align_corners=True), p=2, dim=1)
+    base = F.interpolate(torch.rand(1, 3, low, low, generator=generator), size=(size, size), mode='bilinear', align_corners=True)
+    rough = F.interpolate(torch.rand(1, 1, low, low, generator=generator), size=(size, size), mode='bilinear', align_corners=True)
+    metallic = F.interpolate(torch.rand(1, 1, low, low, generator=generator), size=(size, size), mode='bilinear', align_corners=True)
+    return nml.to(device), base.to(device), rough.to(device), metallic.to(device)
+
+
+def random_lights(num_lights, seed=0, min_elevation=np.pi / 8):
+    """
+    'num_lights' random unit directions (num_lights, 3) on the upper hemisphere, at least 'min_elevation'
+    above the horizon.
+    """
+    rng = np.random.default_rng(seed)
+    azimuth = rng.uniform(0, 2 * np.pi, num_lights)
+    # Uniform on the spherical cap whose elevation is above 'min_elevation'
+    zenith = np.arccos(rng.uniform(np.sin(min_elevation), 1.0, num_lights))
+    return np.stack((np.cos(azimuth) * np.sin(zenith), np.sin(azimuth) * np.sin(zenith), np.cos(zenith)), axis=-1)
+
+
+def circular_mask(size):
+    """
+    uint8 mask (size, size) of a centered disk covering most of the image.
+    """
+    yy, xx = np.mgrid[:size, :size]
+    radius = 0.45 * size
+    return (255 * (((yy - size / 2) ** 2 + (xx - size / 2) ** 2) < radius ** 2)).astype(np.uint8)
+
+
+def write_synthetic_dataset(data_dir, size, num_images, seed=0, device=None, chunk_size=8, with_mask=True, lights=None):
+    """
+    Render a synthetic object under 'num_images' random lights (or under 'lights' (N, 3)) and write it as a
+    '.data' folder:
+    'L (i).PNG' images, 'mask.png', the ground truth 'Normal_gt.png' (which main.py uses to report the mean
+    angular error), the ground truth BRDF maps and 'lights.txt' (one light direction per line).
+    Returns the light directions.
+    """
+    device = device or torch.device("cpu")
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+
+    nml, base, rough, metallic = synthetic_maps(size, device, seed)
+    lights = random_lights(num_images, seed) if lights is None else lights
+    mask = circular_mask(size) if with_mask else np.full((size, size), 255, np.uint8)
+
+    frames = relighting.iter_frames(nml, base, rough, metallic, relighting.numpy_to_pytorch(lights), chunk_size, device)
+    for i, frame in enumerate(frames, 1):
+        frame = frame * (mask[:, :, None] > 0)
+        cv2.imwrite(str(data_dir / f"L ({i}).PNG"), frame[:, :, ::-1])
+
+    if with_mask:
+        cv2.imwrite(str(data_dir / "mask.png"), mask)
+    to_image = lambda x: (255 * x[0].permute(1, 2, 0).cpu().numpy()).clip(0, 255).astype(np.uint8)
+    cv2.imwrite(str(data_dir / "Normal_gt.png"), to_image(0.5 * (nml + 1))[:, :, ::-1])
+    cv2.imwrite(str(data_dir / "baseColor_gt.png"), to_image(base)[:, :, ::-1])
+    cv2.imwrite(str(data_dir / "roughness_gt.png"), to_image(rough))
+    cv2.imwrite(str(data_dir / "metallic_gt.png"), to_image(metallic))
+    np.savetxt(data_dir / "lights.txt", lights, fmt="%.6f")
+    return lights
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic photometric stereo '.data' folders.")
+    parser.add_argument('--output_dir', type=Path, required=True)
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[256])
+    parser.add_argument('--image_counts', type=int, nargs='+', default=[10])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.resolutions:
+        for num_images in args.image_counts:
+            data_dir = args.output_dir / f"synthetic_{size}px_{num_images}img.data"
+            write_synthetic_dataset(data_dir, size, num_images, seed=args.seed)
+            print(f"\nWrote {data_dir}")
+
+
+if __name__ == '__main__':
+    main()
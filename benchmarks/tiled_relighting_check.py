@@ -0,0 +1,58 @@
+"""
+Check of the tiled rendering of relighting.py (--memory_limit_mb): synthetic maps are rendered with and without
+tiles, for every --memory_limit_mb given (small ceilings force tiles of a few rows and chunks of fewer lights),
+and the check fails (non-zero exit code) unless the frames are identical.
+
+python benchmarks/tiled_relighting_check.py --size 96 --num_lights 6 --memory_limits_mb 0.5 2 8
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+# relighting.py imports 'modules' relative to the sdm_unips folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+
+import numpy as np
+import torch
+
+import relighting
+from synthetic_data import synthetic_maps
+
+
+def max_frame_difference(frames_a, frames_b):
+    return max(int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max()) for a, b in zip(frames_a, frames_b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that tiled relighting gives the same frames as untiled relighting.")
+    parser.add_argument('--size', type=int, default=96, help='side of the synthetic square maps')
+    parser.add_argument('--num_lights', type=int, default=6)
+    parser.add_argument('--chunk_size', type=int, default=3)
+    parser.add_argument('--memory_limits_mb', type=float, nargs='+', default=[0.5, 2, 8])
+    args = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    nml, base, rough, metallic = synthetic_maps(args.size, device, seed=1)
+    unit_vectors = relighting.numpy_to_pytorch(relighting.generate_points_with_same_incident_angle(args.num_lights))
+    untiled = relighting.render_frames(nml, base, rough, metallic, unit_vectors, args.chunk_size, device)
+
+    failures = []
+    for memory_limit_mb in args.memory_limits_mb:
+        # Tiled rendering keeps the maps on the cpu, as relighting.py does
+        tiled = relighting.render_frames(nml.cpu(), base.cpu(), rough.cpu(), metallic.cpu(), unit_vectors, args.chunk_size,
+                                         device, memory_limit_mb=memory_limit_mb)
+        difference = max_frame_difference(untiled, tiled)
+        if len(tiled) != len(untiled):
+            difference = f"{len(tiled)} frames instead of {len(untiled)}"
+        print(f"--memory_limit_mb {memory_limit_mb:6.2f}: max frame difference {difference}")
+        if difference != 0:
+            failures.append(memory_limit_mb)
+
+    if failures:
+        sys.exit(f"FAILED: tiled and untiled relighting differ with --memory_limit_mb {', '.join(map(str, failures))}")
+    print(f"OK: tiled and untiled relighting match on {len(untiled)} frames of {args.size} x {args.size} pixels")
+
+
+if __name__ == '__main__':
+    main()
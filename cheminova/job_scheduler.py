@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Per-process state created by the worker initializer (e.g. a resident model)
+_worker_context = None
+
+# Returned by a job function that had nothing to do (e.g. a folder processed by another worker)
+SKIPPED = "skipped"
+
+class JobResult:
+    """
+    Outcome of one job: its name, whether it succeeded, its wall time in seconds, the error message if any and
+    whether it was skipped.
+    """
+
+    def __init__(self, name, success, elapsed, error=None, skipped=False):
+        self.name = name
+        self.success = success
+        self.elapsed = elapsed
+        self.error = error
+        self.skipped = skipped
+
+def set_thread_budget(num_threads):
+    """
+    Limit the number of threads used by torch and the BLAS/OpenMP libraries of this process
+    (and of the subprocesses it starts).
+    """
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(num_threads)
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+
+def _init_worker(num_threads, initializer, initargs):
+    global _worker_context
+    set_thread_budget(num_threads)
+    if initializer is not None:
+        _worker_context = initializer(*initargs)
+
+def _run_job(job_function, name, job_args):
+    """
+    Run one job and turn any exception into a failed JobResult so that one bad folder does not stop the others.
+    The worker context is passed to the job function as its last argument.
+    """
+    start_time = time.time()
+    try:
+        skipped = job_function(*job_args, _worker_context) is SKIPPED
+        return JobResult(name, True, time.time() - start_time, skipped=skipped)
+    except Exception as e:
+        traceback.print_exc()
+        return JobResult(name, False, time.time() - start_time, f"{type(e).__name__}: {e}")
+
+def report_result(result):
+    if result.skipped:
+        print(f"[{result.name}] skipped")
+    elif result.success:
+        print(f"[{result.name}] done in {result.elapsed:.1f} sec")
+    else:
+        print(f"[{result.name}] FAILED after {result.elapsed:.1f} sec: {result.error}")
+    sys.stdout.flush()
+
+def run_jobs(jobs, job_function, num_workers=1, threads_per_worker=None, queue_size=None, initializer=None, initargs=()):
+    """
+    Run 'jobs' (a list of (name, args) tuples) as job_function(*args, context) on a pool of 'num_workers' processes.
+
+    - Each worker calls initializer(*initargs) once and passes its return value as 'context' to every job it runs.
+    - Each worker is limited to 'threads_per_worker' torch/OpenMP threads (default: cores / workers).
+    - At most 'queue_size' jobs (default: 2 * workers) are handed to the pool at any time.
+    - A job that raises is recorded as failed; a job whose worker process crashed is retried once in a new pool.
+
+    Returns the list of JobResult in completion order.
+    """
+    num_workers = max(1, num_workers)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+    if queue_size is None:
+        queue_size = 2 * num_workers
+    queue_size = max(num_workers, queue_size)
+
+    results = []
+    if num_workers == 1:
+        # Run in this process, so that an in-process model is not pickled into a worker
+        _init_worker(threads_per_worker, initializer, initargs)
+        for name, job_args in jobs:
+            result = _run_job(job_function, name, job_args)
+            report_result(result)
+            results.append(result)
+        return results
+
+    print(f"Starting {num_workers} workers with {threads_per_worker} threads each")
+    pending = deque((name, job_args, 0) for name, job_args in jobs)
+    executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                   initargs=(threads_per_worker, initializer, initargs))
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < queue_size:
+                name, job_args, retries = pending.popleft()
+                future = executor.submit(_run_job, job_function, name, job_args)
+                running[future] = (name, job_args, retries, time.time())
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            pool_broken = False
+            for future in done:
+                name, job_args, retries, submit_time = running.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    pool_broken = True
+                    if retries == 0:
+                        print(f"[{name}] worker process crashed, retrying")
+                        pending.append((name, job_args, retries + 1))
+                        continue
+                    result = JobResult(name, False, time.time() - submit_time, f"worker process crashed: {e}")
+                report_result(result)
+                results.append(result)
+
+            if pool_broken:
+                # Every job still running in the broken pool is lost too: queue them again in a new pool
+                for future, (name, job_args, retries, submit_time) in running.items():
+                    pending.appendleft((name, job_args, retries))
+                running = {}
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                               initargs=(threads_per_worker, initializer, initargs))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
+
+def print_summary(results, total_time=None):
+    """
+    Print a table with the status and timing of every job, followed by the totals.
+    """
+    if not results:
+        print("No jobs were run.")
+        return
+    name_width = max(len("Job"), max(len(result.name) for result in results))
+    print('================================================================')
+    print(f"{'Job':<{name_width}}  {'Status':<7}  {'Time (s)':>9}  Error")
+    for result in results:
+        status = "SKIPPED" if result.skipped else "OK" if result.success else "FAILED"
+        print(f"{result.name:<{name_width}}  {status:<7}  {result.elapsed:>9.1f}  {result.error or ''}")
+    skipped = sum(result.skipped for result in results)
+    succeeded = sum(result.success for result in results) - skipped
+    job_time = sum(result.elapsed for result in results)
+    print('----------------------------------------------------------------')
+    print(f"{succeeded} succeeded, {len(results) - succeeded - skipped} failed"
+          + (f", {skipped} skipped" if skipped else "") + f", {job_time:.1f} sec of job time"
+          + (f", {total_time:.1f} sec wall time" if total_time is not None else ""))
+    print('================================================================')
@@ -1,7 +1,13 @@
-import shutil
+import sys
 from pathlib import Path
 import argparse
 
+# The zero-copy helpers are shared with sdm_unips/main.py, which resolves manifests when loading the data
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "sdm_unips"))
+from data_manifest import MANIFEST_NAME, PLACEMENT_MODES, place_file, write_manifest
+from image_selection import SELECTION_MODES, select_diverse_images
+import dataset_index
+
 def select_equally_spaced_images(image_list, num_images_to_select):
     """
     Selects 'num_images_to_select' equally spaced images from the sorted image list.
@@ -16,68 +22,90 @@ def select_equally_spaced_images(image_list, num_images_to_select):
     
     return selected_images
 
-def copy_and_rename_images(src_folder, dst_folder, selected_images, VERBOSE):
+def copy_and_rename_images(src_folder, dst_folder, selected_images, VERBOSE, mode='copy'):
     """
     Copies and renames the selected images into the destination folder.
+    'mode' is one of 'copy', 'hardlink', 'symlink' (falling back to the other link type, then to a copy,
+    when links are not supported) or 'manifest' (only the ordered list of original files is written).
     """
     dst_folder.mkdir(parents=True, exist_ok=True)  # Create destination folder if it doesn't exist
-    
-    for i, image_file in enumerate(selected_images, 1):
-        src_image_path = src_folder / image_file
-        dst_image_name = f"L ({i}).JPG"
+
+    entries = [(f"L ({i}).JPG", src_folder / image_file) for i, image_file in enumerate(selected_images, 1)]
+
+    if mode == 'manifest':
+        for dst_image_name, _ in entries:
+            # Images placed by a previous run would be shadowed by the manifest
+            if (dst_folder / dst_image_name).is_symlink() or (dst_folder / dst_image_name).exists():
+                (dst_folder / dst_image_name).unlink()
+        write_manifest(dst_folder, entries)
+        if VERBOSE:
+            print(f"Wrote manifest of {len(entries)} images: {dst_folder / MANIFEST_NAME}")
+        return
+
+    # A manifest left by a previous run would take precedence over the placed images
+    if (dst_folder / MANIFEST_NAME).exists():
+        (dst_folder / MANIFEST_NAME).unlink()
+
+    for dst_image_name, src_image_path in entries:
         dst_image_path = dst_folder / dst_image_name
         
-        shutil.copy(src_image_path, dst_image_path)
+        used_mode = place_file(src_image_path, dst_image_path, mode)
         if VERBOSE:
-            print(f"Copied and renamed: {src_image_path} -> {dst_image_path}")
+            print(f"Placed ({used_mode}) and renamed: {src_image_path} -> {dst_image_path}")
 
-def copy_mask_image(rti_folder_path, sdm_in_folder, VERBOSE):
+def copy_mask_image(rti_folder_path, sdm_in_folder, VERBOSE, mode='copy'):
     """
     Copies the 'mask.png' file from the rti folder to the SDM_in.data folder.
+    In 'manifest' mode the (small) mask is copied next to the manifest.
     """
     mask_image_path = rti_folder_path / "mask.png"
     if mask_image_path.exists():
         dst_mask_path = sdm_in_folder / "mask.png"
-        shutil.copy(mask_image_path, dst_mask_path)
+        used_mode = place_file(mask_image_path, dst_mask_path, 'copy' if mode == 'manifest' else mode)
         if VERBOSE:
-            print(f"Copied mask: {mask_image_path} -> {dst_mask_path}")
+            print(f"Placed ({used_mode}) mask: {mask_image_path} -> {dst_mask_path}")
     else:
         if VERBOSE:
             print(f"WARNING: 'mask.png' not found in {rti_folder_path}.")
 
-def process_rti_folders(input_folder, num_images, VERBOSE):
+def process_rti_folders(input_folder, num_images, VERBOSE, mode='copy', selection='equally_spaced', index_path=None):
     """
     Main function that processes all subfolders in the input folder, finds the images in the 'rti' folder,
-    selects the requested number of equally spaced images, and copies/renames them into a new 'SDM_in.data' folder inside the 'rti' folder.
+    selects the requested number of images (equally spaced, or with the most diverse lighting), and copies/renames them into a new 'SDM_in.data' folder inside the 'rti' folder.
     """
     # Step 1: List all the folders in the input path
     input_folder = Path(input_folder)  # Convert to a Path object for cross-platform compatibility
-    for root_folder in input_folder.iterdir():
-        if root_folder.is_dir():
-            # Step 2.1: Find the subfolder named "rti"
-            for rti_folder_path in root_folder.rglob("rti"):  # Search for 'rti' folder in subdirectories
-                if rti_folder_path.is_dir():
-                    # Step 2.2: Identify the images with extension JPG, and sort them in ascending order
-                    jpg_images = sorted([f for f in rti_folder_path.iterdir() if f.suffix.lower() == '.jpg'])
-                    total_images_found = len(jpg_images)
-
-                    if jpg_images:
-                        # If requested more images than available, show a warning
-                        if total_images_found < num_images:
-                            print(f"WARNING: Found only {total_images_found} images, but {num_images} were requested.")
-                            selected_images = jpg_images  # Return all images if there are fewer than requested
-                        else:
-                            # Step 2.3: Select the requested number of equally spaced images
-                            selected_images = select_equally_spaced_images(jpg_images, num_images)
-
-                        # Step 2.4: Define the SDM_in folder path inside the rti folder
-                        sdm_in_folder = rti_folder_path / "SDM_in.data"
-                        
-                        # Copy and rename the images into the SDM_in folder
-                        copy_and_rename_images(rti_folder_path, sdm_in_folder, selected_images, VERBOSE)
-                        
-                        # Step 2.5: Copy the mask.png file if it exists
-                        copy_mask_image(rti_folder_path, sdm_in_folder, VERBOSE)
+    # One scan of the whole input folder; only the folders changed since the last run are listed
+    index = dataset_index.load(input_folder, index_path)
+    for root_folder_name in index.subfolders(input_folder):
+        root_folder = input_folder / root_folder_name
+        # Step 2.1: Find the subfolder named "rti"
+        for rti_folder_path in map(Path, index.find_folders("rti", under=root_folder)):  # Search for 'rti' folder in subdirectories
+            # Step 2.2: Identify the images with extension JPG, and sort them in ascending order
+            jpg_images = [Path(f) for f in index.images(rti_folder_path, ['.jpg'])]
+            total_images_found = len(jpg_images)
+
+            if jpg_images:
+                # If requested more images than available, show a warning
+                if total_images_found < num_images:
+                    print(f"WARNING: Found only {total_images_found} images, but {num_images} were requested.")
+                    selected_images = jpg_images  # Return all images if there are fewer than requested
+                else:
+                    # Step 2.3: Select the requested number of images
+                    if selection == 'diverse':
+                        # The most diverse lighting, from shading signatures of the images
+                        selected_images = select_diverse_images(jpg_images, num_images, rti_folder_path / "mask.png")
+                    else:
+                        selected_images = select_equally_spaced_images(jpg_images, num_images)
+
+                # Step 2.4: Define the SDM_in folder path inside the rti folder
+                sdm_in_folder = rti_folder_path / "SDM_in.data"
+                
+                # Copy and rename the images into the SDM_in folder
+                copy_and_rename_images(rti_folder_path, sdm_in_folder, selected_images, VERBOSE, mode)
+                
+                # Step 2.5: Copy the mask.png file if it exists
+                copy_mask_image(rti_folder_path, sdm_in_folder, VERBOSE, mode)
 
 if __name__ == "__main__":
 
@@ -88,8 +116,11 @@ if __name__ == "__main__":
     # Create an argument parser to accept command-line arguments
     parser = argparse.ArgumentParser(description="Process RTI folders and copy selected images into SDM_in.data folder.")
     parser.add_argument("--input_folder", type=str, help="Path to the input folder containing RTI data.")
-    parser.add_argument("--num_images", type=int, default=10, help="Number of equally spaced images to select (default is 10).")
+    parser.add_argument("--num_images", type=int, default=10, help="Number of images to select (default is 10).")
+    parser.add_argument("--selection", default="equally_spaced", choices=SELECTION_MODES, help="How the images are selected: equally spaced in the sorted list, or the most diverse lighting (farthest-point sampling of shading signatures, see sdm_unips/image_selection.py) (default is equally_spaced).")
+    parser.add_argument("--index_path", type=str, default=None, help="Dataset index file of the input folder (default: INPUT_FOLDER/.sdm_index.json, see sdm_unips/dataset_index.py).")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose mode to see more output.")
+    parser.add_argument("--mode", default="copy", choices=PLACEMENT_MODES, help="How images are placed in SDM_in.data: copies, hard links, symbolic links or a manifest of the original files (default is copy).")
 
     # Parse the arguments
     args = parser.parse_args()
@@ -103,6 +134,6 @@ if __name__ == "__main__":
     print('================================================================') 
 
     # Run the processing function with the provided input folder, number of images, and verbosity flag
-    process_rti_folders(args.input_folder, args.num_images, args.verbose)
+    process_rti_folders(args.input_folder, args.num_images, args.verbose, args.mode, args.selection, args.index_path)
 
 # python "cheminova/organize_data_to_SDM.py" --input_folder "C:/Users/Deivid/Documents/DiLiGenT-MV/DiLiGenT-MV/mvpmsData/bearPNG" --verbose --num_images 10
\ No newline at end of file
@@ -0,0 +1,132 @@
+import time
+import threading
+import traceback
+from collections import deque
+
+from job_scheduler import JobResult, report_result
+
+# Marks the end of the jobs in a stage queue
+_DONE = object()
+
+class StageQueue:
+    """
+    FIFO between two pipeline stages holding at most 'depth' items and, if 'max_bytes' is given, at most
+    that many bytes. A single item larger than 'max_bytes' is still accepted when the queue is empty.
+    """
+
+    def __init__(self, depth, max_bytes=None):
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.items = deque()
+        self.bytes = 0
+        self.condition = threading.Condition()
+
+    def _is_full(self, nbytes):
+        if not self.items:
+            return False
+        if len(self.items) >= self.depth:
+            return True
+        return self.max_bytes is not None and self.bytes + nbytes > self.max_bytes
+
+    def put(self, item, nbytes=0):
+        with self.condition:
+            while self._is_full(nbytes):
+                self.condition.wait()
+            self.items.append((item, nbytes))
+            self.bytes += nbytes
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+            item, nbytes = self.items.popleft()
+            self.bytes -= nbytes
+            self.condition.notify_all()
+            return item
+
+def run_pipeline(jobs, prefetch, infer, flush, depth=1, max_bytes=None, item_bytes=None, on_result=None):
+    """
+    Run 'jobs' (an iterable of (name, args) tuples, consumed by the prefetch thread) through three overlapping stages:
+
+    - prefetch(*args) runs in a background thread and reads/decodes the inputs of the next jobs,
+    - infer(*args, prefetched) runs in the calling thread, so that the model is never blocked on the disk,
+    - flush(*args, inferred) runs in another background thread and writes/moves the outputs.
+
+    At most 'depth' jobs wait between two stages and, if 'max_bytes' is given, the prefetched jobs waiting for
+    inference hold at most that many bytes, as measured by item_bytes(prefetched). A job that fails in any stage
+    is recorded as failed and skips its remaining stages. Returns the list of JobResult in completion order;
+    the time of a job goes from the start of its prefetch to the end of its flush. on_result(result), if given,
+    is called in the flush thread as soon as a job is finished. If iterating 'jobs' raises, the jobs already
+    started are finished, then the error is raised here.
+    """
+    prefetched_queue = StageQueue(depth, max_bytes)
+    inferred_queue = StageQueue(depth)
+    results = []
+
+    jobs_error = []
+
+    def prefetch_stage():
+        try:
+            for name, job_args in jobs:
+                start_time = time.time()
+                prefetched, error, nbytes = None, None, 0
+                try:
+                    prefetched = prefetch(*job_args)
+                    nbytes = item_bytes(prefetched) if item_bytes is not None else 0
+                except Exception as e:
+                    traceback.print_exc()
+                    error = e
+                prefetched_queue.put((name, job_args, start_time, prefetched, error), nbytes)
+        except BaseException as e:
+            # The jobs could not be iterated (e.g. the claim directory became unreadable): raised by run_pipeline
+            jobs_error.append(e)
+        finally:
+            prefetched_queue.put(_DONE)
+
+    def flush_stage():
+        while True:
+            entry = inferred_queue.get()
+            if entry is _DONE:
+                break
+            name, job_args, start_time, inferred, error = entry
+            if error is None:
+                try:
+                    flush(*job_args, inferred)
+                except Exception as e:
+                    traceback.print_exc()
+                    error = e
+            result = JobResult(name, error is None, time.time() - start_time,
+                               None if error is None else f"{type(error).__name__}: {error}")
+            report_result(result)
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+
+    prefetch_thread = threading.Thread(target=prefetch_stage, name="prefetch", daemon=True)
+    flush_thread = threading.Thread(target=flush_stage, name="flush", daemon=True)
+    prefetch_thread.start()
+    flush_thread.start()
+
+    while True:
+        entry = prefetched_queue.get()
+        if entry is _DONE:
+            break
+        name, job_args, start_time, prefetched, error = entry
+        entry = None  # Drop the reference to the decoded inputs once inference is done
+        inferred = None
+        if error is None:
+            try:
+                inferred = infer(*job_args, prefetched)
+            except Exception as e:
+                traceback.print_exc()
+                error = e
+        prefetched = None
+        inferred_queue.put((name, job_args, start_time, inferred, error))
+
+    inferred_queue.put(_DONE)
+    prefetch_thread.join()
+    flush_thread.join()
+    if jobs_error:
+        raise jobs_error[0]
+    return results
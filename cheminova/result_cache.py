@@ -0,0 +1,179 @@
+import os
+import json
+import shutil
+import hashlib
+import time
+from pathlib import Path
+
+from data_manifest import list_data_files
+from dataset_index import cached_files
+
+# Bump when the content of the cached results changes for the same inputs: new output files, or a change of the
+# default output of main.py or relighting.py (e.g. 2: render() as default engine, 3: sparse only with mask.png,
+# 4: mask.png copied into the results)
+CACHE_VERSION = "4"
+
+# Options of sdm_unips/main.py that change the results (the others, e.g. decoding threads, only change the speed)
+# Options left unset (None) are not part of the key, so that adding an option does not invalidate the cache
+CACHE_KEY_OPTIONS = ["max_image_res", "max_image_num", "canonical_resolution", "pixel_samples", "scalable", "target",
+                     "cpu_precision", "result_bundle"]
+
+# Files of SDM_out written by sdm_unips/main.py (the maps, the input mask and, with --result_bundle, their float16
+# bundle) and sdm_unips/relighting.py: the results that are cached, and removed before SDM_out is recomputed
+RESULT_FILES = ("normal.png", "baseColor.png", "roughness.png", "metallic.png", "mask.png", "maps.sdmb", "output.avi")
+
+# Written into SDM_out so that an unchanged folder is recognised without copying anything: the key, then the
+# names of the result files it covers, one per line
+CACHE_KEY_FILE = ".sdm_cache_key"
+
+class ResultCache:
+    """
+    Persistent, content-addressed cache of SDM_out results.
+
+    The key of a folder is a hash of the files of SDM_in.data (images and mask.png), the checkpoint files and
+    the sdm_unips options. File hashes are memoised by (size, mtime), so an unchanged capture is recognised
+    without reading it again. Entries are evicted least-recently-used first when the cache exceeds 'max_bytes'.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir).resolve()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.digest_index_path = self.cache_dir / "file_digests.json"
+        self.file_digests = self._load_digest_index()
+
+    def _load_digest_index(self):
+        try:
+            with open(self.digest_index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_digest_index(self):
+        # Merge with what other processes may have written meanwhile
+        file_digests = self._load_digest_index()
+        file_digests.update(self.file_digests)
+        tmp_path = self.digest_index_path.with_name(f"{self.digest_index_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(file_digests, f)
+        os.replace(tmp_path, self.digest_index_path)
+
+    def file_digest(self, path):
+        """
+        sha256 of a file, recomputed only when its size or modification time changed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        memo = self.file_digests.get(path)
+        if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            return memo[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        self.file_digests[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def _hash_tree(self, sha, folder, exclude=()):
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = sorted(d for d in dirs if d not in exclude)
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                sha.update(os.path.relpath(file_path, folder).encode())
+                sha.update(self.file_digest(file_path).encode())
+
+    def key(self, sdm_in_path, checkpoint_path, options):
+        """
+        Cache key of one SDM_in.data folder processed with the given checkpoint and sdm_unips options.
+        """
+        sha = hashlib.sha256(CACHE_VERSION.encode())
+        # Images listed in a manifest are hashed through their original files
+        for name, path in list_data_files(sdm_in_path, cached_files(sdm_in_path)):
+            sha.update(name.encode())
+            sha.update(self.file_digest(path).encode())
+        # Precompiled model artifacts (sdm_unips/model_artifact.py) are derived from the checkpoint
+        self._hash_tree(sha, checkpoint_path, exclude=("compiled",))
+        sha.update(json.dumps({name: options[name] for name in CACHE_KEY_OPTIONS if options.get(name) is not None}, sort_keys=True).encode())
+        self._save_digest_index()
+        return sha.hexdigest()
+
+    def lookup(self, key):
+        """
+        Return the folder of a complete cache entry, or None on a cache miss.
+        """
+        entry = self.cache_dir / key
+        if not (entry / ".complete").exists():
+            return None
+        os.utime(entry / ".complete")  # Last-used time for the eviction policy
+        return entry
+
+    def is_restored(self, key, destination_folder):
+        """
+        True if 'destination_folder' already holds the results of 'key': its key file names 'key' and every
+        result file listed there is present (a map deleted since, or a restore interrupted before the key file
+        was written, makes the folder be restored again).
+        """
+        try:
+            with open(os.path.join(destination_folder, CACHE_KEY_FILE)) as f:
+                lines = f.read().split()
+        except OSError:
+            return False
+        if len(lines) < 2 or lines[0] != key:
+            return False
+        return all(os.path.isfile(os.path.join(destination_folder, file_name)) for file_name in lines[1:])
+
+    @staticmethod
+    def _write_key_file(folder, key, file_names):
+        with open(os.path.join(folder, CACHE_KEY_FILE), "w") as f:
+            f.write("\n".join([key, *file_names]) + "\n")
+
+    def restore(self, key, entry, destination_folder):
+        """
+        Copy the results of a cache entry into 'destination_folder'.
+        """
+        os.makedirs(destination_folder, exist_ok=True)
+        file_names = sorted(file_name for file_name in os.listdir(entry) if file_name != ".complete")
+        for file_name in file_names:
+            shutil.copy2(entry / file_name, os.path.join(destination_folder, file_name))
+        self._write_key_file(destination_folder, key, file_names)
+
+    def store(self, key, results_folder):
+        """
+        Add the RESULT_FILES of 'results_folder' to the cache under 'key', then evict old entries if needed.
+        Other files (e.g. left there by the user) are not cached.
+        """
+        entry = self.cache_dir / key
+        tmp_entry = self.cache_dir / f"{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tmp_entry.mkdir()
+        file_names = [file_name for file_name in RESULT_FILES if os.path.isfile(os.path.join(results_folder, file_name))]
+        for file_name in file_names:
+            shutil.copy2(os.path.join(results_folder, file_name), tmp_entry / file_name)
+        (tmp_entry / ".complete").touch()
+
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # Another worker stored the same key meanwhile
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._write_key_file(results_folder, key, file_names)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least-recently-used entries until the cache fits in 'max_bytes'.
+        """
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            complete_marker = entry / ".complete"
+            if entry.is_dir() and complete_marker.exists():
+                size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+                entries.append((complete_marker.stat().st_mtime, size, entry))
+        total_size = sum(size for _, size, _ in entries)
+        for last_used, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+            print(f"Evicted cache entry {entry.name} (last used {time.ctime(last_used)})")
@@ -3,20 +3,42 @@ import subprocess
 import shutil
 import sys
 import argparse
+import importlib
+import contextlib
+import time
 from pathlib import Path
 from natsort import natsorted  # Import natsorted for natural sorting
 
+# Folder holding sdm_unips/main.py and sdm_unips/relighting.py (imported directly in in-process mode)
+SDM_UNIPS_DIR = Path(__file__).resolve().parent.parent / "sdm_unips"
+sys.path.insert(0, str(SDM_UNIPS_DIR))
+
+import profiling
+from data_manifest import list_data_files
+import dataset_index
+from job_scheduler import run_jobs, print_summary, set_thread_budget
+from pipeline import run_pipeline
+from result_cache import ResultCache, CACHE_KEY_FILE, RESULT_FILES
+from work_claims import ClaimDirectory, STALE_AFTER, parse_shard, shard_jobs, run_claimed
+
 def verify_sdm_in_folder(sdm_in_path):
     """
     Verify if the SDM_in.data folder has at least 10 images with the pattern 'L (x).JPG' or 'L (x).PNG'.
     If more images are present, they will be logged. Raise an error if fewer than 10 are found.
+    Images listed in a manifest (see sdm_unips/data_manifest.py) count as well, if their original file exists.
+    The folder is not listed again if a dataset index loaded by this process covers it (see sdm_unips/dataset_index.py).
     """
     # Generate the expected filenames for the first 10 images
     required_images_jpg = [f"L ({i}).JPG" for i in range(1, 11)]
     required_images_png = [f"L ({i}).PNG" for i in range(1, 11)]
     
     # Collect all images that match the naming pattern 'L (x).JPG' or 'L (x).PNG' in the folder
-    available_images = [f for f in os.listdir(sdm_in_path) if (f.startswith("L (") and (f.endswith(".JPG") or f.endswith(".PNG")))]
+    file_names = dataset_index.cached_files(sdm_in_path)
+    # Files of the folder itself are known to exist when it was just listed; originals of a manifest are checked
+    listed = set(file_names or [])
+    available_images = [f for f, path in list_data_files(sdm_in_path, file_names)
+                        if (f.startswith("L (") and (f.endswith(".JPG") or f.endswith(".PNG")))
+                        and (os.path.dirname(path) == str(sdm_in_path) and f in listed or os.path.exists(path))]
     
     # Check if there are at least 10 images, in either JPG or PNG format
     missing_images = []
@@ -35,30 +57,156 @@ def verify_sdm_in_folder(sdm_in_path):
 
     print(f"Found {len(available_images)} valid images in {sdm_in_path}")
 
-def run_sdm_unips_main(test_dir, session_name, checkpoint_path, max_image_res, max_image_num):
+def sdm_unips_options(max_image_res=4096, max_image_num=10, target="normal_and_brdf", canonical_resolution=256,
+                      pixel_samples=10000, scalable=True, decode_workers=1, decode_cache=None, trace_dir=None,
+                      cpu_precision=None, cpu_threads=None, use_compiled=False, result_bundle=None, decode_cache_size_gb=None):
+    """
+    Options of sdm_unips/main.py shared by all acquisition folders. Those that change the results are also
+    part of the result cache key (see result_cache.CACHE_KEY_OPTIONS).
+    With a 'trace_dir', the time and memory of every stage are written there as Chrome traces (see
+    sdm_unips/profiling.py). With 'result_bundle', the maps are also saved as a float16 bundle (maps.sdmb,
+    see sdm_unips/result_bundle.py).
+    """
+    return {
+        "max_image_res": max_image_res,
+        "max_image_num": max_image_num,
+        "target": target,
+        "canonical_resolution": canonical_resolution,
+        "pixel_samples": pixel_samples,
+        "scalable": scalable,
+        "decode_workers": decode_workers,
+        "decode_cache": decode_cache,
+        "decode_cache_size_gb": decode_cache_size_gb,
+        "trace_dir": trace_dir,
+        "cpu_precision": cpu_precision,
+        "cpu_threads": cpu_threads,
+        "use_compiled": use_compiled,
+        "result_bundle": result_bundle,
+    }
+
+def sdm_unips_main_arguments(test_dir, session_name, checkpoint_path, options, output_dir=None):
+    """
+    Command line arguments of sdm_unips/main.py for one acquisition folder, writing its results to
+    'output_dir' if given (otherwise to the session folder).
+    """
+    arguments = [
+        "--session_name", session_name,
+        "--test_dir", str(test_dir),
+        "--checkpoint", str(checkpoint_path),
+        "--target", options["target"],
+        "--max_image_res", str(options["max_image_res"]),
+        "--max_image_num", str(options["max_image_num"]),
+        "--canonical_resolution", str(options["canonical_resolution"]),
+        "--pixel_samples", str(options["pixel_samples"]),
+    ]
+    if options["scalable"]:
+        arguments.append("--scalable")
+    arguments += ["--decode_workers", str(options["decode_workers"])]
+    if options["decode_cache"]:
+        arguments += ["--decode_cache", str(options["decode_cache"])]
+        if options.get("decode_cache_size_gb"):
+            arguments += ["--decode_cache_size_gb", str(options["decode_cache_size_gb"])]
+    if options.get("use_compiled"):
+        arguments.append("--use_compiled")
+    if options.get("result_bundle"):
+        arguments.append("--result_bundle")
+    if options.get("cpu_precision"):
+        arguments += ["--cpu_precision", options["cpu_precision"]]
+    if options.get("cpu_threads"):
+        arguments += ["--cpu_threads", str(options["cpu_threads"])]
+    if options.get("trace_dir"):
+        arguments += ["--trace", os.path.join(options["trace_dir"], f"{session_name}.main.json")]
+    if output_dir is not None:
+        arguments += ["--output_dir", str(output_dir)]
+    return arguments
+
+def run_sdm_unips_main(test_dir, session_name, checkpoint_path, options, output_dir=None):
     """
     Run the main sdm_unips script using the same Python interpreter that runs this script.
     """
     subprocess.run([
         sys.executable, "sdm_unips/main.py",
-        "--session_name", session_name,
-        "--test_dir", test_dir,
-        "--checkpoint", checkpoint_path,
-        "--max_image_res", str(max_image_res),
-        "--max_image_num", str(max_image_num),
-        "--scalable"
+        *sdm_unips_main_arguments(test_dir, session_name, checkpoint_path, options, output_dir)
     ], stdout=sys.stdout, stderr=sys.stderr, check=True)
 
-def run_sdm_unips_relighting(datadir):
+def run_sdm_unips_relighting(datadir, trace_file=None, output_dir=None):
     """
     Run the relighting script using the same Python interpreter that runs this script.
     """
     subprocess.run([
         sys.executable, "sdm_unips/relighting.py",
         "--datadir", datadir,
-        "--format", "avi"
+        "--format", "avi",
+        *(["--output_dir", output_dir] if output_dir else []),
+        *(["--trace", trace_file] if trace_file else [])
     ], stdout=sys.stdout, stderr=sys.stderr, check=True)
 
+@contextlib.contextmanager
+def traced_job(session_name, trace_dir=None):
+    """
+    Tag the spans recorded by this thread with the session name of the folder and, with a 'trace_dir',
+    write them to '<trace_dir>/<session_name>.json' at the end of the job.
+    """
+    if trace_dir and not profiling.enabled():
+        profiling.enable()  # Worker processes start with profiling disabled
+    try:
+        with profiling.context(session=session_name), profiling.span("folder"):
+            yield
+    finally:
+        if trace_dir:
+            profiling.export(os.path.join(trace_dir, f"{session_name}.json"), session=session_name)
+
+class InProcessRunner:
+    """
+    Runs sdm_unips/main.py and sdm_unips/relighting.py inside this process. The network is built and the
+    checkpoint is loaded once, then the same model is reused for every acquisition folder.
+    """
+
+    def __init__(self, checkpoint_path, options):
+        self.sdm_main = importlib.import_module("main")
+        self.relighting = importlib.import_module("relighting")
+        self.output_writer = importlib.import_module("output_writer")
+
+        self.checkpoint_path = checkpoint_path
+        self.options = options
+
+        # The session name and test directory are replaced for every folder in run_main()
+        args = self.sdm_main.parse_args(sdm_unips_main_arguments(".", "sdm_unips", checkpoint_path, options))
+        if options.get("trace_dir") and not profiling.enabled():
+            profiling.enable()
+        self.sdm_main.setup_decoding(args)
+        self.sdm_main.setup_profiling()
+        self.model = self.sdm_main.build_model(args)
+
+    def session_args(self, test_dir, session_name, options=None, output_dir=None):
+        """
+        Arguments of main.py for one folder. 'options' may change the per-run options (resolutions, number of
+        images, ...) but not those the model is built with (target, checkpoint).
+        """
+        return self.sdm_main.parse_args(sdm_unips_main_arguments(test_dir, session_name, self.checkpoint_path, options or self.options,
+                                                                 output_dir))
+
+    def load_data(self, test_dir, session_name, options=None):
+        """
+        Read and decode the images of 'test_dir' now, for a later run_main(test_data=...).
+        """
+        test_data, _ = self.sdm_main.load_test_data(self.session_args(test_dir, session_name, options), preload=True)
+        return test_data
+
+    def run_main(self, test_dir, session_name, test_data=None, options=None, output_dir=None, wait=True):
+        """
+        Run main.py on 'test_dir'. Returns the output_writer.PendingWrites of its results: unless 'wait', they
+        may still be written in the background on return, and must be awaited with its wait() before they are read.
+        """
+        pending = self.output_writer.PendingWrites()
+        self.sdm_main.run_session(self.model, self.session_args(test_dir, session_name, options, output_dir), test_data, pending)
+        if wait:
+            pending.wait()
+        return pending
+
+    def run_relighting(self, datadir, output_dir=None):
+        self.relighting.relight(datadir, output_format="avi", output_dir=output_dir)
+
 def copy_output_to_sdm_out(results_folder, destination_folder):
     """
     Copy the output from the results folder to the SDM_out folder inside the 'rti' folder.
@@ -76,62 +224,256 @@ def clean_up_repository_output(session_output_folder):
     """
     shutil.rmtree(session_output_folder)
 
-def process_acquisition_folders(input_folder, repository_path, checkpoint_path, max_image_res, max_image_num):
+def find_sdm_in_folder(experiment_path, index=None):
     """
-    Process all acquisition folders and run the necessary scripts.
+    Search recursively for the 'SDM_in.data' folder of an experiment. Returns None if there is none.
+    With an 'index' (a dataset_index.DatasetIndex covering the experiment), the folders are not listed again.
+    """
+    if index is not None:
+        found = index.find_folders("SDM_in.data", under=experiment_path)
+        return found[0] if found else None
+    for root, dirs, files in os.walk(experiment_path):
+        for dir_name in dirs:
+            if dir_name == "SDM_in.data":
+                return os.path.join(root, dir_name)
+    return None
+
+def prepare_sdm_in_folder(sdm_in_path, checkpoint_path, options, cache=None, force=False):
+    """
+    Verify one 'SDM_in.data' folder and look for its results in the cache.
+    Returns the 'SDM_out' path, the cache key (or None) and whether the results were found in the cache.
+    """
+    # Step 2: Verify the presence of the 10 images
+    with profiling.span("verify"):
+        verify_sdm_in_folder(sdm_in_path)
+    print(f"Verified images in {sdm_in_path}")
+
+    test_dir = os.path.dirname(sdm_in_path)  # The parent folder of SDM_in.data
+    sdm_out_path = os.path.join(test_dir, "SDM_out")  # Use the existing rti/SDM_out path directly
+
+    # Step 2.5: Look for the results of identical inputs in the cache
+    cache_key = None
+    if cache is not None:
+        with profiling.span("cache_lookup"):
+            cache_key = cache.key(sdm_in_path, checkpoint_path, options)
+            if not force:
+                if cache.is_restored(cache_key, sdm_out_path):
+                    print(f"Cache hit: {sdm_out_path} is up to date")
+                    return sdm_out_path, cache_key, True
+                cache_entry = cache.lookup(cache_key)
+                if cache_entry is not None:
+                    cache.restore(cache_key, cache_entry, sdm_out_path)
+                    print(f"Cache hit: restored results to {sdm_out_path}")
+                    return sdm_out_path, cache_key, True
+    return sdm_out_path, cache_key, False
+
+def prepare_sdm_out_folder(sdm_out_path):
+    """
+    Make 'SDM_out' ready for sdm_unips/main.py to write into: the cache key and the outputs of an earlier run
+    are removed first, so that an interrupted run never leaves old and new results mixed under the old key
+    (and the relighting never reads an old result bundle instead of the new maps).
+    """
+    os.makedirs(sdm_out_path, exist_ok=True)
+    for file_name in (CACHE_KEY_FILE, *RESULT_FILES):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(sdm_out_path, file_name))
+
+def finish_sdm_in_folder(session_name, repository_path, sdm_out_path, cache=None, cache_key=None, runner=None, trace_dir=None,
+                         in_place=False):
     """
-    # Get a naturally sorted list of folders
-    experiment_folders = natsorted(os.listdir(input_folder))
+    Relight the results of sdm_unips/main.py, move them to 'SDM_out', store them in the cache and clean up.
+    With 'in_place', main.py wrote its results to 'SDM_out' directly (--output_dir) and the video is written
+    there as well: nothing is moved.
+    """
+    # Step 5: Run sdm_unips/relighting.py
+    results_data_dir = sdm_out_path if in_place else os.path.join(repository_path, session_name, "results", "SDM_in.data")
+    with profiling.span("relighting"):
+        if runner is not None:
+            runner.run_relighting(results_data_dir)
+        else:
+            run_sdm_unips_relighting(results_data_dir,
+                                     os.path.join(trace_dir, f"{session_name}.relighting.json") if trace_dir else None)
+    print(f"Completed sdm_unips/relighting.py for {session_name}")
+
+    # Step 6: Move the results to the existing SDM_out folder inside the 'rti' folder
+    if not in_place:
+        with profiling.span("move_results"):
+            copy_output_to_sdm_out(results_data_dir, sdm_out_path)
+        print(f"Moved output to {sdm_out_path}")
+
+    # Step 7: Keep a copy of the results in the cache
+    if cache is not None:
+        with profiling.span("cache_store"):
+            cache.store(cache_key, sdm_out_path)
+        print(f"Stored results in the cache ({cache_key[:12]})")
+
+    # Step 8: Clean up the session output folder (with 'in_place', main.py only leaves it behind if it is not empty)
+    session_output_folder = os.path.join(repository_path, session_name)
+    if os.path.exists(session_output_folder):
+        with profiling.span("clean_up"):
+            clean_up_repository_output(session_output_folder)
+        print(f"Cleaned up {session_output_folder}")
+
+def process_sdm_in_folder(session_name, sdm_in_path, repository_path, checkpoint_path, options, cache=None, force=False, runner=None):
+    """
+    Verify, infer and relight one 'SDM_in.data' folder, writing the results to the 'SDM_out' folder next to it.
+    Uses 'runner' (an InProcessRunner) when given, otherwise starts the sdm_unips scripts as subprocesses.
+    With a 'cache' (a ResultCache), unchanged folders are restored from it unless 'force' is set.
+    """
+    with traced_job(session_name, options.get("trace_dir")):
+        sdm_out_path, cache_key, cached = prepare_sdm_in_folder(sdm_in_path, checkpoint_path, options, cache, force)
+        if cached:
+            return
+
+        # Step 3: Run sdm_unips/main.py, writing the results to SDM_out directly
+        test_dir = os.path.dirname(sdm_in_path)
+        prepare_sdm_out_folder(sdm_out_path)
+        with profiling.span("main"):
+            if runner is not None:
+                runner.run_main(test_dir, session_name, output_dir=sdm_out_path)
+            else:
+                run_sdm_unips_main(test_dir, session_name, checkpoint_path, options, sdm_out_path)
+        print(f"Completed sdm_unips/main.py for {session_name}")
+
+        finish_sdm_in_folder(session_name, repository_path, sdm_out_path, cache, cache_key, runner, options.get("trace_dir"),
+                             in_place=True)
+
+def process_jobs_pipelined(jobs, runner, prefetch_depth=1, prefetch_memory_gb=None, claims=None):
+    """
+    Process the jobs of process_acquisition_folders() with an InProcessRunner in three overlapping stages:
+    a background thread verifies the next folders and decodes their images, this thread runs inference,
+    and another background thread relights the results written to 'SDM_out' and stores them in the cache.
+    The maps of a folder are written to 'SDM_out' by the background writer of main.py (output_writer.py)
+    while the next folder is inferred; the flush thread waits for the writes of that folder only.
+    With 'claims' (a work_claims.ClaimDirectory), a folder is claimed when the prefetch thread reaches it.
+    """
+    # The stages of a folder run in different threads: each one tags its spans with the session name
+    def prefetch(session_name, sdm_in_path, repository_path, checkpoint_path, options, cache, force):
+        with profiling.context(session=session_name), profiling.span("prefetch"):
+            sdm_out_path, cache_key, cached = prepare_sdm_in_folder(sdm_in_path, checkpoint_path, options, cache, force)
+            test_data = None if cached else runner.load_data(os.path.dirname(sdm_in_path), session_name)
+        return sdm_out_path, cache_key, cached, test_data
+
+    def infer(session_name, sdm_in_path, repository_path, checkpoint_path, options, cache, force, prefetched):
+        sdm_out_path, cache_key, cached, test_data = prefetched
+        if not cached:
+            with profiling.context(session=session_name), profiling.span("main"):
+                prepare_sdm_out_folder(sdm_out_path)
+                writes = runner.run_main(os.path.dirname(sdm_in_path), session_name, test_data, output_dir=sdm_out_path, wait=False)
+            print(f"Completed sdm_unips/main.py for {session_name}")
+            return sdm_out_path, cache_key, cached, writes
+        return sdm_out_path, cache_key, cached, None
+
+    def flush(session_name, sdm_in_path, repository_path, checkpoint_path, options, cache, force, inferred):
+        sdm_out_path, cache_key, cached, writes = inferred
+        if not cached:
+            with profiling.context(session=session_name), profiling.span("flush"):
+                # A failed write of the maps of this folder fails this folder
+                writes.wait()
+                finish_sdm_in_folder(session_name, repository_path, sdm_out_path, cache, cache_key, runner, in_place=True)
+        if options.get("trace_dir"):
+            profiling.export(os.path.join(options["trace_dir"], f"{session_name}.json"), session=session_name)
+
+    def item_bytes(prefetched):
+        test_data = prefetched[3]
+        return test_data.nbytes if test_data is not None else 0
+
+    def finish_claim(result):
+        claims.finish(result.name, result.elapsed, result.error)
+
+    max_bytes = int(prefetch_memory_gb * 1024**3) if prefetch_memory_gb else None
+    if claims is None:
+        return run_pipeline(jobs, prefetch, infer, flush, depth=prefetch_depth, max_bytes=max_bytes, item_bytes=item_bytes)
+    return run_pipeline(claims.iter_claimed(jobs), prefetch, infer, flush, depth=prefetch_depth, max_bytes=max_bytes,
+                        item_bytes=item_bytes, on_result=finish_claim)
 
+def list_acquisition_folders(input_folder, index_path=None):
+    """
+    (experiment folder name, 'SDM_in.data' path) of the acquisition folders of 'input_folder', in natural order,
+    from one scan of its dataset index (see sdm_unips/dataset_index.py).
+    """
+    # Get a naturally sorted list of folders, from one scan of the whole input folder
+    index = dataset_index.load(input_folder, index_path)
+    experiment_folders = natsorted(index.subfolders(input_folder))
+
+    folders = []
     for experiment_folder in experiment_folders:
         experiment_path = os.path.join(input_folder, experiment_folder)
-        if os.path.isdir(experiment_path):
-            # Find the SDM_in.data folder
-            sdm_in_path = None
-            for root, dirs, files in os.walk(experiment_path):
-                for dir_name in dirs:
-                    if dir_name == "SDM_in.data":
-                        sdm_in_path = os.path.join(root, dir_name)
-                        break
-                if sdm_in_path:
-                    break
-
-            if not sdm_in_path:
-                print(f"No 'SDM_in.data' folder found in {experiment_path}, skipping...")
-                continue
-
-            try:
-                # Step 2: Verify the presence of the 10 images
-                verify_sdm_in_folder(sdm_in_path)
-                print(f"Verified images in {sdm_in_path}")
-
-                # Step 3: Run sdm_unips/main.py
-                session_name = experiment_folder
-                test_dir = os.path.dirname(sdm_in_path)  # The parent folder of SDM_in.data
-                run_sdm_unips_main(test_dir, session_name, checkpoint_path, max_image_res, max_image_num)
-                print(f"Completed sdm_unips/main.py for {session_name}")
-
-                # Step 5: Run sdm_unips/relighting.py
-                results_data_dir = os.path.join(repository_path, session_name, "results", "SDM_in.data")
-                run_sdm_unips_relighting(results_data_dir)
-                print(f"Completed sdm_unips/relighting.py for {session_name}")
-
-                # Step 6: Move the results to the existing SDM_out folder inside the 'rti' folder
-                rti_folder = os.path.join(test_dir)
-                sdm_out_path = os.path.join(rti_folder, "SDM_out")  # Use the existing rti/SDM_out path directly
-
-                copy_output_to_sdm_out(results_data_dir, sdm_out_path)
-                print(f"Moved output to {sdm_out_path}")
-
-                # Step 8: Clean up the session output folder
-                session_output_folder = os.path.join(repository_path, session_name)
-                clean_up_repository_output(session_output_folder)
-                print(f"Cleaned up {session_output_folder}")
-
-            except Exception as e:
-                print(f"Error processing {experiment_path}: {e}")
-
-def main(input_folder, max_image_res, max_image_num):
+        # Find the SDM_in.data folder
+        sdm_in_path = find_sdm_in_folder(experiment_path, index)
+
+        if not sdm_in_path:
+            print(f"No 'SDM_in.data' folder found in {experiment_path}, skipping...")
+            continue
+        folders.append((experiment_folder, sdm_in_path))
+    return folders
+
+def process_acquisition_folders(input_folder, repository_path, checkpoint_path, options, in_process=False,
+                                workers=1, threads_per_worker=None, queue_size=None, cache=None, force=False,
+                                prefetch_depth=0, prefetch_memory_gb=None, index_path=None, shard=None, claims=None):
+    """
+    Process all acquisition folders and run the necessary scripts.
+    With 'in_process', the model is loaded once per worker and kept resident for all its folders.
+    With 'workers' > 1, folders are processed in parallel by a pool of worker processes.
+    With a 'cache', folders whose inputs, checkpoint and options did not change are not recomputed.
+    With 'prefetch_depth' > 0 (in-process, single worker), loading, inference and writing of consecutive
+    folders overlap (see process_jobs_pipelined()).
+    The folders are found with the dataset index of the input folder (see sdm_unips/dataset_index.py), kept in
+    'index_path' (default: input_folder/.sdm_index.json), so that only the folders changed since the last run
+    are listed.
+    With a 'shard' (index, count), only the folders of that shard are processed (see cheminova/work_claims.py).
+    With 'claims' (a work_claims.ClaimDirectory on a filesystem shared by several runs of this script), every
+    folder is claimed before it is processed, so that independent processes never process the same folder;
+    a shard is then only processed first, before the unclaimed folders of the other shards.
+    """
+    start_time = time.time()
+    trace_dir = options.get("trace_dir")
+    if trace_dir:
+        profiling.enable()
+
+    jobs = [(experiment_folder, (experiment_folder, sdm_in_path, repository_path, checkpoint_path, options, cache, force))
+            for experiment_folder, sdm_in_path in list_acquisition_folders(input_folder, index_path)]
+    if shard is not None:
+        shard_names = {name for name, _ in shard_jobs(jobs, shard)}
+        print(f"Shard {shard[0]}/{shard[1]}: {len(shard_names)} of {len(jobs)} folders")
+        if claims is None:
+            jobs = [job for job in jobs if job[0] in shard_names]
+        else:
+            # Own shard first, then help with the folders of the other shards that are not claimed yet
+            jobs = [job for job in jobs if job[0] in shard_names] + [job for job in jobs if job[0] not in shard_names]
+
+    if prefetch_depth > 0:
+        if threads_per_worker is not None:
+            set_thread_budget(threads_per_worker)
+        runner = InProcessRunner(checkpoint_path, options)
+
+    def run(jobs):
+        if prefetch_depth > 0:
+            return process_jobs_pipelined(jobs, runner, prefetch_depth, prefetch_memory_gb, claims)
+        job_function = process_sdm_in_folder
+        if claims is not None:
+            # The folders are claimed by the worker processes, when they start them
+            jobs = [(name, (claims, process_sdm_in_folder, name, *job_args)) for name, job_args in jobs]
+            job_function = run_claimed
+        initializer = InProcessRunner if in_process else None
+        return run_jobs(jobs, job_function, num_workers=workers, threads_per_worker=threads_per_worker,
+                        queue_size=queue_size, initializer=initializer,
+                        initargs=(checkpoint_path, options))
+
+    results = run(jobs)
+    if claims is not None:
+        results += claims.take_over_stale(jobs, run)
+    print_summary(results, total_time=time.time() - start_time)
+    if claims is not None:
+        print(claims.progress_line([name for name, _ in jobs]))
+
+    if trace_dir:
+        # Stages run by this process (the worker processes only write the traces of their folders)
+        profiling.export(os.path.join(trace_dir, "multifolder.json"))
+        profiling.print_summary()
+    return results
+
+def main(args):
     """
     Main function to handle argument parsing and trigger the processing.
     """
@@ -145,7 +487,29 @@ def main(input_folder, max_image_res, max_image_num):
     # Checkpoint path is always inside the repository in the 'checkpoint' folder
     checkpoint_path = repository_path / "checkpoint"
 
-    process_acquisition_folders(input_folder, str(repository_path), str(checkpoint_path), max_image_res, max_image_num)
+    options = sdm_unips_options(max_image_res=args.max_image_res, max_image_num=args.max_image_num, target=args.target,
+                                canonical_resolution=args.canonical_resolution, pixel_samples=args.pixel_samples,
+                                scalable=args.scalable, decode_workers=args.decode_workers, decode_cache=args.decode_cache,
+                                trace_dir=str(Path(args.trace_dir).resolve()) if args.trace_dir else None,
+                                cpu_precision=args.cpu_precision, cpu_threads=args.cpu_threads, use_compiled=args.use_compiled,
+                                result_bundle=args.result_bundle, decode_cache_size_gb=args.decode_cache_size_gb)
+
+    shard = parse_shard(args.shard) if args.shard else None
+    claims = ClaimDirectory(args.claim_dir, args.claim_timeout) if args.claim_dir else None
+    if args.progress:
+        # Report the state of the folders of the input folder in the claim folder, without processing anything
+        claims.print_progress([name for name, _ in list_acquisition_folders(input_folder, args.index_path)])
+        return
+
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, int(args.cache_size_gb * 1024**3))
+
+    process_acquisition_folders(input_folder, str(repository_path), str(checkpoint_path), options,
+                                in_process=args.in_process, workers=args.workers, threads_per_worker=args.threads_per_worker,
+                                queue_size=args.queue_size, cache=cache, force=args.force,
+                                prefetch_depth=args.prefetch_depth, prefetch_memory_gb=args.prefetch_memory_gb,
+                                index_path=args.index_path, shard=shard, claims=claims)
 
 if __name__ == "__main__":
     print('================================================================')
@@ -155,8 +519,43 @@ if __name__ == "__main__":
     parser.add_argument("--input_folder", type=str, help="Path to the input folder containing acquisition data.")
     parser.add_argument('--max_image_res', type=int, default=4096)
     parser.add_argument('--max_image_num', type=int, default=10)
+    parser.add_argument('--target', default='normal_and_brdf', choices=['normal', 'brdf', 'normal_and_brdf'])
+    parser.add_argument('--canonical_resolution', type=int, default=256)
+    parser.add_argument('--pixel_samples', type=int, default=10000)
+    parser.add_argument('--no_scalable', dest='scalable', action='store_false', help="Run sdm_unips/main.py without --scalable.")
+    parser.add_argument('--decode_workers', type=int, default=1, help="Threads decoding the images of a folder in parallel.")
+    parser.add_argument('--decode_cache', type=str, default=None, help="Folder of an on-disk cache of decoded images, reused when the same captures are processed again.")
+    parser.add_argument('--decode_cache_size_gb', type=float, default=None, help="Size limit of --decode_cache (default: that of sdm_unips/main.py); least recently used images are evicted first.")
+    parser.add_argument('--in_process', action='store_true', help="Load the model once and run inference and relighting for all folders in this process.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of folders processed in parallel by separate worker processes.")
+    parser.add_argument('--threads_per_worker', type=int, default=None, help="torch/OpenMP threads per worker (default: cores / workers).")
+    parser.add_argument('--queue_size', type=int, default=None, help="Maximum number of folders handed to the worker pool at once (default: 2 * workers).")
+    parser.add_argument('--cache_dir', type=str, default=None, help="Folder of the persistent result cache. Unchanged folders are restored from it instead of recomputed.")
+    parser.add_argument('--cache_size_gb', type=float, default=20.0, help="Size limit of the result cache; least recently used entries are evicted first.")
+    parser.add_argument('--force', action='store_true', help="Recompute every folder even if its results are in the cache.")
+    parser.add_argument('--prefetch_depth', type=int, default=0, help="Number of folders decoded ahead of inference while the previous results are written (implies --in_process, single worker).")
+    parser.add_argument('--prefetch_memory_gb', type=float, default=None, help="Maximum memory of the decoded folders waiting for inference.")
+    parser.add_argument('--use_compiled', action='store_true', help="Load the precompiled model artifact (python sdm_unips/main.py --export_model) instead of building the model for every folder.")
+    parser.add_argument('--cpu_precision', default=None, choices=['fp32', 'int8', 'bf16'], help="Run sdm_unips/main.py in the optimized CPU inference mode with this precision.")
+    parser.add_argument('--cpu_threads', type=int, default=None, help="torch threads of the CPU inference mode (default: the thread budget of the worker).")
+    parser.add_argument('--index_path', type=str, default=None, help="Dataset index file of the input folder (default: INPUT_FOLDER/.sdm_index.json); only the folders changed since the last run are listed.")
+    parser.add_argument('--result_bundle', action='store_true', default=None, help="Also save the maps at float16 precision in SDM_out/maps.sdmb (used by the relighting instead of the PNGs).")
+    parser.add_argument('--shard', type=str, default=None, help="Only process the folders of shard i of N (given as i/N, 0 <= i < N), e.g. one shard per cluster node. With --claim_dir, the shard is processed first, then the unclaimed folders of the other shards.")
+    parser.add_argument('--claim_dir', type=str, default=None, help="Folder on a filesystem shared by several runs of this script: every folder is claimed there before it is processed, so that any number of runs split the work.")
+    parser.add_argument('--claim_timeout', type=float, default=STALE_AFTER, help="Seconds without heartbeat after which the claim of a crashed run is taken over.")
+    parser.add_argument('--progress', action='store_true', help="Print the state of the folders in --claim_dir (done, failed, running, stale, pending) and exit.")
+    parser.add_argument('--trace_dir', type=str, default=None, help="Write the time and memory of every stage of every folder to Chrome trace files in this folder.")
 
     args = parser.parse_args()
+    if args.prefetch_depth > 0 and args.workers > 1:
+        parser.error("--prefetch_depth runs a single in-process pipeline and cannot be combined with --workers")
+    if args.shard:
+        try:
+            parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.progress and not args.claim_dir:
+        parser.error("--progress reports the state of --claim_dir")
 
     """""""""
     SHOW PARAMETERES CHOOSEN FOR THIS EXPERIMENT
@@ -166,6 +565,6 @@ if __name__ == "__main__":
     print('================================================================')
     print('================================================================') 
 
-    main(args.input_folder, args.max_image_res, args.max_image_num)
+    main(args)
 
     # python "cheminova/run_sdm_multifolder.py" --input_folder "C:/Users/Deivid/Documents/DiLiGenT-MV/DiLiGenT-MV/mvpmsData/bearPNG" --max_image_res 4096 --max_image_num 10
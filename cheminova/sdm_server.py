@@ -0,0 +1,437 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import threading
+import traceback
+import http.client
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+
+from run_sdm_multifolder import (InProcessRunner, sdm_unips_options, find_sdm_in_folder, prepare_sdm_in_folder,
+                                 finish_sdm_in_folder)
+from data_manifest import list_data_files, place_file, MANIFEST_NAME
+from result_cache import ResultCache
+
+# Options a job may set; the others (decoding, tracing, CPU mode) are those of the server
+JOB_OPTIONS = ["target", "max_image_res", "max_image_num", "canonical_resolution", "pixel_samples", "scalable"]
+
+def check_job_options(options):
+    """
+    Raise ValueError if a job sets an option it may not set or a value of the wrong type.
+    """
+    unknown = set(options) - set(JOB_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown options: {', '.join(sorted(unknown))} (allowed: {', '.join(JOB_OPTIONS)})")
+    for name, value in options.items():
+        if name == "target":
+            valid = value in ('normal', 'brdf', 'normal_and_brdf')
+        elif name == "scalable":
+            valid = isinstance(value, bool)
+        else:
+            valid = isinstance(value, int) and not isinstance(value, bool) and value > 0
+        if not valid:
+            raise ValueError(f"Invalid value for {name}: {value!r}")
+
+class Job:
+    """
+    One 'SDM_in.data' folder submitted to the server, and its progress.
+    """
+
+    def __init__(self, job_id, sdm_in_path, options, force=False):
+        self.id = job_id
+        self.sdm_in_path = sdm_in_path
+        self.options = options
+        self.force = force
+        self.status = "queued"  # queued, running, done, cached or failed
+        self.error = None
+        self.sdm_out_path = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def batch_key(self):
+        """
+        Jobs with the same options can be run together in one call of the model.
+        """
+        return json.dumps({name: self.options[name] for name in JOB_OPTIONS}, sort_keys=True), self.force
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "sdm_in": self.sdm_in_path,
+            "sdm_out": self.sdm_out_path,
+            "status": self.status,
+            "error": self.error,
+            "options": {name: self.options[name] for name in JOB_OPTIONS},
+            "submitted": self.submitted,
+            "queue_time": (self.started or time.time()) - self.submitted,
+            "run_time": None if self.started is None else (self.finished or time.time()) - self.started,
+        }
+
+class InferenceServer:
+    """
+    Keeps one InProcessRunner (model and checkpoint) per target resident and processes the submitted jobs in
+    order in a worker thread, as run_sdm_multifolder.py does for every folder. Up to 'batch_size' queued jobs
+    with the same options are run by the model together; the worker waits at most 'batch_wait' seconds for
+    a batch to fill up.
+    """
+
+    def __init__(self, repository_path, checkpoint_path, options, cache=None, batch_size=1, batch_wait=0.0):
+        self.repository_path = repository_path
+        self.checkpoint_path = checkpoint_path
+        self.options = options
+        self.cache = cache
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.runners = {}
+        self.jobs = {}
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.next_id = 1
+        self.start_time = time.time()
+        self.batches = 0
+        self.stopping = False
+        self.worker = threading.Thread(target=self._work, name="inference", daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.worker.join()
+
+    def submit(self, sdm_in, options=None, force=False):
+        """
+        Queue the 'SDM_in.data' folder 'sdm_in' (or the first one found below it). Raises ValueError for
+        an invalid request.
+        """
+        sdm_in = os.path.abspath(sdm_in)
+        sdm_in_path = sdm_in if os.path.basename(sdm_in) == "SDM_in.data" else find_sdm_in_folder(sdm_in)
+        if sdm_in_path is None or not os.path.isdir(sdm_in_path):
+            raise ValueError(f"No 'SDM_in.data' folder found at {sdm_in}")
+        check_job_options(options or {})
+
+        with self.condition:
+            job = Job(self.next_id, sdm_in_path, {**self.options, **(options or {})}, force)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.condition.notify_all()
+        print(f"[job {job.id}] queued {sdm_in_path}")
+        return job
+
+    def _next_batch(self):
+        """
+        Wait for a job, then collect the queued jobs that can run with it (None when the server stops).
+        """
+        with self.condition:
+            while not self.queue and not self.stopping:
+                self.condition.wait()
+            if self.stopping:
+                return None
+            first = self.queue.popleft()
+            batch = [first]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                for job in list(self.queue):
+                    if len(batch) < self.batch_size and job.batch_key() == first.batch_key():
+                        self.queue.remove(job)
+                        batch.append(job)
+                remaining = deadline - time.time()
+                if len(batch) >= self.batch_size or remaining <= 0 or self.stopping:
+                    break
+                self.condition.wait(remaining)
+            for job in batch:
+                job.status = "running"
+                job.started = time.time()
+            return batch
+
+    def load_runner(self, target):
+        """
+        The InProcessRunner of 'target', loaded on first use.
+        """
+        if target not in self.runners:
+            print(f"Loading the model for target {target}")
+            self.runners[target] = InProcessRunner(self.checkpoint_path, {**self.options, "target": target})
+        return self.runners[target]
+
+    def _finish(self, job, status, error=None):
+        with self.condition:
+            job.status = status
+            job.error = error
+            job.finished = time.time()
+        print(f"[job {job.id}] {status} in {job.finished - job.started:.1f} sec" + (f": {error}" if error else ""))
+        sys.stdout.flush()
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.batches += 1
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                traceback.print_exc()
+                for job in batch:
+                    if job.status == "running":
+                        self._finish(job, "failed", f"{type(e).__name__}: {e}")
+
+    def _process_batch(self, batch):
+        """
+        Verify every job and look it up in the cache, run the model once on the remaining ones, then relight
+        and move the results of every job to its 'SDM_out' folder.
+        """
+        pending = []
+        for job in batch:
+            try:
+                sdm_out_path, cache_key, cached = prepare_sdm_in_folder(job.sdm_in_path, self.checkpoint_path,
+                                                                        job.options, self.cache, job.force)
+                job.sdm_out_path = sdm_out_path
+                if cached:
+                    self._finish(job, "cached")
+                else:
+                    pending.append((job, cache_key))
+            except Exception as e:
+                self._finish(job, "failed", f"{type(e).__name__}: {e}")
+        if not pending:
+            return
+
+        options = pending[0][0].options
+        runner = self.load_runner(options["target"])
+        if len(pending) == 1:
+            job, cache_key = pending[0]
+            session_name = f"sdm_server_job{job.id}"
+            runner.run_main(os.path.dirname(job.sdm_in_path), session_name, options=options)
+        else:
+            session_name = self._run_batch(runner, [job for job, _ in pending], options)
+
+        for job, cache_key in pending:
+            try:
+                job_session = session_name
+                if len(pending) > 1:
+                    # Give every job the layout of a single-folder session for finish_sdm_in_folder()
+                    job_session = f"sdm_server_job{job.id}"
+                    results = os.path.join(self.repository_path, job_session, "results")
+                    os.makedirs(results, exist_ok=True)
+                    shutil.move(os.path.join(self.repository_path, session_name, "results", f"job{job.id}.data"),
+                                os.path.join(results, "SDM_in.data"))
+                finish_sdm_in_folder(job_session, self.repository_path, job.sdm_out_path, self.cache, cache_key, runner)
+                self._finish(job, "done")
+            except Exception as e:
+                traceback.print_exc()
+                self._finish(job, "failed", f"{type(e).__name__}: {e}")
+        if len(pending) > 1:
+            shutil.rmtree(os.path.join(self.repository_path, session_name), ignore_errors=True)
+
+    def _run_batch(self, runner, jobs, options):
+        """
+        Run the model once on a test directory holding the 'SDM_in.data' folder of every job (as links to its
+        files) named 'job<id>.data'. Returns the session name.
+        """
+        session_name = f"sdm_server_batch{jobs[0].id}"
+        test_dir = os.path.join(self.repository_path, f"{session_name}_inputs")
+        try:
+            for job in jobs:
+                data_folder = os.path.join(test_dir, f"job{job.id}.data")
+                os.makedirs(data_folder)
+                for name, path in list_data_files(job.sdm_in_path):
+                    if name != MANIFEST_NAME:
+                        place_file(path, os.path.join(data_folder, name), mode='symlink')
+            print(f"Running a batch of {len(jobs)} jobs: {', '.join(str(job.id) for job in jobs)}")
+            runner.run_main(test_dir, session_name, options=options)
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+        return session_name
+
+    def job(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return None if job is None else job.to_dict()
+
+    def job_list(self):
+        with self.condition:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def metrics(self):
+        """
+        Job counts, throughput and mean times since the server started.
+        """
+        with self.condition:
+            jobs = list(self.jobs.values())
+            queued = len(self.queue)
+        uptime = time.time() - self.start_time
+        finished = [job for job in jobs if job.finished is not None]
+        completed = [job for job in finished if job.status in ("done", "cached")]
+        counts = {status: sum(job.status == status for job in jobs) for status in ("queued", "running", "done", "cached", "failed")}
+        mean = lambda values: sum(values) / len(values) if values else None
+        return {
+            "uptime": uptime,
+            "jobs": len(jobs),
+            "queue_length": queued,
+            "status": counts,
+            "models_loaded": sorted(self.runners),
+            "batches": self.batches,
+            "mean_batch_size": len([job for job in jobs if job.started is not None]) / self.batches if self.batches else None,
+            "throughput_per_minute": 60 * len(completed) / uptime if uptime > 0 else 0,
+            "mean_queue_time": mean([job.started - job.submitted for job in finished]),
+            "mean_run_time": mean([job.finished - job.started for job in finished]),
+        }
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the server:
+
+    - POST /jobs {"sdm_in": path, "options": {...}, "force": false} queues a job and returns it,
+    - GET /jobs lists the jobs, GET /jobs/<id> returns one job,
+    - GET /metrics returns the job counts and throughput.
+    """
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload, indent=2).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip("/")
+        if path == "/metrics":
+            self._reply(200, self.server.inference.metrics())
+        elif path == "/jobs":
+            self._reply(200, self.server.inference.job_list())
+        elif path.startswith("/jobs/") and path[len("/jobs/"):].isdigit():
+            job = self.server.inference.job(int(path[len("/jobs/"):]))
+            self._reply(200, job) if job is not None else self._reply(404, {"error": "unknown job"})
+        else:
+            self._reply(404, {"error": f"unknown path {path}"})
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.server.inference.submit(request["sdm_in"], request.get("options"), request.get("force", False))
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._reply(202, job.to_dict())
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else "local"
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection over a Unix socket.
+    """
+
+    def __init__(self, socket_path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def request(server, method, path, payload=None):
+    """
+    Send a request to the server at 'server' (http://host:port or the path of a Unix socket) and return
+    the HTTP status and the decoded JSON reply.
+    """
+    if server.startswith("http://"):
+        address = urlparse(server)
+        connection = http.client.HTTPConnection(address.hostname, address.port or 80, timeout=60)
+    else:
+        connection = UnixHTTPConnection(server)
+    try:
+        body = None if payload is None else json.dumps(payload)
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b"null")
+    finally:
+        connection.close()
+
+def main(args):
+    repository_path = Path.cwd()
+    checkpoint_path = repository_path / "checkpoint"
+    options = sdm_unips_options(max_image_res=args.max_image_res, max_image_num=args.max_image_num, target=args.target,
+                                canonical_resolution=args.canonical_resolution, pixel_samples=args.pixel_samples,
+                                scalable=args.scalable, decode_workers=args.decode_workers, decode_cache=args.decode_cache,
+                                cpu_precision=args.cpu_precision, cpu_threads=args.cpu_threads, use_compiled=args.use_compiled,
+                                result_bundle=args.result_bundle, decode_cache_size_gb=args.decode_cache_size_gb)
+    cache = ResultCache(args.cache_dir, int(args.cache_size_gb * 1024**3)) if args.cache_dir else None
+
+    inference = InferenceServer(str(repository_path), str(checkpoint_path), options, cache,
+                                batch_size=args.batch_size, batch_wait=args.batch_wait)
+    # Load the default model before accepting jobs
+    inference.load_runner(options["target"])
+    inference.start()
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        print(f"Listening on {args.socket}")
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), RequestHandler)
+        print(f"Listening on http://127.0.0.1:{args.port}")
+    server.inference = inference
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+        inference.stop()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+if __name__ == "__main__":
+    print('================================================================')
+    print('                        Running sdm_server.py                    ')
+    print('================================================================')
+    parser = argparse.ArgumentParser(description="Inference server keeping the SDM-UniPS model resident.")
+    parser.add_argument('--port', type=int, default=8765, help="Port of the HTTP API on localhost.")
+    parser.add_argument('--socket', type=str, default=None, help="Serve the API on this Unix socket instead of a port.")
+    parser.add_argument('--batch_size', type=int, default=1, help="Maximum number of queued folders with the same options run together.")
+    parser.add_argument('--batch_wait', type=float, default=0.0, help="Seconds to wait for a batch to fill up.")
+    parser.add_argument('--max_image_res', type=int, default=4096)
+    parser.add_argument('--max_image_num', type=int, default=10)
+    parser.add_argument('--target', default='normal_and_brdf', choices=['normal', 'brdf', 'normal_and_brdf'])
+    parser.add_argument('--canonical_resolution', type=int, default=256)
+    parser.add_argument('--pixel_samples', type=int, default=10000)
+    parser.add_argument('--no_scalable', dest='scalable', action='store_false', help="Run the model without --scalable.")
+    parser.add_argument('--decode_workers', type=int, default=1, help="Threads decoding the images of a folder in parallel.")
+    parser.add_argument('--decode_cache', type=str, default=None, help="Folder of an on-disk cache of decoded images.")
+    parser.add_argument('--decode_cache_size_gb', type=float, default=None, help="Size limit of --decode_cache.")
+    parser.add_argument('--cpu_precision', default=None, choices=['fp32', 'int8', 'bf16'], help="Run the model in the optimized CPU inference mode with this precision.")
+    parser.add_argument('--cpu_threads', type=int, default=None, help="torch threads of the CPU inference mode (default: the torch setting of the process).")
+    parser.add_argument('--use_compiled', action='store_true', help="Load the precompiled model artifact instead of building the model.")
+    parser.add_argument('--result_bundle', action='store_true', default=None, help="Also save the maps at float16 precision in SDM_out/maps.sdmb.")
+    parser.add_argument('--cache_dir', type=str, default=None, help="Folder of the persistent result cache.")
+    parser.add_argument('--cache_size_gb', type=float, default=20.0, help="Size limit of the result cache.")
+
+    args = parser.parse_args()
+    for arg in vars(args):
+        print(f'{arg} : {getattr(args, arg)}')
+    print('================================================================')
+
+    main(args)
+
+    # python cheminova/sdm_server.py --port 8765 --batch_size 4 --batch_wait 2
@@ -0,0 +1,135 @@
+import os
+import time
+import argparse
+from pathlib import Path
+
+from sdm_server import request
+
+def folder_signature(sdm_in_path):
+    """
+    Number, total size and latest modification time of the files of a folder (None if it cannot be read).
+    """
+    try:
+        entries = [entry.stat() for entry in os.scandir(sdm_in_path) if entry.is_file()]
+    except OSError:
+        return None
+    return len(entries), sum(stat.st_size for stat in entries), max((stat.st_mtime_ns for stat in entries), default=0)
+
+def find_sdm_in_folders(input_folder):
+    """
+    All the 'SDM_in.data' folders below 'input_folder'.
+    """
+    found = []
+    for root, dirs, files in os.walk(input_folder):
+        if "SDM_in.data" in dirs:
+            found.append(os.path.join(root, "SDM_in.data"))
+            dirs.remove("SDM_in.data")
+    return sorted(found)
+
+class FolderWatcher:
+    """
+    Polls 'input_folder' for new or modified 'SDM_in.data' folders. A folder is reported once its files have
+    not changed for 'settle_time' seconds (so that a capture still being copied is not submitted), and again
+    only if its files change later.
+    """
+
+    def __init__(self, input_folder, settle_time=10.0, skip_existing=False):
+        self.input_folder = input_folder
+        self.settle_time = settle_time
+        self.seen = {}       # path -> (signature, time the signature was first seen)
+        self.submitted = {}  # path -> signature submitted
+        if skip_existing:
+            for path in find_sdm_in_folders(input_folder):
+                self.submitted[path] = folder_signature(path)
+
+    def waiting(self):
+        """
+        Whether some folders were seen but not submitted yet (e.g. not settled).
+        """
+        return any(self.submitted.get(path) != signature for path, (signature, _) in self.seen.items())
+
+    def poll(self):
+        """
+        The folders ready to be submitted.
+        """
+        ready = []
+        now = time.time()
+        for path in find_sdm_in_folders(self.input_folder):
+            signature = folder_signature(path)
+            if signature is None or signature[0] == 0 or self.submitted.get(path) == signature:
+                continue
+            previous = self.seen.get(path)
+            if previous is None or previous[0] != signature:
+                self.seen[path] = (signature, now)
+            elif now - previous[1] >= self.settle_time:
+                ready.append(path)
+                self.submitted[path] = signature
+        return ready
+
+def main(args):
+    if args.status:
+        status, reply = request(args.server, "GET", "/metrics")
+        for name, value in reply.items():
+            print(f"{name} : {value}")
+        return
+
+    options = {name: getattr(args, name) for name in ("target", "max_image_res", "max_image_num", "canonical_resolution", "pixel_samples")
+               if getattr(args, name) is not None}
+    watcher = FolderWatcher(str(Path(args.input_folder).resolve()), settle_time=args.settle_time, skip_existing=args.skip_existing)
+    jobs = {}
+    print(f"Watching {watcher.input_folder} (every {args.interval} sec)")
+    try:
+        while True:
+            for path in watcher.poll():
+                try:
+                    status, reply = request(args.server, "POST", "/jobs", {"sdm_in": path, "options": options, "force": args.force})
+                except OSError as e:
+                    print(f"Cannot reach the server at {args.server}: {e}")
+                    del watcher.submitted[path]  # Try again at the next poll
+                    continue
+                if status == 202:
+                    jobs[reply["id"]] = path
+                    print(f"Submitted {path} as job {reply['id']}")
+                else:
+                    print(f"Rejected {path}: {reply.get('error')}")
+
+            # Report the jobs that finished since the last poll
+            for job_id in list(jobs):
+                try:
+                    status, reply = request(args.server, "GET", f"/jobs/{job_id}")
+                except OSError:
+                    break
+                if status == 200 and reply["status"] in ("done", "cached", "failed"):
+                    print(f"Job {job_id} {reply['status']}: {jobs.pop(job_id)}" + (f" ({reply['error']})" if reply["error"] else ""))
+
+            if args.once and not jobs and not watcher.waiting():
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("Stopping")
+
+if __name__ == "__main__":
+    print('================================================================')
+    print('                        Running sdm_watch.py                     ')
+    print('================================================================')
+    parser = argparse.ArgumentParser(description="Submit new SDM_in.data folders to a running sdm_server.py.")
+    parser.add_argument("--input_folder", type=str, help="Folder watched for new 'SDM_in.data' folders (recursively).")
+    parser.add_argument("--server", type=str, default="http://127.0.0.1:8765", help="URL of the server, or the path of its Unix socket.")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between two scans of the input folder.")
+    parser.add_argument("--settle_time", type=float, default=10.0, help="Seconds a folder must stay unchanged before it is submitted.")
+    parser.add_argument("--skip_existing", action="store_true", help="Only submit the folders created or modified after the start.")
+    parser.add_argument("--once", action="store_true", help="Submit the folders found, wait for their jobs and exit.")
+    parser.add_argument("--force", action="store_true", help="Recompute the folders even if their results are in the server's cache.")
+    parser.add_argument("--status", action="store_true", help="Print the metrics of the server and exit.")
+    parser.add_argument('--target', default=None, choices=['normal', 'brdf', 'normal_and_brdf'], help="Options of the jobs (default: those of the server).")
+    parser.add_argument('--max_image_res', type=int, default=None)
+    parser.add_argument('--max_image_num', type=int, default=None)
+    parser.add_argument('--canonical_resolution', type=int, default=None)
+    parser.add_argument('--pixel_samples', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.input_folder is None and not args.status:
+        parser.error("--input_folder is required")
+    main(args)
+
+    # python cheminova/sdm_watch.py --input_folder "/path/to/acquisitions" --server http://127.0.0.1:8765
@@ -0,0 +1,306 @@
+"""
+Sharing the acquisition folders of one input folder between independent run_sdm_multifolder.py processes
+(several cluster nodes, or several processes on one machine) through files on the shared filesystem.
+
+- Sharding: with --shard i/N, a process only considers the folders whose name hashes to shard i (0 <= i < N).
+  The hash only depends on the folder name, so every node computes the same partition whatever it lists.
+- Claims: before processing a folder, a process creates '<claim_dir>/<folder>.claim' with O_CREAT | O_EXCL,
+  which succeeds for exactly one process. The claim holds the host, pid and a random token, and its
+  modification time is refreshed by a heartbeat thread while the folder is processed.
+- Outcome: when the folder is finished, '<folder>.done' (or '<folder>.failed', with the error) is written and
+  the claim is removed. Finished folders are skipped by every later claim in the same claim folder, so a
+  cancelled run resumes where it stopped; use a new claim folder (or delete it) to process everything again,
+  or delete the '.failed' files to retry the failed folders.
+- Stale claims: a claim whose heartbeat is older than 'stale_after' seconds belongs to a crashed worker. It is
+  renamed away (an atomic rename, so only one process recovers it) and claimed again.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+
+from job_scheduler import SKIPPED
+
+CLAIM_SUFFIX = ".claim"
+DONE_SUFFIX = ".done"
+FAILED_SUFFIX = ".failed"
+# Seconds without heartbeat after which a claim is considered abandoned; the heartbeat runs 4 times as often
+STALE_AFTER = 600
+
+def parse_shard(text):
+    """
+    (index, count) of a shard given as 'i/N', with 0 <= i < N.
+    """
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"invalid shard '{text}', expected i/N")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"invalid shard '{text}', expected 0 <= i < N")
+    return index, count
+
+def shard_of(name, count):
+    """
+    Shard (0 to count - 1) of a folder name, the same on every machine and for every listing order.
+    """
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest(), 16) % count
+
+def shard_jobs(jobs, shard):
+    """
+    The (name, args) jobs of shard (index, count).
+    """
+    index, count = shard
+    return [(name, job_args) for name, job_args in jobs if shard_of(name, count) == index]
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_json(path, content):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+class ClaimDirectory:
+    """
+    Claims, heartbeats and outcomes of the folders processed by the workers sharing 'claim_dir'.
+    Can be passed to worker processes: every process runs its own heartbeat thread for the claims it holds.
+    """
+
+    def __init__(self, claim_dir, stale_after=STALE_AFTER):
+        self.claim_dir = os.path.abspath(claim_dir)
+        os.makedirs(self.claim_dir, exist_ok=True)
+        self.stale_after = stale_after
+        self._reset()
+
+    def _reset(self):
+        self._held = {}  # name -> token of the claims held by this process
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    def __getstate__(self):
+        return {"claim_dir": self.claim_dir, "stale_after": self.stale_after}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _path(self, name, suffix):
+        return os.path.join(self.claim_dir, name + suffix)
+
+    def is_finished(self, name):
+        return os.path.exists(self._path(name, DONE_SUFFIX)) or os.path.exists(self._path(name, FAILED_SUFFIX))
+
+    def _recover_stale(self, name):
+        """
+        Move away the claim of 'name' if its heartbeat is older than 'stale_after'. Returns True if the claim
+        may be taken now (recovered here or by another process), False if it is held by a live worker.
+        """
+        path = self._path(name, CLAIM_SUFFIX)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return True
+        age = time.time() - stat.st_mtime
+        if age < self.stale_after:
+            return False
+        stale_path = f"{path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True  # Recovered by another process
+        if os.stat(stale_path).st_ino != stat.st_ino:
+            # Another process recovered the stale claim and claimed the folder in between: put its claim back
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        owner = _read_json(stale_path) or {}
+        os.remove(stale_path)
+        print(f"[{name}] recovered the stale claim of {owner.get('host')}:{owner.get('pid')} "
+              f"(no heartbeat for {age:.0f} sec)")
+        return True
+
+    def claim(self, name):
+        """
+        Claim the folder 'name' for this process. Returns False if it is finished, or claimed by a live worker.
+        """
+        if self.is_finished(name):
+            return False
+        path = self._path(name, CLAIM_SUFFIX)
+        token = uuid.uuid4().hex
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._recover_stale(name):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid(), "token": token, "time": time.time()}, f)
+            with self._lock:
+                self._held[name] = token
+            # Another worker may have finished the folder and released its claim just before it was created here
+            if self.is_finished(name):
+                self.release(name)
+                return False
+            self._start_heartbeat()
+            return True
+        return False
+
+    def _owns(self, name, token):
+        claim = _read_json(self._path(name, CLAIM_SUFFIX))
+        return claim is not None and claim.get("token") == token
+
+    def release(self, name):
+        """
+        Remove the claim of 'name' if this process still holds it.
+        """
+        with self._lock:
+            token = self._held.pop(name, None)
+        if token is not None and self._owns(name, token):
+            try:
+                os.remove(self._path(name, CLAIM_SUFFIX))
+            except FileNotFoundError:
+                pass
+
+    def finish(self, name, elapsed, error=None):
+        """
+        Record the outcome of a claimed folder ('.done', or '.failed' with the error) and release its claim.
+        The outcome is written first, so that no other worker can claim the folder in between.
+        """
+        _write_json(self._path(name, FAILED_SUFFIX if error else DONE_SUFFIX),
+                    {"host": socket.gethostname(), "pid": os.getpid(), "time": time.time(),
+                     "elapsed": elapsed, "error": error})
+        self.release(name)
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None and self._heartbeat.is_alive():
+                return
+            self._heartbeat = threading.Thread(target=self._beat, name="claim-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.stale_after / 4)
+            with self._lock:
+                held = list(self._held.items())
+            for name, token in held:
+                # A claim recovered by another worker (after a long stall of this one) is not refreshed
+                if self._owns(name, token):
+                    try:
+                        os.utime(self._path(name, CLAIM_SUFFIX))
+                    except FileNotFoundError:
+                        pass
+
+    def iter_claimed(self, jobs):
+        """
+        Yields the (name, args) jobs that this process could claim, each one when it is reached.
+        """
+        for name, job_args in jobs:
+            if self.claim(name):
+                yield name, job_args
+            else:
+                print(f"[{name}] finished or claimed by another worker, skipped")
+
+    def take_over_stale(self, jobs, run):
+        """
+        After a pass over the (name, args) 'jobs', wait for the folders still running on other workers and run
+        again, with run(jobs), those whose worker crashed meanwhile (stale claim) or that were released
+        unfinished. Every folder is taken over at most once by this process, so that a folder crashing every
+        worker does not loop. Returns the JobResult of these runs, without the skipped folders.
+        """
+        names = [name for name, _ in jobs]
+        results, retried = [], set()
+        while True:
+            states = self.progress(names)
+            retry = [(name, job_args) for name, job_args in jobs
+                     if states[name][0] in ("stale", "pending") and name not in retried]
+            if retry:
+                retried.update(name for name, _ in retry)
+                results += [result for result in run(retry) if not result.skipped]
+            elif any(state == "running" for state, _ in states.values()):
+                time.sleep(self.stale_after / 4)
+            else:
+                return results
+
+    def progress(self, names):
+        """
+        State of every folder of 'names': 'done', 'failed', 'running' (claimed, with a recent heartbeat),
+        'stale' (claimed by a worker that stopped beating) or 'pending'. Returns {name: (state, details)},
+        'details' being the content of the marker or claim file.
+        """
+        with os.scandir(self.claim_dir) as it:
+            files = {entry.name: entry for entry in it}
+        now = time.time()
+        states = {}
+        for name in names:
+            if name + DONE_SUFFIX in files:
+                states[name] = ("done", _read_json(self._path(name, DONE_SUFFIX)) or {})
+            elif name + FAILED_SUFFIX in files:
+                states[name] = ("failed", _read_json(self._path(name, FAILED_SUFFIX)) or {})
+            elif name + CLAIM_SUFFIX in files:
+                try:
+                    age = now - files[name + CLAIM_SUFFIX].stat().st_mtime
+                except FileNotFoundError:
+                    states[name] = ("pending", {})
+                    continue
+                details = _read_json(self._path(name, CLAIM_SUFFIX)) or {}
+                details["heartbeat_age"] = age
+                states[name] = ("stale" if age >= self.stale_after else "running", details)
+            else:
+                states[name] = ("pending", {})
+        return states
+
+    def progress_line(self, names):
+        """
+        One line with the number of folders in every state.
+        """
+        states = [state for state, _ in self.progress(names).values()]
+        counts = ", ".join(f"{states.count(state)} {state}" for state in ("done", "failed", "running", "stale", "pending"))
+        return f"Progress of {self.claim_dir}: {counts} (of {len(names)})"
+
+    def print_progress(self, names):
+        """
+        Print the state of every folder that is not pending, then the totals.
+        """
+        print('================================================================')
+        for name, (state, details) in sorted(self.progress(names).items()):
+            if state == "done":
+                print(f"{name}: done by {details.get('host')}:{details.get('pid')} in {details.get('elapsed', 0):.1f} sec")
+            elif state == "failed":
+                print(f"{name}: FAILED on {details.get('host')}:{details.get('pid')}: {details.get('error')}")
+            elif state in ("running", "stale"):
+                print(f"{name}: {state} on {details.get('host')}:{details.get('pid')} "
+                      f"(last heartbeat {details['heartbeat_age']:.0f} sec ago)")
+        print('----------------------------------------------------------------')
+        print(self.progress_line(names))
+        print('================================================================')
+
+def run_claimed(claims, job_function, name, *job_args):
+    """
+    Job function of job_scheduler.run_jobs() running job_function(*job_args) only if this process can claim the
+    folder 'name' (in the worker process, so that its heartbeat stops if the worker dies). Returns SKIPPED
+    otherwise.
+    """
+    if not claims.claim(name):
+        print(f"[{name}] finished or claimed by another worker, skipped")
+        return SKIPPED
+    start_time = time.time()
+    try:
+        job_function(*job_args)
+    except Exception as e:
+        claims.finish(name, time.time() - start_time, f"{type(e).__name__}: {e}")
+        raise
+    claims.finish(name, time.time() - start_time)
@@ -0,0 +1,144 @@
+"""
+CPU inference mode of the builder: eval mode, torch.inference_mode(), thread tuning and a choice of precision
+for the networks:
+
+- 'fp32': full precision (the reference),
+- 'int8': dynamic int8 quantization of the linear layers, which include the query/key/value and output
+  projections of the attention blocks (weights are quantized once, activations on the fly),
+- 'bf16': bfloat16 autocast of the forward passes of the networks, whose outputs are cast back to float32
+  before the builder post-processes and writes them (numpy has no bfloat16 type); only worthwhile on CPUs
+  with native bfloat16 instructions (AVX512-BF16, AMX).
+
+int8 and bf16 are exclusive: dynamically quantized layers take float32 inputs, which autocast would cast
+to bfloat16.
+"""
+
+import functools
+
+import cv2
+import numpy as np
+import torch
+
+CPU_PRECISIONS = ['fp32', 'int8', 'bf16']
+
+
+def bf16_supported():
+    """
+    Whether the CPU has native bfloat16 instructions (otherwise bfloat16 is emulated and slower than fp32).
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def networks(sdf_unips):
+    """
+    The torch modules held by the builder, as (attribute name, module).
+    """
+    return [(name, value) for name, value in vars(sdf_unips).items() if isinstance(value, torch.nn.Module)]
+
+
+def to_float32(value):
+    """
+    'value' with its bfloat16 tensors (also inside tuples, lists and dicts) cast to float32.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.float() if value.dtype == torch.bfloat16 else value
+    if isinstance(value, (tuple, list)):
+        return type(value)(to_float32(item) for item in value)
+    if isinstance(value, dict):
+        return {key: to_float32(item) for key, item in value.items()}
+    return value
+
+
+def autocast_bf16(network):
+    """
+    Run the forward pass of 'network' under bfloat16 autocast, with float32 outputs.
+    """
+    forward = network.forward
+
+    @functools.wraps(forward)
+    def bf16_forward(*args, **kwargs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            outputs = forward(*args, **kwargs)
+        return to_float32(outputs)
+
+    network.forward = bf16_forward
+    return network
+
+
+def set_threads(num_threads=None):
+    """
+    Use 'num_threads' intra-op threads. Without 'num_threads' the current setting is kept, e.g. the thread
+    budget of a worker of run_sdm_multifolder.py (--threads_per_worker).
+    """
+    if num_threads is None:
+        return torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        # Only possible before the first parallel operation of the process
+        torch.set_num_interop_threads(max(1, min(4, num_threads // 4)))
+    except RuntimeError:
+        pass
+    return num_threads
+
+
+def optimize(sdf_unips, precision='fp32', num_threads=None):
+    """
+    Prepare a builder created on the cpu for the CPU inference mode: networks in eval mode (quantized for
+    'int8', their forward passes under bfloat16 autocast for 'bf16'), tuned threads, and run() wrapped in
+    torch.inference_mode().
+    """
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"Unknown CPU precision '{precision}', expected one of {CPU_PRECISIONS}")
+    if precision == 'bf16' and not bf16_supported():
+        print("Warning: this CPU has no native bfloat16 instructions, bf16 will likely be slower than fp32")
+
+    num_threads = set_threads(num_threads)
+
+    for name, network in networks(sdf_unips):
+        network.eval()
+        if precision == 'int8':
+            setattr(sdf_unips, name, torch.ao.quantization.quantize_dynamic(network, {torch.nn.Linear}, dtype=torch.qint8))
+        elif precision == 'bf16':
+            autocast_bf16(network)
+
+    run = sdf_unips.run
+
+    @functools.wraps(run)
+    def optimized_run(*args, **kwargs):
+        with torch.inference_mode():
+            return run(*args, **kwargs)
+
+    sdf_unips.run = optimized_run
+    print(f"CPU inference: {precision}, {num_threads} threads")
+    return sdf_unips
+
+
+def read_normal_map(path):
+    """
+    Unit normal map (H, W, 3) of a normal.png written by the builder, and the mask of its foreground pixels.
+    """
+    img = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise FileNotFoundError(path)
+    img = img[:, :, ::-1].astype(np.float32) / np.iinfo(img.dtype).max
+    mask = img.max(axis=2) > 0
+    nml = 2 * img - 1
+    nml /= np.linalg.norm(nml, axis=2, keepdims=True) + 1e-12
+    return nml, mask
+
+
+def mean_angular_error(reference_path, candidate_path):
+    """
+    Mean angular error (degrees) between two normal.png, over the foreground pixels of the reference.
+    """
+    reference, mask = read_normal_map(reference_path)
+    candidate, _ = read_normal_map(candidate_path)
+    if candidate.shape != reference.shape:
+        candidate = cv2.resize(candidate, reference.shape[1::-1], interpolation=cv2.INTER_LINEAR)
+    cosine = np.clip(np.sum(reference * candidate, axis=2), -1, 1)
+    return float(np.degrees(np.arccos(cosine[mask])).mean())
@@ -0,0 +1,128 @@
+"""
+Zero-copy datasets: a '.data' folder may hold its images as hard links, symbolic links, or only a
+'manifest.txt' listing the original files. This module writes such folders (used by the cheminova
+organizers) and resolves manifests back to the original files before loading (used by main.py).
+"""
+
+import os
+import shutil
+import fnmatch
+import tempfile
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.txt"
+MANIFEST_HEADER = "# SDM-UniPS image manifest: <name in the .data folder>\t<original file>\n"
+
+PLACEMENT_MODES = ['copy', 'hardlink', 'symlink', 'manifest']
+
+# Modes tried, in order, when the requested way of placing a file is not supported
+_FALLBACKS = {
+    'copy': ['copy'],
+    'hardlink': ['hardlink', 'symlink', 'copy'],
+    'symlink': ['symlink', 'hardlink', 'copy'],
+}
+
+def place_file(src, dst, mode='copy'):
+    """
+    Place 'src' at 'dst' as a copy, a hard link or a symbolic link. When links are not supported
+    (different filesystems, missing privileges on Windows, ...) the next mode of the fallback chain is used.
+    Returns the mode that was actually used.
+    """
+    src, dst = Path(src), Path(dst)
+    if dst.is_symlink() or dst.exists():
+        dst.unlink()
+    for placement in _FALLBACKS[mode]:
+        try:
+            if placement == 'hardlink':
+                os.link(src, dst)
+            elif placement == 'symlink':
+                os.symlink(src.resolve(), dst)
+            else:
+                shutil.copy(src, dst)
+            return placement
+        except (OSError, NotImplementedError):
+            if placement == 'copy':
+                raise
+    return None
+
+def write_manifest(data_folder, entries):
+    """
+    Write the manifest of a '.data' folder. 'entries' is an ordered list of (name, original file) pairs;
+    originals are stored relative to the folder when possible so that the archive can be moved.
+    """
+    data_folder = Path(data_folder)
+    data_folder.mkdir(parents=True, exist_ok=True)
+    with open(data_folder / MANIFEST_NAME, "w") as f:
+        f.write(MANIFEST_HEADER)
+        for name, src in entries:
+            src = Path(src).resolve()
+            try:
+                src = os.path.relpath(src, data_folder.resolve())
+            except ValueError:
+                pass  # Different drive on Windows
+            f.write(f"{name}\t{src}\n")
+
+def read_manifest(data_folder):
+    """
+    Ordered list of (name, absolute original path) pairs of the manifest of a '.data' folder,
+    or None if the folder has no manifest.
+    """
+    manifest_path = Path(data_folder) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    entries = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            name, src = line.split("\t", 1)
+            entries.append((name, os.path.normpath(os.path.join(data_folder, src))))
+    return entries
+
+def list_data_files(data_folder, file_names=None):
+    """
+    Ordered list of (name, path) of the files of a '.data' folder, resolving its manifest if it has one.
+    The manifest file itself is not listed. 'file_names' are the names of the files of the folder when they
+    are already known (e.g. from dataset_index.cached_files()); otherwise the folder is listed.
+    """
+    if file_names is None:
+        file_names = [name for name in os.listdir(data_folder) if os.path.isfile(os.path.join(data_folder, name))]
+    files = [(name, os.path.join(data_folder, name)) for name in sorted(file_names)]
+    entries = read_manifest(data_folder)
+    if entries is None:
+        return files
+    # Files stored next to the manifest (e.g. mask.png) are part of the dataset too
+    manifest_names = {name for name, _ in entries}
+    return entries + [(name, path) for name, path in files if name != MANIFEST_NAME and name not in manifest_names]
+
+def light_images(data_folder, test_prefix, file_names=None):
+    """
+    Ordered list of (name, path) of the images of a '.data' folder that the loader reads as lights: the files
+    matching test_prefix (e.g. 'L*'), without the mask, the ground truth maps ('*_gt.*') and text files.
+    """
+    return [(name, path) for name, path in list_data_files(data_folder, file_names)
+            if fnmatch.fnmatch(name, test_prefix) and name.lower() != "mask.png" and "_gt." not in name.lower()
+            and not name.lower().endswith(".txt")]
+
+def resolve_test_dir(test_dir, test_ext):
+    """
+    If any '*{test_ext}' folder of 'test_dir' holds a manifest, build a temporary test directory in which
+    every manifest is replaced by links to (or, when links are not supported, copies of) the original files,
+    and the other datasets are linked as they are. Returns (test_dir to load, temporary folder or None);
+    the temporary folder must be removed with shutil.rmtree once the data has been loaded.
+    """
+    test_dir = Path(test_dir)
+    data_folders = sorted(p for p in test_dir.glob(f"*{test_ext}") if p.is_dir())
+    if not any((p / MANIFEST_NAME).exists() for p in data_folders):
+        return test_dir, None
+
+    staging_dir = Path(tempfile.mkdtemp(prefix="sdm_manifest_"))
+    for data_folder in data_folders:
+        staged_folder = staging_dir / data_folder.name
+        staged_folder.mkdir()
+        for name, src in list_data_files(data_folder):
+            if name != MANIFEST_NAME:
+                place_file(src, staged_folder / name, mode='symlink')
+    print(f"Resolved image manifests of {test_dir} in {staging_dir}")
+    return staging_dir, staging_dir
@@ -0,0 +1,177 @@
+"""
+Cached index of an archive of captures. The directory tree under a root folder is listed once with os.scandir
+and saved (subfolders and file names of every folder, with the folder's modification time) to an index file,
+'.sdm_index.json' in the root folder by default. A later scan only lists again the folders whose modification
+time changed; the others cost one stat. Adding, removing or renaming a file or folder changes the modification
+time of its parent folder, so the listings stay exact (rewriting a file in place does not, and is not needed:
+only names are indexed).
+
+The cheminova organizers and run_sdm_multifolder.py find their captures ('rti', 'view_*', 'SDM_in.data'
+folders), image lists and masks with it. Indexes loaded by a process are also used by cached_files(), so that
+later listings of the same folders in this process (or in worker processes forked from it) are free.
+"""
+
+import os
+import json
+import time
+
+INDEX_NAME = ".sdm_index.json"
+INDEX_VERSION = 1
+# A folder modified less than this long before a scan may change again within the same mtime tick, so its
+# listing is not trusted by the next scan
+MTIME_SLACK_NS = 2 * 10**9
+
+# Indexes loaded by this process, by root folder
+_loaded = {}
+
+
+class DatasetIndex:
+    """
+    Listings of the folders under 'root', kept in 'index_path' (default: root/.sdm_index.json).
+    """
+
+    def __init__(self, root, index_path=None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path or os.path.join(self.root, INDEX_NAME)
+        self.folders = {}
+        self.listed = 0
+        self.reused = 0
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION and index.get("root") == self.root:
+                self.folders = index["folders"]
+        except (OSError, ValueError, KeyError):
+            pass  # No index yet, or a partial one: everything is listed
+
+    def _relative(self, path):
+        relative = os.path.relpath(os.path.abspath(path), self.root)
+        return "" if relative == "." else relative.replace(os.sep, "/")
+
+    def scan(self):
+        """
+        Bring the listings up to date: unchanged folders are reused, the others are listed with os.scandir.
+        Folders that no longer exist are dropped. A folder reached again through a symlink (e.g. a link to
+        one of its parents) is only listed the first time, so symlink loops end.
+        """
+        scan_start = time.time_ns()
+        folders = {}
+        visited = set()
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            path = os.path.join(self.root, relative)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            mtime = stat.st_mtime_ns
+            entry = self.folders.get(relative)
+            if entry is None or entry["mtime"] != mtime or not entry["stable"]:
+                subfolders, files = [], []
+                try:
+                    with os.scandir(path) as it:
+                        for dir_entry in it:
+                            # d_type from the directory listing: no stat per entry (symlinks are followed)
+                            (subfolders if dir_entry.is_dir() else files).append(dir_entry.name)
+                except OSError:
+                    continue
+                entry = {"mtime": mtime, "stable": mtime < scan_start - MTIME_SLACK_NS,
+                         "subfolders": sorted(subfolders), "files": sorted(files)}
+                self.listed += 1
+            else:
+                self.reused += 1
+            folders[relative] = entry
+            pending += [f"{relative}/{name}" if relative else name for name in entry["subfolders"]]
+        self.folders = folders
+        _loaded[self.root] = self
+        return self
+
+    def save(self):
+        """
+        Write the index to a temporary file renamed over the previous one, so that an interrupted save or a
+        concurrent scan never leaves a truncated index (the rename only makes the next scan list the root
+        folder again). Returns False if the folder of the index is not writable.
+        """
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"version": INDEX_VERSION, "root": self.root, "folders": self.folders}, f)
+            os.replace(tmp_path, self.index_path)
+            return True
+        except OSError as e:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            print(f"Could not write the dataset index {self.index_path}: {e}")
+            return False
+
+    def listing(self, path):
+        """
+        (subfolder names, file names) of a folder of the index, or None if it is not indexed.
+        """
+        entry = self.folders.get(self._relative(path))
+        return None if entry is None else (entry["subfolders"], entry["files"])
+
+    def subfolders(self, path):
+        return self.listing(path)[0]
+
+    def files(self, path):
+        return self.listing(path)[1]
+
+    def find_folders(self, name, under=None):
+        """
+        Paths of the folders called 'name' under 'under' (default: the root), at any depth, in sorted order.
+        """
+        prefix = self._relative(under) if under is not None else ""
+        found = []
+        for relative in sorted(self.folders):
+            if prefix and relative != prefix and not relative.startswith(prefix + "/"):
+                continue
+            if relative.rsplit("/", 1)[-1] == name and relative != prefix:
+                found.append(os.path.join(self.root, *relative.split("/")))
+        return found
+
+    def images(self, path, extensions, exclude=("mask.png",)):
+        """
+        Sorted paths of the files of a folder with one of 'extensions' (lower case, e.g. ['.jpg']).
+        """
+        return [os.path.join(path, name) for name in self.files(path)
+                if os.path.splitext(name)[1].lower() in extensions and name not in exclude]
+
+    def mask(self, path, name="mask.png"):
+        """
+        Path of the mask of a folder, or None.
+        """
+        return os.path.join(path, name) if name in self.files(path) else None
+
+    def summary(self):
+        return f"{len(self.folders)} folders indexed ({self.listed} listed, {self.reused} unchanged)"
+
+
+def load(root, index_path=None):
+    """
+    The index of 'root', scanned and saved.
+    """
+    start = time.perf_counter()
+    index = DatasetIndex(root, index_path).scan()
+    index.save()
+    print(f"Dataset index of {index.root}: {index.summary()} in {time.perf_counter() - start:.2f} sec")
+    return index
+
+
+def cached_files(path):
+    """
+    File names of 'path' from an index loaded by this process, or None if no loaded index covers it.
+    """
+    path = os.path.abspath(path)
+    for root, index in _loaded.items():
+        if path == root or path.startswith(root + os.sep):
+            listing = index.listing(path)
+            if listing is not None:
+                return listing[1]
+    return None
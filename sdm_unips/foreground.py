@@ -0,0 +1,75 @@
+"""
+Mask-aware sparse computation. The foreground pixels of an object (those of the mask.png that main.py copies
+from the input dataset into the result folder) are listed once in a ForegroundIndex; maps are packed into images
+that hold only those pixels, the renderers work on the packed images, and the frames are scattered back to
+full frames just before they are encoded. The work is proportional to the foreground, not to the frame.
+"""
+
+import os
+
+import cv2
+import numpy as np
+import torch
+
+# Above this foreground fraction the maps are rendered densely (packing would not save anything)
+MAX_SPARSE_FRACTION = 0.9
+
+
+def load_mask(datadir, shape):
+    """
+    Boolean foreground mask of the given (height, width) read from mask.png of 'datadir', or None if there is
+    no mask.png. The black pixels of normal.png are not used: they can be true normals of the object.
+    """
+    mask_path = os.path.join(datadir, "mask.png")
+    if not os.path.exists(mask_path):
+        return None
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    if mask.shape != tuple(shape):
+        mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+    return mask > 0
+
+
+class ForegroundIndex:
+    """
+    Flat indices of the foreground pixels of a (height, width) boolean mask.
+
+    Packed images have the width of the frame and ceil(count / width) rows; the last row is padded with
+    copies of the last foreground pixel, so the renderers (and their tiling) see an ordinary, smaller image.
+    """
+
+    def __init__(self, mask):
+        self.height, self.width = mask.shape
+        self.index = np.flatnonzero(mask.reshape(-1))
+        self.count = len(self.index)
+        self.rows = max(1, -(-self.count // self.width))
+        self._index_tensor = torch.from_numpy(self.index)
+
+    @property
+    def fraction(self):
+        return self.count / (self.height * self.width)
+
+    def pack(self, x):
+        """
+        Packed image (1, C, rows, width) of the foreground pixels of a map (1, C, height, width).
+        """
+        channels = x.shape[1]
+        pixels = x.reshape(channels, -1)[:, self._index_tensor.to(x.device)]
+        padding = self.rows * self.width - self.count
+        if padding:
+            pixels = torch.cat((pixels, pixels[:, -1:].expand(channels, padding)), dim=1)
+        return pixels.reshape(1, channels, self.rows, self.width)
+
+    def unpack(self, frame):
+        """
+        Full uint8 frame (height, width, 3), black outside the foreground, of a packed frame (rows, width, 3).
+        """
+        full = np.zeros((self.height * self.width, frame.shape[-1]), dtype=frame.dtype)
+        full[self.index] = frame.reshape(-1, frame.shape[-1])[:self.count]
+        return full.reshape(self.height, self.width, -1)
+
+    def iter_unpacked(self, frames):
+        """
+        Yields the full frames of an iterable of packed frames.
+        """
+        for frame in frames:
+            yield self.unpack(frame)
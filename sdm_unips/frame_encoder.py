@@ -0,0 +1,237 @@
+"""
+Parallel encoding of the relighting frames. The frames are grouped into segments of consecutive frames; every
+segment is normalized / quantized as one (K, h, w, 3) stack and encoded to a temporary file by a worker
+process, and the segments are concatenated in order:
+
+- GIF: all segments share one global palette (built from the pixels of the first segment), so their frame
+  blocks are simply appended after the header of the first segment. Colors are mapped to the palette with a
+  lookup table over the whole stack instead of a per-frame quantization.
+- AVI: every segment is an XVID video, and ffmpeg joins them without re-encoding (concat demuxer), so
+  ffmpeg (on the PATH or from imageio-ffmpeg) is needed (see can_encode()).
+"""
+
+import os
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import profiling
+
+SEGMENT_FRAMES = 24
+PALETTE_COLORS = 256
+PALETTE_SAMPLES = 1 << 18
+# Colors are looked up in the palette after dropping the 3 low bits of every channel (32 x 32 x 32 table)
+LUT_BITS = 5
+
+
+def normalize_stack(frames):
+    """
+    Every frame of a (K, h, w, 3) stack stretched to the full 0-255 range (like create_gif_from_numpy_arrays),
+    as uint8.
+    """
+    frames = frames.astype(np.float32)
+    flat = frames.reshape(frames.shape[0], -1)
+    low = flat.min(axis=1)[:, None, None, None]
+    high = flat.max(axis=1)[:, None, None, None]
+    return ((frames - low) * (255 / np.maximum(high - low, 1e-6))).astype(np.uint8)
+
+
+def build_palette(frames, colors=PALETTE_COLORS, samples=PALETTE_SAMPLES, seed=0):
+    """
+    Palette (colors, 3) uint8 of a stack of frames (median cut on a random sample of their pixels).
+    """
+    from PIL import Image
+
+    pixels = frames.reshape(-1, 3)
+    if len(pixels) > samples:
+        pixels = pixels[np.random.default_rng(seed).choice(len(pixels), samples, replace=False)]
+    quantized = Image.fromarray(np.ascontiguousarray(pixels[:, None, :])).quantize(colors=colors, method=Image.MEDIANCUT)
+    palette = np.array(quantized.getpalette()[:3 * colors], dtype=np.uint8).reshape(-1, 3)
+    return np.concatenate((palette, np.zeros((colors - len(palette), 3), np.uint8))) if len(palette) < colors else palette
+
+
+def palette_lut(palette):
+    """
+    Index of the nearest palette color for every color of a 2^LUT_BITS per channel grid (flattened).
+    """
+    levels = (np.arange(2 ** LUT_BITS) << (8 - LUT_BITS)) + (1 << (7 - LUT_BITS))
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 1, 3).astype(np.float32)
+    lut = np.empty(len(grid), dtype=np.uint8)
+    for start in range(0, len(grid), 4096):
+        distances = ((grid[start:start + 4096] - palette[None].astype(np.float32)) ** 2).sum(axis=2)
+        lut[start:start + 4096] = distances.argmin(axis=1)
+    return lut
+
+
+def quantize_stack(frames, lut):
+    """
+    Palette indices (K, h, w) uint8 of a uint8 stack (K, h, w, 3).
+    """
+    shift = 8 - LUT_BITS
+    r, g, b = (frames[..., c] >> shift for c in range(3))
+    return lut[(r.astype(np.int32) << (2 * LUT_BITS)) | (g.astype(np.int32) << LUT_BITS) | b]
+
+
+def _encode_gif_segment(path, frames, palette, lut, duration):
+    from PIL import Image
+
+    indices = quantize_stack(normalize_stack(frames), lut)
+    images = []
+    for index in indices:
+        image = Image.fromarray(index)
+        image.putpalette(palette.reshape(-1).tolist())  # 'L' becomes 'P'
+        images.append(image)
+    images[0].save(path, save_all=True, append_images=images[1:], duration=int(round(1000 * duration)), loop=0, optimize=False)
+    return path
+
+
+def _encode_avi_segment(path, frames, fps):
+    height, width = frames.shape[1:3]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'XVID'), fps, (width, height), isColor=True)
+    for frame in frames:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    writer.release()
+    return path
+
+
+def _skip_sub_blocks(data, pos):
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def split_gif(data):
+    """
+    (head, frames) of a GIF file: the header, screen descriptor, global color table and extensions before the
+    first frame, and the blocks of all the frames without the trailer.
+    """
+    flags = data[10]
+    pos = 13 + (3 * 2 ** ((flags & 7) + 1) if flags & 0x80 else 0)
+    first_frame = None
+    while data[pos] != 0x3B:
+        start = pos
+        if data[pos] == 0x21:  # Extension; a graphic control extension starts a frame
+            label = data[pos + 1]
+            pos = _skip_sub_blocks(data, pos + 2)
+            if label == 0xF9 and first_frame is None:
+                first_frame = start
+        elif data[pos] == 0x2C:  # Image descriptor, optional local color table, then the LZW data
+            first_frame = start if first_frame is None else first_frame
+            flags = data[pos + 9]
+            pos += 10 + (3 * 2 ** ((flags & 7) + 1) if flags & 0x80 else 0)
+            pos = _skip_sub_blocks(data, pos + 1)
+        else:
+            raise ValueError(f"unexpected GIF block 0x{data[pos]:02x} at {pos}")
+    return data[:first_frame], data[first_frame:pos]
+
+
+def _global_color_table(data):
+    flags = data[10]
+    return data[13:13 + 3 * 2 ** ((flags & 7) + 1)] if flags & 0x80 else b""
+
+
+def concatenate_gifs(segment_paths, output_file):
+    """
+    Join GIF segments that share their global color table into one animation.
+    """
+    with open(output_file, "wb") as out:
+        for i, path in enumerate(segment_paths):
+            with open(path, "rb") as f:
+                data = f.read()
+            head, frames = split_gif(data)
+            if i == 0:
+                out.write(head)
+                color_table = _global_color_table(data)
+            elif _global_color_table(data) != color_table:
+                raise ValueError(f"{path} does not share the global palette of the first segment")
+            out.write(frames)
+        out.write(b"\x3B")
+
+
+def find_ffmpeg():
+    """
+    Path of an ffmpeg executable, or None.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        try:
+            import imageio_ffmpeg
+            ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+        except (ImportError, RuntimeError):
+            pass
+    return ffmpeg
+
+
+def concatenate_videos(segment_paths, output_file, ffmpeg):
+    list_file = os.path.join(os.path.dirname(segment_paths[0]), "segments.txt")
+    with open(list_file, "w") as f:
+        f.writelines(f"file '{path}'\n" for path in segment_paths)
+    subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_file,
+                    "-c", "copy", output_file], check=True)
+
+
+def can_encode(output_file):
+    """
+    Whether encode() supports 'output_file' here (a GIF, or an AVI when ffmpeg is available).
+    """
+    return output_file.lower().endswith(".gif") or find_ffmpeg() is not None
+
+
+def iter_segments(frames, segment_frames):
+    """
+    Yields stacks (K, h, w, 3) of up to 'segment_frames' consecutive frames of an iterable of frames.
+    """
+    segment = []
+    for frame in frames:
+        segment.append(frame)
+        if len(segment) == segment_frames:
+            yield np.stack(segment)
+            segment = []
+    if segment:
+        yield np.stack(segment)
+
+
+def encode(frames, output_file, fps=30, duration=0.05, workers=None, segment_frames=SEGMENT_FRAMES):
+    """
+    Encode an iterable of uint8 frames (h, w, 3) to 'output_file' (.gif with 'duration' seconds per frame, or
+    .avi at 'fps') with 'workers' processes (default: number of cpus). At most 2 x workers segments are held in
+    memory. Returns the number of frames.
+    """
+    workers = workers or os.cpu_count()
+    is_gif = output_file.lower().endswith(".gif")
+    ffmpeg = None if is_gif else find_ffmpeg()
+    count = 0
+    temp_dir = tempfile.mkdtemp(prefix="sdm_encode_", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        extension = ".gif" if is_gif else ".avi"
+        palette = lut = None
+        pending, paths = [], []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for i, segment in enumerate(iter_segments(frames, segment_frames)):
+                if is_gif and palette is None:
+                    with profiling.span("relight.build_palette"):
+                        palette = build_palette(normalize_stack(segment))
+                        lut = palette_lut(palette)
+                path = os.path.join(temp_dir, f"segment_{i:06d}{extension}")
+                if is_gif:
+                    pending.append(pool.submit(_encode_gif_segment, path, segment, palette, lut, duration))
+                else:
+                    pending.append(pool.submit(_encode_avi_segment, path, segment, fps))
+                count += len(segment)
+                # Bound the number of segments waiting for a worker
+                while len(pending) >= 2 * workers:
+                    paths.append(pending.pop(0).result())
+            paths += [future.result() for future in pending]
+        if paths:
+            with profiling.span("relight.concatenate"):
+                if is_gif:
+                    concatenate_gifs(paths, output_file)
+                else:
+                    concatenate_videos(paths, output_file, ffmpeg)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return count
@@ -0,0 +1,229 @@
+"""
+Faster image decoding for the test loader: images are decoded by a thread pool (cv2 releases the GIL)
+and, optionally, kept in an on-disk cache of memory-mapped .npy arrays.
+
+The loader (modules/io) reads its images one after another with cv2.imread. install() replaces cv2.imread
+with a function that, in the threads reading test data (inside a reading() block), calls
+DecodeAccelerator.imread: the first light image requested in a folder starts the decoding of the other light
+images of that folder (data_manifest.light_images(), the loader's list: the files matching --test_prefix, in
+the loader's order, without the mask and the ground truth maps), so the following requests of the loader are
+served from the pool. The light images are only decoded ahead when the loader reads all of them (no more than
+--max_image_num, as in the SDM_in.data folders of the organize scripts); otherwise the loader's choice is not
+known here, and every image is decoded when it is requested. Other reads (e.g. of the maps by relighting.py in
+the same process) go to the original cv2.imread.
+
+Light images are downsampled to max_image_res (longest side, memory_model.resized_shape(), as the loader does)
+right after decoding, so that the loader's own resize has nothing left to do, and the cache holds the resized
+arrays: a cache hit costs neither decoding nor resizing. The arrays keep their decoded dtype, so the loader
+still normalizes them by their bit depth. Cache entries are keyed by the real path of the images (staging
+folders of symbolic links change from run to run) and evicted least-recently-used first beyond a size limit.
+"""
+
+import os
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import data_manifest
+from memory_model import resized_shape
+
+# Default size limit of the decoded-image cache
+DEFAULT_MAX_BYTES = 20 * 1024**3
+
+_accelerator = None
+_reading = threading.local()
+_original_imread = cv2.imread
+
+class DecodeAccelerator:
+    """
+    Drop-in replacement of cv2.imread with background decoding of sibling images and a decoded-image cache.
+
+    :param workers: Number of decoding threads (1 disables the background decoding).
+    :param cache_dir: Folder of the decoded-image cache, or None. Entries are keyed by real file path, size,
+                      modification time, imread flags and, for light images, max_image_res.
+    :param max_image_res: Longest side of the light images once resized (None: not resized).
+    :param max_prefetch: Number of images read by the loader per folder (--max_image_num): the light images
+                         of a folder are decoded ahead only if there are no more.
+    :param max_bytes: Size limit of the cache; least-recently-used entries are evicted beyond it.
+    :param test_prefix: Pattern of the names of the light images (--test_prefix).
+    """
+
+    def __init__(self, workers=4, cache_dir=None, max_image_res=None, max_prefetch=100, max_bytes=DEFAULT_MAX_BYTES,
+                 test_prefix='L*'):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode") if workers > 1 else None
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_image_res = max_image_res
+        self.max_prefetch = max_prefetch
+        self.max_bytes = max_bytes
+        self.test_prefix = test_prefix
+        self.cache_bytes = self._cache_size() if self.cache_dir is not None else 0
+        self.original_imread = _original_imread
+        self.futures = {}
+        self.prefetched_folders = set()
+        self.light_images = {}
+        self.lock = threading.Lock()
+
+    def _cache_path(self, path, flags, max_image_res):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        key = f"{path}|{stat.st_size}|{stat.st_mtime_ns}|{flags}|{max_image_res}"
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.npy"
+
+    def _entries(self):
+        """
+        (last used time, size, path) of the cache entries.
+        """
+        entries = []
+        for entry in self.cache_dir.glob("*.npy"):
+            if ".tmp" in entry.name:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another process
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        return entries
+
+    def _cache_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Remove least-recently-used entries until the cache fits in 'max_bytes' (other processes may share it,
+        so the entries are listed again).
+        """
+        entries = self._entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                entry.unlink()
+            total_size -= size
+        with self.lock:
+            self.cache_bytes = total_size
+
+    def _decode(self, path, flags, light):
+        """
+        The image at 'path', from the cache if it holds it; light images are resized to max_image_res.
+        """
+        max_image_res = self.max_image_res if light else None
+        cache_path = None
+        if self.cache_dir is not None and os.path.exists(path):
+            cache_path = self._cache_path(path, flags, max_image_res)
+            if cache_path.exists():
+                try:
+                    # Copy-on-write, so that the loader may modify the array in place
+                    img = np.load(cache_path, mmap_mode='c')
+                    os.utime(cache_path)  # Last-used time for the eviction policy
+                    return img
+                except (OSError, ValueError):
+                    pass  # Corrupted or evicted entry: decode again
+
+        img = self.original_imread(path, flags)
+        if img is not None and max_image_res is not None:
+            height, width = resized_shape(img.shape[0], img.shape[1], max_image_res)
+            if (height, width) != img.shape[:2]:
+                img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+        if img is not None and cache_path is not None:
+            tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npy")
+            np.save(tmp_path, img)
+            os.replace(tmp_path, cache_path)
+            with self.lock:
+                self.cache_bytes += img.nbytes
+                full = self.cache_bytes > self.max_bytes
+            if full:
+                self.evict()
+        return img
+
+    def _light_images(self, folder):
+        """
+        Paths of the light images of 'folder', in the loader's order (listed once per folder).
+        """
+        with self.lock:
+            images = self.light_images.get(folder)
+        if images is None:
+            try:
+                images = [os.path.abspath(path) for _, path in data_manifest.light_images(folder, self.test_prefix)]
+            except OSError:
+                images = []
+            with self.lock:
+                images = self.light_images.setdefault(folder, images)
+        return images
+
+    def _prefetch(self, images, path, flags):
+        """
+        Decode ahead the light 'images' of the folder of 'path' if the loader reads all of them (called once
+        per folder, with the lock held).
+        """
+        if len(images) > self.max_prefetch:
+            return
+        for image in images:
+            if image != path and (image, flags) not in self.futures:
+                self.futures[(image, flags)] = self.pool.submit(self._decode, image, flags, True)
+
+    def imread(self, filename, flags=cv2.IMREAD_COLOR):
+        path = os.path.abspath(str(filename))
+        images = self._light_images(os.path.dirname(path))
+        light = path in images
+        with self.lock:
+            future = self.futures.pop((path, flags), None)
+            folder_key = (os.path.dirname(path), flags)
+            if future is None and light and self.pool is not None and folder_key not in self.prefetched_folders:
+                self.prefetched_folders.add(folder_key)
+                self._prefetch(images, path, flags)
+        if future is not None:
+            return future.result()
+        return self._decode(path, flags, light)
+
+    def clear(self):
+        """
+        Drop the images decoded ahead but never requested (e.g. images the loader did not select).
+        """
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+            self.prefetched_folders = set()
+            self.light_images = {}
+
+def _imread(filename, flags=cv2.IMREAD_COLOR):
+    if _accelerator is not None and getattr(_reading, "depth", 0) > 0:
+        return _accelerator.imread(filename, flags)
+    return _original_imread(filename, flags)
+
+def install(workers=4, cache_dir=None, max_image_res=None, max_prefetch=100, max_bytes=DEFAULT_MAX_BYTES, test_prefix='L*'):
+    """
+    Set up a DecodeAccelerator, used by cv2.imread inside reading() blocks.
+    """
+    global _accelerator
+    _accelerator = DecodeAccelerator(workers, cache_dir, max_image_res, max_prefetch, max_bytes, test_prefix)
+    cv2.imread = _imread
+    return _accelerator
+
+@contextlib.contextmanager
+def reading():
+    """
+    The cv2.imread calls of this thread inside the block read test data, through the DecodeAccelerator (if
+    install() was called).
+    """
+    _reading.depth = getattr(_reading, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _reading.depth -= 1
+
+def clear():
+    """
+    Release the images decoded ahead but not used by the last dataset (no-op if install() was not called).
+    """
+    if _accelerator is not None:
+        _accelerator.clear()
@@ -0,0 +1,83 @@
+"""
+Lighting-diversity selection of a subset of the images of a capture. Every image is reduced to a cheap shading
+signature (a small grayscale thumbnail of the object, centered and scaled to unit norm so that the overall
+exposure does not matter), and the K most mutually different signatures are chosen greedily (farthest-point
+sampling). Images lit from similar directions have similar signatures, so the subset covers the lighting
+directions of the capture better than an index stride.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+SELECTION_MODES = ['equally_spaced', 'diverse']
+SIGNATURE_SIZE = 32
+
+
+def shading_signature(image_path, size=SIGNATURE_SIZE, mask=None):
+    """
+    Unit-norm, zero-mean grayscale thumbnail (size x size, flattened) of an image, restricted to 'mask'
+    (a boolean size x size array) if given.
+    """
+    # JPEG images are decoded at 1/8 of their resolution directly
+    img = cv2.imread(str(image_path), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None:
+        raise FileNotFoundError(image_path)
+    signature = cv2.resize(img.astype(np.float32), (size, size), interpolation=cv2.INTER_AREA).reshape(-1)
+    if mask is not None:
+        signature = signature[mask.reshape(-1)]
+    signature -= signature.mean()
+    return signature / max(float(np.linalg.norm(signature)), 1e-6)
+
+
+def load_signature_mask(mask_path, size=SIGNATURE_SIZE):
+    """
+    Boolean size x size mask of mask.png, or None if there is no mask (or it is empty).
+    """
+    if mask_path is None or not os.path.exists(mask_path):
+        return None
+    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        return None
+    mask = cv2.resize(mask, (size, size), interpolation=cv2.INTER_AREA) > 127
+    return mask if mask.any() else None
+
+
+def shading_signatures(image_paths, size=SIGNATURE_SIZE, mask_path=None, workers=8):
+    """
+    Signatures (N, D) of the images, decoded by 'workers' threads.
+    """
+    mask = load_signature_mask(mask_path, size)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return np.stack(list(pool.map(lambda path: shading_signature(path, size, mask), image_paths)))
+
+
+def farthest_point_selection(signatures, k):
+    """
+    Indices (sorted) of 'k' signatures chosen greedily, each the farthest from those already chosen; the first
+    one is the farthest from the mean signature.
+    """
+    count = len(signatures)
+    if k >= count:
+        return list(range(count))
+    selected = [int(np.argmax(np.linalg.norm(signatures - signatures.mean(axis=0), axis=1)))]
+    distances = np.linalg.norm(signatures - signatures[selected[0]], axis=1)
+    while len(selected) < k:
+        index = int(np.argmax(distances))
+        selected.append(index)
+        distances = np.minimum(distances, np.linalg.norm(signatures - signatures[index], axis=1))
+    return sorted(selected)
+
+
+def select_diverse_images(image_list, num_images_to_select, mask_path=None):
+    """
+    Selects the 'num_images_to_select' images with the most diverse lighting from the image list (kept in
+    their original order). If the number of images requested is not smaller than the available images,
+    it returns all images.
+    """
+    if len(image_list) <= num_images_to_select:
+        return image_list
+    signatures = shading_signatures(image_list, mask_path=mask_path)
+    return [image_list[i] for i in farthest_point_selection(signatures, num_images_to_select)]
@@ -5,13 +5,34 @@ Scalable, Detailed and Mask-free Universal Photometric Stereo Network (CVPR2023)
 """
 
 from __future__ import print_function, division
+import time
+# Start of the process, for the time to first pixel
+START_TIME = time.time()
 from modules.model.model_utils import *
 from modules.builder import builder
 from modules.io import dataio
+import os
 import sys
+import copy
+import shutil
+import tempfile
+import contextlib
 import argparse
-import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import cv2
+import numpy as np
+import torch
+import data_manifest
+import image_cache
+import cpu_inference
+import model_artifact
+import memory_model
+import multi_view
+import output_writer
+import profiling
+import result_bundle
 
 # Dynamically add the parent directory to sys.path for importing modules
 current_dir = Path(__file__).resolve().parent
@@ -32,51 +53,431 @@ parser.add_argument('--test_ext', default='.data')
 parser.add_argument('--test_dir', type=Path, default=Path('DefaultTest'))
 parser.add_argument('--test_prefix', default='L*')
 parser.add_argument('--mask_margin', type=int, default=8)
+parser.add_argument('--decode_workers', type=int, default=1, help='threads decoding the images of a dataset in parallel')
+parser.add_argument('--decode_cache', type=Path, default=None, help='folder of an on-disk cache of decoded images (memory-mapped .npy)')
+parser.add_argument('--decode_cache_size_gb', type=float, default=20.0, help='size limit of --decode_cache; least recently used images are evicted first')
 
 # Network Configuration
 parser.add_argument('--canonical_resolution', type=int, default=256)
 parser.add_argument('--pixel_samples', type=int, default=10000)
 parser.add_argument('--scalable', action='store_true')
 
+# Output
+parser.add_argument('--output_dir', type=Path, default=None, help='write the results to this folder instead of ./{session_name}/results/<dataset> (to <output_dir>/<dataset> with several datasets or --multi_view); the results are always written atomically (temporary file and rename) by a background thread')
+parser.add_argument('--result_bundle', action='store_true', help='also save the maps at float16 precision in one memory-mappable file (results/<object>/maps.sdmb, read by relighting.py); the PNGs are kept as previews')
 
-def main():
-    print('================================================================')
-    print('                         Running sdm_unips/main.py              ')
-    print('================================================================')
+# Multi-view
+parser.add_argument('--multi_view', action='store_true', help='run all the views under --test_dir (e.g. the view_*/SDM_in.data folders of a DiLiGenT-MV object) in groups of views with the same number and size of images: the model is built once and the next group is decoded while a group runs, its views being inferred one after the other; groups are sized so that the peak of the view being inferred plus the decoded images of the other views of two groups fit --memory_budget_gb (see multi_view.py); results in results/<view>')
+parser.add_argument('--max_views_per_group', type=int, default=None, help='upper bound of the number of views per group of --multi_view (fewer views per group hold fewer decoded images in memory)')
 
-    args = parser.parse_args()
+# Model Artifact
+parser.add_argument('--export_model', action='store_true', help='build the model of --target and save it as a precompiled artifact next to the checkpoint, then exit')
+parser.add_argument('--use_compiled', action='store_true', help='load the precompiled artifact of --target instead of building the model (built as usual if there is no up-to-date artifact)')
 
-    # Resolve paths to make them absolute
+# Memory
+parser.add_argument('--auto', action='store_true', help='choose max_image_num, max_image_res, canonical_resolution, pixel_samples and scalable to fit --memory_budget_gb (see memory_model.py); max_image_num and max_image_res are upper bounds')
+parser.add_argument('--memory_budget_gb', type=float, default=None, help='memory budget of --auto and --multi_view (default: 90%% of the available memory)')
+parser.add_argument('--memory_calibration', type=Path, default=None, help='coefficients of the memory model fitted by benchmarks/memory_validation.py')
+
+# CPU Inference
+parser.add_argument('--cpu_precision', default=None, choices=cpu_inference.CPU_PRECISIONS, help='run on the cpu in the optimized CPU inference mode, with this precision (see cpu_inference.py)')
+parser.add_argument('--cpu_threads', type=int, default=None, help='torch threads of the CPU inference mode (default: the current torch setting, e.g. the --threads_per_worker budget of run_sdm_multifolder.py)')
+parser.add_argument('--cpu_accuracy_check', action='store_true', help='also run the fp32 CPU path and report the speed and the mean angular error of the normals of --cpu_precision against it')
+
+# Profiling
+parser.add_argument('--trace', type=Path, default=None, help='record the time and memory of every stage and write them to this Chrome trace (JSON) file')
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line (or 'argv' when given) and resolves paths to make them absolute.
+    """
+    args = parser.parse_args(argv)
     args.checkpoint = args.checkpoint.resolve()
     args.test_dir = args.test_dir.resolve()
+    if args.output_dir is not None:
+        args.output_dir = args.output_dir.resolve()
+    return args
 
-    print(f'\nStarting a session: {args.session_name}')
-    print(f'Target: {args.target}\n')
 
-    # Detect GPU or fall back to CPU
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def setup_decoding(args):
+    """
+    Enables the parallel decoding and the decoded-image cache of image_cache.py if requested.
+    """
+    if args.decode_workers > 1 or args.decode_cache is not None:
+        image_cache.install(workers=args.decode_workers, cache_dir=args.decode_cache,
+                            max_image_res=args.max_image_res, max_prefetch=args.max_image_num,
+                            max_bytes=int(args.decode_cache_size_gb * 1024**3), test_prefix=args.test_prefix)
+
+
+def memory_budget_bytes(args):
+    """
+    --memory_budget_gb, or 90% of the available memory; None if unknown.
+    """
+    if args.memory_budget_gb is not None:
+        return args.memory_budget_gb * 1024**3
+    available = memory_model.available_memory_bytes()
+    return None if available is None else 0.9 * available
+
+
+def apply_auto_settings(args):
+    """
+    Replaces the settings of args by the highest-quality ones whose estimated peak memory fits the budget.
+    """
+    budget = memory_budget_bytes(args)
+    if budget is None:
+        print("Unknown available memory, --auto needs --memory_budget_gb")
+        return
+    data_folders = [data_folder for _, data_folder in multi_view.find_views(args.test_dir, args.test_ext)] if args.multi_view else None
+    num_images, height, width = memory_model.inspect_test_dir(args.test_dir, args.test_ext, args.test_prefix, data_folders)
+    if num_images == 0:
+        print(f"No images found in {args.test_dir}, --auto ignored")
+        return
+
+    coefficients = memory_model.load_coefficients(args.memory_calibration)
+    settings = memory_model.auto_settings(num_images, height, width, budget, args.max_image_num, args.max_image_res,
+                                          args.target, coefficients)
+    for name in ['max_image_num', 'max_image_res', 'canonical_resolution', 'pixel_samples', 'scalable']:
+        setattr(args, name, settings[name])
+    print(f"Auto settings for {num_images} images of {width} x {height} pixels and {budget / 1024**3:.1f} GB: "
+          f"max_image_num {args.max_image_num}, max_image_res {args.max_image_res}, "
+          f"canonical_resolution {args.canonical_resolution}, pixel_samples {args.pixel_samples}, scalable {args.scalable} "
+          f"(estimated peak {settings['estimated_bytes'] / 1024**3:.1f} GB)")
+    if not settings['fits']:
+        print("Warning: even the lowest settings are estimated to exceed the memory budget")
+
+
+def setup_profiling():
+    """
+    Traces the image reads and writes of the loader and of the builder (no-op unless profiling is enabled).
+    Called after setup_decoding(), so that a read is timed as seen by the loader.
+    """
+    profiling.instrument_functions(cv2, ['imread', 'imwrite'])
+
+
+def build_model(args):
+    """
+    Builds the network and loads the checkpoint. The returned builder can be reused by run_session()
+    for any number of datasets as long as the target and network configuration do not change.
+    """
+    # Detect GPU or fall back to CPU (always the CPU in the CPU inference mode)
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cpu_precision is None else "cpu")
     print(f"Using device: {device}")
 
-    # Initialize the model builder
-    sdf_unips = builder.builder(args, device)
-    
-    # Load the test data
-    test_data = dataio.dataio('Test', args)
+    with profiling.span("build_model", device=str(device)):
+        sdf_unips = None
+        if args.use_compiled:
+            sdf_unips = model_artifact.load(builder.builder, args.checkpoint, args.target, device, args)
+            if sdf_unips is None:
+                print("No up-to-date model artifact (see --export_model), building the model")
+            else:
+                print(f"Loaded the model artifact of {args.target}")
+        if sdf_unips is None:
+            sdf_unips = builder.builder(args, device)
+        if args.cpu_precision is not None:
+            cpu_inference.optimize(sdf_unips, args.cpu_precision, args.cpu_threads)
+    # Stages of the networks (no-op unless profiling is enabled)
+    profiling.instrument_model(sdf_unips)
+    return sdf_unips
+
+
+class PreloadedDataset(torch.utils.data.Dataset):
+    """
+    A dataio dataset whose items have all been read and decoded in advance, so that run() never waits for
+    the disk. Other attributes (e.g. 'data', read by the builder) are taken from the wrapped dataset.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.items = [dataset[i] for i in range(len(dataset))]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the decoded items.
+        """
+        total = 0
+        for item in self.items:
+            for value in item:
+                if isinstance(value, torch.Tensor):
+                    total += value.element_size() * value.nelement()
+                elif isinstance(value, np.ndarray):
+                    total += value.nbytes
+        return total
+
+
+def load_test_data(args, preload=False):
+    """
+    Creates the dataio dataset of args.test_dir. Datasets organized as manifests are resolved to their
+    original images in a temporary folder. With 'preload' all the images are decoded now (see
+    PreloadedDataset) instead of during run().
+
+    Returns the dataset and the temporary folder (None if there is none, or once it is no longer needed),
+    to be removed with shutil.rmtree after run().
+    """
+    load_args = copy.copy(args)
+    load_args.test_dir, staging_dir = data_manifest.resolve_test_dir(args.test_dir, args.test_ext)
+
+    with profiling.span("load_test_data"), image_cache.reading():
+        test_data = dataio.dataio('Test', load_args)
+    if preload:
+        try:
+            with profiling.span("preload"), image_cache.reading():
+                test_data = PreloadedDataset(test_data)
+        finally:
+            image_cache.clear()
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir = None
+    return test_data, staging_dir
+
+
+def input_masks(args, results_dir):
+    """
+    The mask.png of every dataset of args.test_dir that has one, by results folder (named by the builder after
+    the dataset folder, with or without args.test_ext).
+    """
+    masks = {}
+    for data_folder in sorted(Path(args.test_dir).glob(f"*{args.test_ext}")):
+        mask_path = data_folder / "mask.png"
+        if not mask_path.is_file():
+            continue
+        for name in (data_folder.name, data_folder.name[:-len(args.test_ext)]):
+            if (results_dir / name).is_dir():
+                masks[results_dir / name] = mask_path
+                break
+    return masks
+
+
+def copy_input_masks(masks, destination, pending):
+    """
+    Copies the input masks (see input_masks()) into their results folders, where relighting.py uses them to
+    render the foreground pixels only. The copies are writes of 'pending', sent where destination()
+    (output_writer.redirect()) says.
+    """
+    for results_folder, mask_path in masks.items():
+        target = destination(results_folder / "mask.png")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        output_writer.submit(pending, output_writer.atomic_copy, str(mask_path), target)
 
-    start_time = time.time()
 
-    # Run the model on the test data
-    sdf_unips.run(testdata=test_data,
-                  max_image_resolution=args.max_image_res,
-                  canonical_resolution=args.canonical_resolution,
-                  )
-    
+def run_session(sdf_unips, args, test_data=None, pending=None):
+    """
+    Runs an already built model on the datasets of args.test_dir (or on 'test_data', e.g. prepared in
+    advance by load_test_data()) and writes the results, with the mask.png of each dataset, to
+    ./{args.session_name}/results (or args.output_dir).
+    The result images are written by the background writer of output_writer.py: with 'pending' (an
+    output_writer.PendingWrites), they are added to it and may still be pending on return, to be awaited
+    with pending.wait(); otherwise they are all written on return.
+    Returns the test data.
+    """
+    own_pending = pending is None
+    if own_pending:
+        pending = output_writer.PendingWrites()
+    # The builder reads the session name (output folder) from its args
+    sdf_unips.args = args
+
+    staging_dir = None
+    try:
+        # Load the test data
+        if test_data is None:
+            test_data, staging_dir = load_test_data(args)
+
+        start_time = time.time()
+
+        # Run the model on the test data; its results are written atomically by the writer thread
+        results_dir = Path(args.session_name) / 'results'
+        single = not args.multi_view and len(test_data) == 1
+        # With --result_bundle, the maps written by the builder are also handed to the bundle recorder
+        recorder = result_bundle.Recorder(args) if args.result_bundle else None
+        with output_writer.redirect(results_dir, pending, args.output_dir, single,
+                                    recorder.record if recorder is not None else None) as destination:
+            # The images of a dataset that was not preloaded are read by run()
+            with profiling.span("run", max_image_res=args.max_image_res, canonical_resolution=args.canonical_resolution,
+                                pixel_samples=args.pixel_samples), image_cache.reading():
+                sdf_unips.run(testdata=test_data,
+                              max_image_resolution=args.max_image_res,
+                              canonical_resolution=args.canonical_resolution,
+                              )
+            masks = input_masks(args, results_dir)
+            copy_input_masks(masks, destination, pending)
+            if recorder is not None:
+                recorder.write(destination, masks)
+        if args.output_dir is not None:
+            # Folders created by the builder for results that were written to args.output_dir
+            output_writer.remove_empty_folders(results_dir)
+            with contextlib.suppress(OSError):
+                os.rmdir(args.session_name)
+    finally:
+        image_cache.clear()
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
     end_time = time.time()
     print(f"Prediction finished (Elapsed time: {end_time - start_time:.3f} sec)")
+    if own_pending:
+        pending.wait()
+    return test_data
+
+
+def run_multi_view(sdf_unips, args):
+    """
+    Runs the views under args.test_dir in groups (see multi_view.py): the views of a group are loaded and decoded
+    as one dataset in a background thread while the previous group runs, then run by one run_session() call.
+    Returns the number of views.
+    """
+    views = multi_view.find_views(args.test_dir, args.test_ext)
+    budget = memory_budget_bytes(args)
+    if budget is None and args.max_views_per_group is None:
+        print("Unknown available memory, one view per group (see --memory_budget_gb and --max_views_per_group)")
+    coefficients = memory_model.load_coefficients(args.memory_calibration)
+    groups = multi_view.group_views(views, args.test_prefix, args, budget, args.max_views_per_group, coefficients)
+    print(f"{sum(len(group) for group in groups)} views of {args.test_dir} in {len(groups)} groups: "
+          + ", ".join(str(len(group)) for group in groups))
+
+    staging_root = tempfile.mkdtemp(prefix="sdm_views_")
+    start_time = time.time()
+
+    def load(index):
+        group_args = copy.copy(args)
+        group_args.test_dir = multi_view.stage_group(groups[index], os.path.join(staging_root, f"group_{index}"), args.test_ext)
+        with profiling.context(group=index):
+            return load_test_data(group_args, preload=True)[0]
+
+    # The results of a group are written while the next one runs
+    writes = output_writer.PendingWrites()
+    try:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="load_views") as loader:
+            pending = loader.submit(load, 0) if groups else None
+            for index, group in enumerate(groups):
+                test_data = pending.result()
+                # Decode the next group while this one runs
+                pending = loader.submit(load, index + 1) if index + 1 < len(groups) else None
+                with profiling.context(group=index):
+                    run_session(sdf_unips, args, test_data, writes)
+                test_data = None
+                print(f"Views {', '.join(name for name, _ in group)} done")
+        writes.wait()
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+
+    count = sum(len(group) for group in groups)
+    if count:
+        elapsed = time.time() - start_time
+        print(f"Multi-view: {count} views in {elapsed:.3f} sec ({elapsed / count:.3f} sec per view)")
+    return count
+
+
+def export_model(args):
+    """
+    Builds the model of args.target from the checkpoint and saves it as an artifact for --use_compiled.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model_artifact.export(builder.builder(args, device), args.checkpoint, args.target)
+
+
+def run_accuracy_check(args):
+    """
+    Runs the datasets of args.test_dir with the fp32 CPU path and with args.cpu_precision, from the same random
+    seed, into the sessions '{session_name}_fp32' and '{session_name}_{cpu_precision}'. Then reports both run
+    times and, for every dataset, the mean angular error between the two normal maps.
+    """
+    sessions = {}
+    for precision in ['fp32', args.cpu_precision]:
+        session_args = copy.copy(args)
+        session_args.cpu_precision = precision
+        session_args.session_name = f"{args.session_name}_{precision}"
+        torch.manual_seed(0)
+        np.random.seed(0)
+        random.seed(0)
+        sdf_unips = build_model(session_args)
+        start_time = time.time()
+        run_session(sdf_unips, session_args)
+        sessions[precision] = (Path(session_args.session_name) / 'results', time.time() - start_time)
+
+    (reference_dir, reference_time), (candidate_dir, candidate_time) = sessions['fp32'], sessions[args.cpu_precision]
+    print('================================================================')
+    print(f"fp32: {reference_time:.3f} sec, {args.cpu_precision}: {candidate_time:.3f} sec "
+          f"(x{reference_time / candidate_time:.2f})")
+    for reference in sorted(reference_dir.glob('*/normal.png')):
+        candidate = candidate_dir / reference.parent.name / 'normal.png'
+        if candidate.exists():
+            error = cpu_inference.mean_angular_error(reference, candidate)
+            print(f"{reference.parent.name}: mean angular error of {args.cpu_precision} vs fp32 = {error:.3f} deg")
+    print('================================================================')
+
+
+def main(argv=None):
+    print('================================================================')
+    print('                         Running sdm_unips/main.py              ')
+    print('================================================================')
+
+    args = parse_args(argv)
+
+    print(f'\nStarting a session: {args.session_name}')
+    print(f'Target: {args.target}\n')
+
+    if args.auto:
+        apply_auto_settings(args)
+
+    if args.trace is not None:
+        profiling.enable()
+    setup_decoding(args)
+    setup_profiling()
+
+    if args.export_model:
+        export_model(args)
+        return
+
+    if args.cpu_accuracy_check:
+        if args.cpu_precision in (None, 'fp32'):
+            parser.error("--cpu_accuracy_check compares --cpu_precision int8 or bf16 against fp32")
+        run_accuracy_check(args)
+        return
+
+    # Initialize the model builder
+    sdf_unips = build_model(args)
+    model_ready_time = time.time() - START_TIME
+
+    if args.multi_view:
+        run_multi_view(sdf_unips, args)
+        if args.trace is not None:
+            profiling.export(args.trace)
+            profiling.print_summary()
+        results_dir = args.output_dir or f"./{args.session_name}/results"
+        print(f"\nThe results of every view are in {results_dir}/<view>; relight them with")
+        print(f"        python sdm_unips/relighting.py --datadir {results_dir}/<view>\n")
+        return
+
+    # The first result map handed to the writer is the first pixel out
+    writes = output_writer.PendingWrites()
+    test_data = run_session(sdf_unips, args, pending=writes)
+    writes.wait()
+    first_pixel_time = (writes.first_write_time or time.time()) - START_TIME
+    print(f"Time to first pixel: {first_pixel_time:.3f} sec (model ready after {model_ready_time:.3f} sec, "
+          f"all results written after {time.time() - START_TIME:.3f} sec)")
+    print(f"Peak RSS: {profiling.peak_rss_bytes() / 1024**2:.1f} MB")
+
+    if args.trace is not None:
+        profiling.export(args.trace)
+        profiling.print_summary()
 
     # Instructions for running relighting script
     print("\nExecute the following script to render a video under new lighting conditions based on the generated BRDF and normal map.\n")
-    print(f"        python sdm_unips/relighting.py --datadir ./{args.session_name}/results/{test_data.data.objname}\n")
+    if args.output_dir is None:
+        results_dir = f"./{args.session_name}/results/{test_data.data.objname}"
+    else:
+        results_dir = args.output_dir if len(test_data) == 1 else args.output_dir / test_data.data.objname
+    print(f"        python sdm_unips/relighting.py --datadir {results_dir}\n")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,203 @@
+"""
+Peak memory estimator of main.py and the choice of settings under a memory budget (main.py --auto).
+
+The peak memory is modelled as a linear function of a few terms:
+
+- a base (Python, torch and the network weights; larger for target 'normal_and_brdf'),
+- the input images, proportional to N x H x W (N images of H x W pixels after the max_image_res resize),
+- the encoder activations at the canonical resolution, proportional to N x canonical_resolution^2,
+- the encoder activations at the image resolution without --scalable, proportional to N x H x W,
+- the decoding of the sampled pixels, proportional to N x pixel_samples.
+
+The default coefficients follow the figures of the README (ten 2048 x 2048 images take over 40GB without
+--scalable and about 10GB with it); benchmarks/memory_validation.py measures the peak RSS of main.py on
+synthetic inputs, compares it with the estimate and can refit the coefficients (--memory_calibration).
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+import data_manifest
+
+# Bytes per unit of every term of features()
+DEFAULT_COEFFICIENTS = {
+    "base": 1.0e9,
+    "second_network": 0.3e9,
+    "image_pixels": 40.0,
+    "canonical_pixels": 15000.0,
+    "full_resolution_pixels": 900.0,
+    "pixel_samples": 2000.0,
+}
+
+# Settings tried by auto_settings(), from the highest quality down
+PIXEL_SAMPLES_STEPS = [10000, 5000, 2500]
+CANONICAL_RESOLUTION_STEPS = [256, 192, 128]
+MIN_IMAGE_NUM = 4
+MIN_IMAGE_RES = 512
+
+
+def load_coefficients(path=None):
+    """
+    The default coefficients, updated with those of a calibration file written by fit_coefficients().
+    """
+    coefficients = dict(DEFAULT_COEFFICIENTS)
+    if path is not None:
+        with open(path) as f:
+            coefficients.update(json.load(f))
+    return coefficients
+
+
+def resized_shape(height, width, max_image_res):
+    """
+    Shape of an image once its longest side is limited to max_image_res.
+    """
+    scale = min(1.0, max_image_res / max(height, width))
+    return int(height * scale), int(width * scale)
+
+
+def features(num_images, height, width, max_image_res, canonical_resolution, pixel_samples, scalable, target):
+    """
+    Values of the terms of the model (see DEFAULT_COEFFICIENTS) for one dataset.
+    """
+    height, width = resized_shape(height, width, max_image_res)
+    pixels = num_images * height * width
+    return {
+        "base": 1.0,
+        "second_network": 1.0 if target == 'normal_and_brdf' else 0.0,
+        "image_pixels": pixels,
+        "canonical_pixels": num_images * canonical_resolution ** 2,
+        "full_resolution_pixels": 0.0 if scalable else pixels,
+        "pixel_samples": num_images * pixel_samples,
+    }
+
+
+def estimate_peak_bytes(num_images, height, width, max_image_res, canonical_resolution, pixel_samples, scalable,
+                        target='normal_and_brdf', coefficients=None):
+    """
+    Estimated peak memory (bytes) of main.py on N = num_images images of height x width pixels.
+    """
+    coefficients = coefficients or DEFAULT_COEFFICIENTS
+    terms = features(num_images, height, width, max_image_res, canonical_resolution, pixel_samples, scalable, target)
+    return sum(coefficients[name] * value for name, value in terms.items())
+
+
+def fit_coefficients(measurements, coefficients=None):
+    """
+    Least-squares fit of the coefficients on measurements, a list of (features() dict, measured peak bytes).
+    Terms that do not vary in the measurements keep their current coefficient; coefficients stay >= 0.
+    """
+    coefficients = dict(coefficients or DEFAULT_COEFFICIENTS)
+    names = list(DEFAULT_COEFFICIENTS)
+    X = np.array([[terms[name] for name in names] for terms, _ in measurements], dtype=np.float64)
+    y = np.array([peak for _, peak in measurements], dtype=np.float64)
+    varying = [i for i, name in enumerate(names) if name == "base" or np.ptp(X[:, i]) > 0]
+    fixed = [i for i in range(len(names)) if i not in varying]
+    residual = y - X[:, fixed] @ np.array([coefficients[names[i]] for i in fixed]) if fixed else y
+    solution, *_ = np.linalg.lstsq(X[:, varying], residual, rcond=None)
+    for i, value in zip(varying, solution):
+        coefficients[names[i]] = max(0.0, float(value))
+    return coefficients
+
+
+def available_memory_bytes():
+    """
+    Memory available to a new job (MemAvailable of /proc/meminfo), or None if unknown.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def image_size(path):
+    """
+    (height, width) of an image, read from its header when PIL is available.
+    """
+    try:
+        from PIL import Image
+        with Image.open(path) as img:
+            width, height = img.size
+            return height, width
+    except ImportError:
+        import cv2
+        img = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+        return img.shape[:2]
+
+
+def inspect_data_folder(data_folder, test_prefix):
+    """
+    (number of images, height, width) of one dataset, or (0, 0, 0) if it has no images.
+    """
+    images = [path for _, path in data_manifest.light_images(data_folder, test_prefix)]
+    if not images:
+        return (0, 0, 0)
+    height, width = image_size(images[0])
+    return (len(images), height, width)
+
+
+def inspect_test_dir(test_dir, test_ext, test_prefix, data_folders=None):
+    """
+    (number of images, height, width) of the largest dataset of test_dir (or of 'data_folders'), for
+    estimate_peak_bytes().
+    """
+    if data_folders is None:
+        data_folders = [p for p in sorted(Path(test_dir).glob(f"*{test_ext}")) if p.is_dir()]
+    largest = (0, 0, 0)
+    for data_folder in data_folders:
+        shape = inspect_data_folder(data_folder, test_prefix)
+        if shape[0] * shape[1] * shape[2] > largest[0] * largest[1] * largest[2]:
+            largest = shape
+    return largest
+
+
+def auto_settings(num_images, height, width, budget_bytes, max_image_num=10, max_image_res=4096,
+                  target='normal_and_brdf', coefficients=None):
+    """
+    The highest-quality settings whose estimated peak memory fits 'budget_bytes'. Starting from all the
+    images (up to max_image_num) at full resolution (up to max_image_res), with --scalable above 1024 pixels
+    as recommended in the README, quality is reduced step by step until the estimate fits: --scalable,
+    then fewer pixel samples, a lower canonical resolution, fewer images and finally a lower resolution.
+
+    Returns a dict of settings with the estimate, and whether it fits the budget.
+    """
+    settings = {
+        "max_image_num": max(1, min(num_images, max_image_num)),
+        "max_image_res": min(max(height, width), max_image_res),
+        "scalable": max(height, width) > 1024,
+        "pixel_samples": PIXEL_SAMPLES_STEPS[0],
+        "canonical_resolution": CANONICAL_RESOLUTION_STEPS[0],
+    }
+
+    def estimate(s):
+        return estimate_peak_bytes(s["max_image_num"], height, width, s["max_image_res"], s["canonical_resolution"],
+                                   s["pixel_samples"], s["scalable"], target, coefficients)
+
+    def reductions(s):
+        if not s["scalable"]:
+            yield {**s, "scalable": True}
+        for value in PIXEL_SAMPLES_STEPS:
+            if value < s["pixel_samples"]:
+                yield {**s, "pixel_samples": value}
+                break
+        for value in CANONICAL_RESOLUTION_STEPS:
+            if value < s["canonical_resolution"]:
+                yield {**s, "canonical_resolution": value}
+                break
+        if s["max_image_num"] > MIN_IMAGE_NUM:
+            yield {**s, "max_image_num": s["max_image_num"] - 1}
+        if s["max_image_res"] > MIN_IMAGE_RES:
+            yield {**s, "max_image_res": max(MIN_IMAGE_RES, s["max_image_res"] // 2)}
+
+    while estimate(settings) > budget_bytes:
+        # Apply the first reduction of the list (the one that costs the least quality)
+        reduced = next(reductions(settings), None)
+        if reduced is None:
+            break
+        settings = reduced
+    return {**settings, "estimated_bytes": estimate(settings), "fits": estimate(settings) <= budget_bytes}
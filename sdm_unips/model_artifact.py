@@ -0,0 +1,160 @@
+"""
+Precompiled model artifacts for a fast startup. export() saves a builder whose checkpoint is already loaded
+to '<checkpoint>/compiled/<target>/': every network as TorchScript (torch.jit.script) when it can be scripted
+with all its methods, otherwise as a pickled module, plus the rest of the builder state. load() restores the
+builder from there without running builder.__init__, i.e. without constructing and initializing the networks
+in Python and loading the raw checkpoint.
+
+An artifact is only used while it matches the checkpoint files, the source files of the networks and the
+torch version it was exported with; otherwise load() returns None and the model is built as usual.
+"""
+
+import json
+import hashlib
+import inspect
+from pathlib import Path
+
+import torch
+
+ARTIFACT_VERSION = "1"
+META_NAME = "meta.json"
+STATE_NAME = "builder_state.pt"
+
+# Checkpoint subfolders read by the builder for every target
+TARGET_SUBFOLDERS = {'normal': ['normal'], 'brdf': ['brdf'], 'normal_and_brdf': ['normal', 'brdf']}
+
+
+def artifact_dir(checkpoint, target):
+    return Path(checkpoint) / "compiled" / target
+
+
+def _checkpoint_signature(checkpoint, target):
+    signature = {}
+    for subfolder in TARGET_SUBFOLDERS[target]:
+        for path in sorted((Path(checkpoint) / subfolder).glob("*")):
+            if path.is_file():
+                stat = path.stat()
+                signature[f"{subfolder}/{path.name}"] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def _source_digests(paths):
+    digests = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                digests[path] = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            digests[path] = None
+    return digests
+
+
+def _public_methods(module):
+    """
+    Methods defined by the class of 'module' (and its bases below nn.Module), which a scripted module must keep.
+    """
+    methods = set()
+    for cls in type(module).__mro__:
+        if cls in (torch.nn.Module, object) or not issubclass(cls, torch.nn.Module):
+            continue
+        methods.update(name for name, value in vars(cls).items() if callable(value) and not name.startswith("_"))
+    return methods
+
+
+def _script(module):
+    """
+    TorchScript version of 'module' or None if it cannot be scripted, or would lose methods the builder may call.
+    """
+    try:
+        scripted = torch.jit.script(module)
+    except Exception as e:
+        print(f"  cannot be scripted ({type(e).__name__}), saved as a pickled module")
+        return None
+    missing = [name for name in _public_methods(module) if name != "forward" and not hasattr(scripted, name)]
+    if missing:
+        print(f"  scripting would drop {', '.join(sorted(missing))}, saved as a pickled module")
+        return None
+    return scripted
+
+
+def export(sdf_unips, checkpoint, target):
+    """
+    Write the artifact of a freshly built builder (before any CPU optimization) for 'target'.
+    """
+    directory = artifact_dir(checkpoint, target)
+    directory.mkdir(parents=True, exist_ok=True)
+    for stale in directory.glob("*"):
+        stale.unlink()
+
+    networks, state, sources = {}, {}, {inspect.getsourcefile(type(sdf_unips))}
+    for name, value in vars(sdf_unips).items():
+        if isinstance(value, torch.nn.Module):
+            print(f"Exporting {name}")
+            sources.update(inspect.getsourcefile(type(module)) for module in value.modules()
+                           if inspect.getsourcefile(type(module)) and not type(module).__module__.startswith("torch"))
+            scripted = _script(value.eval())
+            if scripted is not None:
+                torch.jit.save(scripted, str(directory / f"{name}.ts"))
+                networks[name] = "script"
+            else:
+                torch.save(value, directory / f"{name}.pt")
+                networks[name] = "pickle"
+        else:
+            state[name] = value
+    torch.save(state, directory / STATE_NAME)
+
+    meta = {
+        "version": ARTIFACT_VERSION,
+        "torch": torch.__version__,
+        "target": target,
+        "builder_class": f"{type(sdf_unips).__module__}.{type(sdf_unips).__qualname__}",
+        "networks": networks,
+        "checkpoint": _checkpoint_signature(checkpoint, target),
+        "sources": _source_digests(sorted(sources)),
+    }
+    # Written last: an interrupted export leaves no valid artifact
+    with open(directory / META_NAME, "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Model artifact written to {directory}")
+    return directory
+
+
+def is_valid(checkpoint, target):
+    """
+    The metadata of the artifact of 'target' if it is up to date, otherwise None.
+    """
+    try:
+        with open(artifact_dir(checkpoint, target) / META_NAME) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (meta.get("version") != ARTIFACT_VERSION or meta.get("torch") != torch.__version__
+            or meta.get("checkpoint") != _checkpoint_signature(checkpoint, target)
+            or meta.get("sources") != _source_digests(meta.get("sources", {}))):
+        return None
+    return meta
+
+
+def load(builder_class, checkpoint, target, device, args):
+    """
+    The builder restored from the artifact of 'target' on 'device', or None if there is no valid artifact.
+    """
+    meta = is_valid(checkpoint, target)
+    if meta is None:
+        return None
+    directory = artifact_dir(checkpoint, target)
+
+    sdf_unips = builder_class.__new__(builder_class)
+    state = torch.load(directory / STATE_NAME, map_location=device, weights_only=False)
+    for name, value in state.items():
+        if isinstance(value, torch.device):
+            value = device
+        setattr(sdf_unips, name, value)
+    for name, kind in meta["networks"].items():
+        if kind == "script":
+            network = torch.jit.load(str(directory / f"{name}.ts"), map_location=device)
+        else:
+            network = torch.load(directory / f"{name}.pt", map_location=device, weights_only=False)
+        setattr(sdf_unips, name, network.to(device).eval())
+    sdf_unips.args = args
+    return sdf_unips
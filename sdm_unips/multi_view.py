@@ -0,0 +1,109 @@
+"""
+Multi-view mode of main.py (--multi_view). The views of one object, e.g. the view_*/SDM_in.data folders written
+by cheminova/organize_DiLiGenT-MV_to_SMD.py, are run by one main.py call instead of one call per view:
+
+- views with the same number and size of images are grouped, with as many views per group as fit the memory
+  budget (memory_model.py): the peak of the view being inferred, plus the decoded images of the other views of
+  its group and of the next group,
+- every group is linked into a temporary test directory as '<view>.data' folders, loaded and decoded as one
+  dataset while the previous group runs, and run by one builder.run() call, which infers its views one after
+  the other (the views are not batched into one forward pass),
+- the builder writes the results of every view to ./{session_name}/results/<view>/.
+
+The model is built once and loading overlaps inference; the inference of every view is unchanged.
+"""
+
+import os
+import shutil
+from pathlib import Path
+
+import memory_model
+
+
+def view_name(data_folder, test_dir, test_ext):
+    """
+    Name of the results folder of a view: the name of a '.data' folder directly in test_dir without its
+    extension, otherwise the path of its parent folder (e.g. 'view_01' for view_01/SDM_in.data).
+    """
+    relative = Path(data_folder).relative_to(test_dir)
+    if len(relative.parts) == 1:
+        return relative.name[:-len(test_ext)] if relative.name.endswith(test_ext) else relative.name
+    return "_".join(relative.parent.parts)
+
+
+def find_views(test_dir, test_ext='.data'):
+    """
+    (view name, '.data' folder) of every view under test_dir, at any depth, in sorted order.
+    """
+    views = []
+    for root, dirs, files in os.walk(test_dir, followlinks=True):
+        dirs.sort()
+        data_dirs = [d for d in dirs if d.endswith(test_ext)]
+        for data_dir in data_dirs:
+            data_folder = Path(root) / data_dir
+            views.append((view_name(data_folder, test_dir, test_ext), data_folder))
+        # The images of a view are not searched for other views
+        dirs[:] = [d for d in dirs if d not in data_dirs]
+    names = [name for name, _ in views]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"several views of {test_dir} are named {', '.join(duplicates)}")
+    return views
+
+
+def views_per_group(shape, args, budget_bytes, coefficients=None):
+    """
+    Number of views V of 'shape' (number of images, height, width) per group that fit 'budget_bytes': the
+    estimated peak of the view being inferred (memory_model.estimate_peak_bytes(), its decoded images included),
+    plus the decoded images of the 2 x V - 1 other views held at that time (the rest of the group and the next
+    group, decoded meanwhile). At least 1, even if a single view exceeds the budget.
+    """
+    coefficients = coefficients or memory_model.DEFAULT_COEFFICIENTS
+    num_images, height, width = shape
+    num_images = min(num_images, args.max_image_num)
+    peak = memory_model.estimate_peak_bytes(num_images, height, width, args.max_image_res, args.canonical_resolution,
+                                            args.pixel_samples, args.scalable, args.target, coefficients)
+    terms = memory_model.features(num_images, height, width, args.max_image_res, args.canonical_resolution,
+                                  args.pixel_samples, args.scalable, args.target)
+    view_bytes = coefficients["image_pixels"] * terms["image_pixels"]
+    return max(1, int(((budget_bytes - peak) / view_bytes + 1) // 2))
+
+
+def group_views(views, test_prefix, args, budget_bytes=None, max_views=None, coefficients=None):
+    """
+    Groups (lists of (view name, '.data' folder)) of views with the same number and size of images, in the
+    order of 'views', each of at most 'max_views' views and within 'budget_bytes' (see views_per_group());
+    one view per group if neither is given.
+    """
+    by_shape = {}
+    for view in views:
+        shape = memory_model.inspect_data_folder(view[1], test_prefix)
+        if shape[0] == 0:
+            print(f"No images in {view[1]}, view {view[0]} skipped")
+            continue
+        by_shape.setdefault(shape, []).append(view)
+    groups = []
+    for shape, shape_views in by_shape.items():
+        size = len(shape_views) if budget_bytes is not None or max_views is not None else 1
+        if budget_bytes is not None:
+            size = min(size, views_per_group(shape, args, budget_bytes, coefficients))
+        if max_views is not None:
+            size = min(size, max_views)
+        groups += [shape_views[i:i + size] for i in range(0, len(shape_views), size)]
+    return groups
+
+
+def stage_group(group, staging_dir, test_ext='.data'):
+    """
+    Test directory holding the views of a group as '<view name>{test_ext}' folders, linked to (or, where
+    folder links are not supported, copied from) the original folders.
+    """
+    staging_dir = Path(staging_dir)
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    for name, data_folder in group:
+        staged_folder = staging_dir / f"{name}{test_ext}"
+        try:
+            os.symlink(os.path.abspath(data_folder), staged_folder, target_is_directory=True)
+        except OSError:
+            shutil.copytree(data_folder, staged_folder)
+    return staging_dir
@@ -0,0 +1,290 @@
+"""
+Atomic, asynchronous writing of the outputs of main.py and relighting.py.
+
+- Every output is written to a temporary file next to its destination (same folder, so same filesystem) and
+  renamed over it once complete, so that a reader (relighting.py, run_sdm_multifolder.py, the result cache)
+  never sees a partial file.
+- The images are written by one background writer thread per process, so that the PNG maps of a dataset are
+  encoded while the model runs on the next one. The writes of every run are tracked by its own PendingWrites:
+  waiting for them only waits for, and raises the errors of, the writes of that run.
+- Videos are encoded by stream() on a thread of their own while their frames are rendered, so that a long
+  encode never holds up the image writes queued meanwhile.
+- redirect() sends the maps written by the builder under ./{session_name}/results/<dataset> to an explicit
+  output folder (main.py --output_dir) instead. It only applies to the cv2.imwrite calls of the thread that
+  entered it (the one running the builder), so that other threads of the process write as usual.
+"""
+
+import os
+import time
+import uuid
+import queue
+import atexit
+import shutil
+import itertools
+import threading
+import contextlib
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+
+import profiling
+
+# Writes waiting for the writer thread; submit() blocks beyond, which bounds the memory of the pending images
+MAX_PENDING = 8
+
+_writer = None
+_writer_lock = threading.Lock()
+_original_imwrite = cv2.imwrite
+# The cv2.imwrite handler of the redirect() block of each thread
+_redirecting = threading.local()
+# Ends the items of stream()
+_END = object()
+
+
+def temporary_path(path):
+    """
+    Hidden temporary file next to 'path', with the same extension (the encoders choose the format from it).
+    """
+    folder, name = os.path.split(str(path))
+    stem, extension = os.path.splitext(name)
+    return os.path.join(folder, f".{stem}.{uuid.uuid4().hex[:12]}.tmp{extension}")
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Yields a temporary path to write the output to; it is renamed to 'path' at the end of the block, or removed
+    if the block raises.
+    """
+    tmp_path = temporary_path(path)
+    try:
+        yield tmp_path
+        if not os.path.exists(tmp_path):
+            raise OSError(f"nothing was written to {path}")
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_imwrite(path, img, params=()):
+    """
+    cv2.imwrite of 'img' to 'path' through a temporary file.
+    """
+    with profiling.span("write_output", path=os.path.basename(path)), atomic_output(path) as tmp_path:
+        if not _original_imwrite(tmp_path, img, *params):
+            raise OSError(f"could not write {path}")
+
+
+def atomic_copy(src, path):
+    """
+    Copy of the file 'src' to 'path' through a temporary file.
+    """
+    with profiling.span("write_output", path=os.path.basename(path)), atomic_output(path) as tmp_path:
+        shutil.copyfile(src, tmp_path)
+
+
+class PendingWrites:
+    """
+    The writes submitted for one run (a main.py session, a folder of run_sdm_multifolder.py).
+    """
+
+    def __init__(self):
+        self.futures = []
+        self.first_write_time = None  # time.time() of the first submitted write
+        self._lock = threading.Lock()
+
+    def add(self, future):
+        with self._lock:
+            if self.first_write_time is None:
+                self.first_write_time = time.time()
+            self.futures.append(future)
+
+    def wait(self):
+        """
+        Wait for the writes submitted so far and raise the first error of one of them.
+        """
+        with self._lock:
+            futures, self.futures = self.futures, []
+        if not futures:
+            return
+        with profiling.span("flush_outputs", writes=len(futures)):
+            errors = [future.exception() for future in futures]
+        error = next((e for e in errors if e is not None), None)
+        if error is not None:
+            raise error
+
+
+class BackgroundWriter:
+    """
+    One thread running the submitted writes in order.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, name="output_writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            future, function, args = self.jobs.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, function, *args):
+        """
+        Queue function(*args); returns its Future. Blocks while 'max_pending' writes are queued.
+        """
+        future = Future()
+        self.jobs.put((future, function, args))
+        return future
+
+    def drain(self):
+        """
+        Wait for every queued write (their errors are left to their PendingWrites).
+        """
+        self.jobs.join()
+
+
+def writer():
+    """
+    The writer of this process, started on first use. Its queued writes are completed at exit.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BackgroundWriter()
+            atexit.register(_writer.drain)
+        return _writer
+
+
+def submit(pending, function, *args):
+    """
+    Run function(*args) on the writer thread, as one of the writes of 'pending' (a PendingWrites).
+    """
+    pending.add(writer().submit(function, *args))
+
+
+class _Aborted(Exception):
+    """
+    Raised in the consumer of stream() when the producer of its items failed.
+    """
+
+
+def stream(consumer, items, depth=MAX_PENDING):
+    """
+    Run consumer(iterator) on a thread of its own over the items produced by this thread (e.g. frames to
+    encode), with at most 'depth' items waiting between them. Returns the Future of the consumer once all the
+    items are handed over. Items are no longer produced if the consumer stops early; if producing them raises,
+    the consumer is interrupted (and its atomic_output() removed) and the error is raised here.
+    """
+    channel = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    future = Future()
+
+    def received():
+        while True:
+            item = channel.get()
+            if item is _END:
+                return
+            if item is _Aborted:
+                raise _Aborted()
+            yield item
+
+    def consume():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(consumer(received()))
+        except _Aborted:
+            future.set_result(None)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            stopped.set()
+
+    def hand_over(item):
+        while not stopped.is_set():
+            try:
+                channel.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    threading.Thread(target=consume, name="output_stream", daemon=True).start()
+    try:
+        for item in itertools.chain(items, [_END]):
+            if not hand_over(item):
+                break
+    except BaseException:
+        hand_over(_Aborted)
+        future.exception()
+        raise
+    return future
+
+
+def remove_empty_folders(root):
+    """
+    Remove the empty folders under 'root' (and 'root' itself if it ends up empty).
+    """
+    for folder, _, _ in sorted(os.walk(root), key=lambda entry: len(entry[0]), reverse=True):
+        with contextlib.suppress(OSError):
+            os.rmdir(folder)
+
+
+def _imwrite(filename, img, *params):
+    handler = getattr(_redirecting, "handler", None)
+    if handler is not None:
+        return handler(filename, img, *params)
+    return _original_imwrite(filename, img, *params)
+
+
+@contextlib.contextmanager
+def redirect(results_dir, pending, output_dir=None, single=True, on_write=None):
+    """
+    While the block runs, the images written by this thread with cv2.imwrite under 'results_dir'
+    (./{session_name}/results) are written atomically by the writer thread, as writes of 'pending' (a
+    PendingWrites): to 'output_dir' if given (the files of a 'single' dataset go to output_dir directly,
+    otherwise to output_dir/<dataset>), or where they were meant to go. Other images, and the images written by
+    other threads, are written as usual. on_write(filename, img), if given, is called with every image written
+    under results_dir (e.g. result_bundle.Recorder.record). Yields destination(filename): where a file written
+    under results_dir goes.
+    """
+    results_dir = os.path.abspath(results_dir)
+
+    def destination(filename):
+        path = os.path.abspath(str(filename))
+        if not path.startswith(results_dir + os.sep):
+            return None
+        if output_dir is None:
+            return path
+        dataset, _, rest = os.path.relpath(path, results_dir).partition(os.sep)
+        return os.path.join(output_dir, rest) if single else os.path.join(output_dir, dataset, rest)
+
+    def writing_imwrite(filename, img, *params):
+        target = destination(filename)
+        if target is None:
+            return _original_imwrite(filename, img, *params)
+        if on_write is not None:
+            on_write(filename, img)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # The builder may reuse its buffers: the writer gets its own copy
+        submit(pending, atomic_imwrite, target, np.array(img, copy=True), params)
+        return True
+
+    # The dispatcher stays installed; only the handler of this thread changes
+    cv2.imwrite = _imwrite
+    previous = getattr(_redirecting, "handler", None)
+    _redirecting.handler = writing_imwrite
+    try:
+        yield destination
+    finally:
+        _redirecting.handler = previous
@@ -0,0 +1,299 @@
+"""
+Lightweight span profiler. Every span records its wall time, the CPU time of the process and the resident
+memory of the process (at its end, and the peak during the span, sampled every SAMPLE_INTERVAL seconds by a
+background thread while spans are open), and the spans can be exported as a Chrome trace (chrome://tracing
+or https://ui.perfetto.dev) and summarized per stage.
+
+The spans of a session (see context()) are dropped once exported with export(path, session), so that long
+runs (run_sdm_multifolder.py) do not accumulate them; the per-stage totals of summary() are kept.
+
+Profiling is off until enable() is called: span() then returns a shared no-op context manager, and the
+instrument_*() helpers do nothing, so the instrumented code runs as before.
+
+    profiling.enable()
+    with profiling.span("load_test_data"):
+        ...
+    profiling.export("trace.json")
+    profiling.print_summary()
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import functools
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Seconds between two samples of the resident memory while spans are open
+SAMPLE_INTERVAL = 0.01
+
+_tracer = None
+_NULL_SPAN = contextlib.nullcontext()
+_local = threading.local()
+
+
+def rss_bytes():
+    """
+    Current resident memory of the process (0 if unknown).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+def peak_rss_bytes():
+    """
+    Peak resident memory of the process since it started (0 if unknown).
+    """
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Tracer:
+    """
+    Collects the spans of the process as Chrome trace events.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.thread_names = {}
+        self.stages = {}  # Per-stage totals of all the spans, kept when their events are dropped
+        self.open_spans = {}  # Peak RSS of every open span
+        self.sampler = None
+        self.lock = threading.Lock()
+
+    def _timestamp_us(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _sample(self):
+        """
+        Raise the peak RSS of the open spans to the current RSS every SAMPLE_INTERVAL, until no span is open.
+        """
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            rss = rss_bytes()
+            with self.lock:
+                if not self.open_spans:
+                    self.sampler = None
+                    return
+                for token, peak in self.open_spans.items():
+                    if rss > peak:
+                        self.open_spans[token] = rss
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        args = {**getattr(_local, "context", {}), **args}
+        thread = threading.current_thread()
+        token = object()
+        start_rss = rss_bytes()
+        with self.lock:
+            self.open_spans[token] = start_rss
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, name="profiling_sampler", daemon=True)
+                self.sampler.start()
+        start_cpu = time.process_time()
+        start = self._timestamp_us()
+        try:
+            yield
+        finally:
+            end = self._timestamp_us()
+            end_cpu = time.process_time()
+            end_rss = rss_bytes()
+            with self.lock:
+                peak_rss = max(self.open_spans.pop(token), end_rss)
+            args.update(cpu_ms=round(1e3 * (end_cpu - start_cpu), 3),
+                        rss_mb=round(end_rss / 2**20, 1),
+                        rss_delta_mb=round((end_rss - start_rss) / 2**20, 1),
+                        peak_rss_mb=round(peak_rss / 2**20, 1))
+            memory = {"name": "memory", "ph": "C", "ts": end, "pid": self.pid, "args": {"rss_mb": args["rss_mb"]}}
+            if "session" in args:
+                memory["cat"] = str(args["session"])  # Dropped with the spans of the session
+            with self.lock:
+                self.thread_names[thread.ident] = thread.name
+                self.events.append({"name": name, "ph": "X", "ts": start, "dur": end - start,
+                                    "pid": self.pid, "tid": thread.ident, "args": args})
+                self.events.append(memory)
+                self.stages[name] = _add_span(self.stages.get(name), end - start, args)
+
+    def trace(self, session=None):
+        """
+        The Chrome trace of the spans recorded so far (only those of 'session' if given, see context()).
+        """
+        with self.lock:
+            events = [event for event in self.events
+                      if session is None or event["ph"] != "X" or event["args"].get("session") == session]
+            if session is not None:
+                spans = [event for event in events if event["ph"] == "X"]
+                first = min((event["ts"] for event in spans), default=0)
+                last = max((event["ts"] + event["dur"] for event in spans), default=0)
+                events = [event for event in events if event["ph"] == "X" or first <= event["ts"] <= last]
+            names = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                     for tid, name in self.thread_names.items()]
+        return {"traceEvents": names + events, "displayTimeUnit": "ms"}
+
+    def drop(self, session):
+        """
+        Forget the events of 'session' (their per-stage totals are kept).
+        """
+        session = str(session)
+        with self.lock:
+            self.events = [event for event in self.events
+                           if (str(event["args"].get("session")) if event["ph"] == "X" else event.get("cat")) != session]
+
+    def summary(self, session=None):
+        """
+        Per span name: number of calls, total wall time, total CPU time (sec) and peak RSS (MB) of the spans
+        (all of them, or those of 'session' not dropped yet).
+        """
+        if session is None:
+            with self.lock:
+                return dict(self.stages)
+        stages = {}
+        for event in self.trace(session)["traceEvents"]:
+            if event["ph"] == "X":
+                stages[event["name"]] = _add_span(stages.get(event["name"]), event["dur"], event["args"])
+        return stages
+
+
+def _add_span(totals, duration_us, args):
+    """
+    Per-stage totals (calls, wall, cpu, peak RSS) with one more span.
+    """
+    calls, wall, cpu, peak = totals or (0, 0.0, 0.0, 0.0)
+    return calls + 1, wall + duration_us / 1e6, cpu + args["cpu_ms"] / 1e3, max(peak, args["peak_rss_mb"])
+
+
+def enable():
+    """
+    Start recording spans (again from scratch if profiling was already enabled).
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, **args):
+    """
+    Context manager timing the enclosed code as the stage 'name'; 'args' are attached to the trace event.
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, **args)
+
+
+@contextlib.contextmanager
+def context(**args):
+    """
+    Attach 'args' (e.g. session=...) to every span opened by this thread inside the block.
+    """
+    previous = getattr(_local, "context", {})
+    _local.context = {**previous, **args}
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+def traced(function, name):
+    """
+    'function' wrapped in a span (or 'function' itself when profiling is disabled).
+    """
+    if _tracer is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def instrument_functions(module, names, prefix=None):
+    """
+    Replace the functions 'names' of 'module' (e.g. cv2.imread) by traced versions.
+    """
+    if _tracer is None:
+        return
+    for name in names:
+        function = getattr(module, name)
+        if not getattr(function, "_profiled", False):
+            wrapper = traced(function, f"{prefix or module.__name__}.{name}")
+            wrapper._profiled = True
+            setattr(module, name, wrapper)
+
+
+def instrument_model(owner):
+    """
+    Trace the forward passes of the torch modules held by 'owner' (e.g. the networks of the builder) and of
+    their direct children, which are the stages of the networks (encoders, aggregation, decoders, ...).
+    Their forward methods are wrapped in spans (traced()), which are closed even if the forward pass raises.
+    """
+    if _tracer is None:
+        return
+    import torch
+
+    for owner_name, network in vars(owner).items():
+        if not isinstance(network, torch.nn.Module):
+            continue
+        modules = [(owner_name, network)] + [(f"{owner_name}.{name}", child) for name, child in network.named_children()]
+        for name, module in modules:
+            if hasattr(module, "_profiling_name"):
+                continue
+            module._profiling_name = f"forward:{name}"
+            # nn.Module.__call__ calls the forward attribute of the instance
+            try:
+                module.forward = traced(module.forward, module._profiling_name)
+            except (AttributeError, RuntimeError):
+                pass  # A module whose attributes cannot be replaced (e.g. some TorchScript modules) is not traced
+
+
+def export(path, session=None):
+    """
+    Write the Chrome trace (of 'session' only if given, whose events are then dropped) to 'path'.
+    No-op when profiling is disabled.
+    """
+    if _tracer is None:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(_tracer.trace(session), f)
+    if session is not None:
+        _tracer.drop(session)
+    print(f"Trace written to {path}")
+
+
+def print_summary(session=None):
+    """
+    Print the time and memory of every stage. No-op when profiling is disabled.
+    """
+    if _tracer is None:
+        return
+    stages = _tracer.summary(session)
+    if not stages:
+        return
+    width = max(len("Stage"), max(len(name) for name in stages))
+    print('================================================================')
+    print(f"{'Stage':<{width}}  {'Calls':>6}  {'Wall (s)':>9}  {'CPU (s)':>9}  {'Peak RSS (MB)':>13}")
+    for name, (calls, wall, cpu, peak) in sorted(stages.items(), key=lambda item: -item[1][1]):
+        print(f"{name:<{width}}  {calls:>6}  {wall:>9.3f}  {cpu:>9.3f}  {peak:>13.1f}")
+    print('================================================================')
@@ -6,32 +6,55 @@ Scalable, Detailed and Mask-free Universal Photometric Stereo Network (CVPR2023)
 
 from __future__ import print_function, division
 from modules.utils.render import *
-import sys, time
+import os
+import sys
+import time
 sys.path.append('..') # add parent directly for importing
 import cv2
 import argparse
 import torch
 import torch.nn.functional as F
 import imageio
+import profiling
+import relighting_engine
+import foreground
+import result_bundle
+import frame_encoder
+import output_writer
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--datadir')
+parser.add_argument('--output_dir', default=None, help='write output.avi (or output.gif) to this folder instead of --datadir')
 parser.add_argument('--format', default='avi', choices=['gif', 'avi'])
+parser.add_argument('--chunk_size', type=int, default=8, help='number of light directions rendered together in one batched call (1 renders one light at a time)')
+parser.add_argument('--full_resolution', action='store_true', help='render at the resolution of the maps instead of downsampling them to 512 (gif) or 2048 (avi) pixels')
+parser.add_argument('--memory_limit_mb', type=float, default=None, help='render in horizontal tiles so that the rendering buffers stay below this size')
+parser.add_argument('--lights', default=None, help="file of light directions to render, one per line ('x y z' or 'azimuth elevation' in degrees) or an RTI .lp file (default: 72 lights at 45 degrees)")
+parser.add_argument('--engine', default='render', choices=['render', 'precomputed'], help="'render' calls render() for every chunk of lights; 'precomputed' evaluates every light on light-independent buffers computed once, if they reproduce render() term for term on a sample of pixels (render() is used otherwise)")
+parser.add_argument('--dense', action='store_true', help='render every pixel even when the result folder has a mask.png')
+parser.add_argument('--encode_workers', type=int, default=1, help='processes encoding segments of frames in parallel (see frame_encoder.py); 1 encodes the frames one after another in this process')
+parser.add_argument('--trace', default=None, help='record the time and memory of every stage and write them to this Chrome trace (JSON) file')
+
+# Rough number of bytes held per pixel and per light while render() runs (float32 shading terms and output)
+RENDER_BYTES_PER_PIXEL_PER_LIGHT = 128
+# Largest difference of a diffuse or specular term of one probe pixel between the precomputed engine and render()
+# (half an 8-bit level of the output)
+ENGINE_TOLERANCE = 0.5 / 255
+NUM_PROBE_LIGHTS = 8
 
 def create_gif_from_numpy_arrays(image_list, gif_filename, duration):
     """
-    image_list: list of numpy arrays representing images
+    image_list: list (or any iterable, e.g. a generator) of numpy arrays representing images
     gif_filename: str, output filename for the gif
     duration: float, duration between frames in seconds
-    """
-    # Normalize images and convert them to 8-bit format
-    normalized_images = [((img - img.min()) * (255 / (img.max() - img.min()))).astype(np.uint8) for img in image_list]
-
-    # Convert images to PIL.Image format
-    pil_images = [imageio.core.util.Array(img) for img in normalized_images]
 
-    # Save as GIF
-    imageio.mimsave(gif_filename, pil_images, duration=duration)
+    Frames are normalized and appended to the GIF one at a time, so a generator is never held in memory.
+    """
+    with imageio.get_writer(gif_filename, mode='I', duration=duration) as writer:
+        for img in image_list:
+            with profiling.span("relight.encode_frame"):
+                # Normalize the image and convert it to 8-bit format
+                writer.append_data(((img - img.min()) * (255 / (img.max() - img.min()))).astype(np.uint8))
 
 def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=50, fill=' '):
     
@@ -65,50 +88,218 @@ def create_video(images, output_file, fps=30, size=None):
     """
     Create a video from a list of NumPy images.
 
-    :param images: A list of NumPy arrays (H, W, 3).
+    :param images: A list (or any iterable, e.g. a generator) of NumPy arrays (H, W, 3).
+                   Frames are written as they are produced.
     :param output_file: Output video filename (e.g., 'output.avi').
     :param fps: Frames per second.
     :param size: Tuple (width, height). If None, size is obtained from the first image.
     """
-    if size is None:
-        height, width, _ = images[0].shape
-        size = (width, height)
+    out = None
+    for img in images:
+        if out is None:
+            if size is None:
+                height, width, _ = img.shape
+                size = (width, height)
 
-    
-    # Define the codec and create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'XVID')
-    out = cv2.VideoWriter(output_file, fourcc, fps, size, isColor=True)
+            # Define the codec and create VideoWriter object
+            fourcc = cv2.VideoWriter_fourcc(*'XVID')
+            out = cv2.VideoWriter(output_file, fourcc, fps, size, isColor=True)
 
-    for img in images:
-        # Convert the image from RGB to BGR (as OpenCV uses BGR)
-        img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        out.write(img_bgr)
+        with profiling.span("relight.encode_frame"):
+            # Convert the image from RGB to BGR (as OpenCV uses BGR)
+            img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            out.write(img_bgr)
 
     # Release the VideoWriter object and close the output file
-    out.release()
+    if out is not None:
+        out.release()
+
+def render_light_chunk(nml, base, rough, metallic, lights, device):
+    """
+    Renders the maps under K directional lights with a single batched call to render().
+
+    :param nml, base, rough, metallic: Maps (or tiles of the maps) of shape (1, C, h, w).
+    :param lights: Tensor (K, 3) of unit light directions.
+    :return: Float tensor (K, h, w, 3) on the cpu, clamped to [0, 1].
+    """
+    K = lights.shape[0]
+    l = lights.reshape(K, 3, 1).to(device)
+    nml, base, rough, metallic = nml.to(device), base.to(device), rough.to(device), metallic.to(device)
+    nl, fd, fr = render(nml.expand(K, -1, -1, -1), l,
+                        base.expand(K, -1, -1, -1),
+                        rough.expand(K, -1, -1, -1),
+                        metallic.expand(K, -1, -1, -1),
+                        emit = relighting_engine.EMIT, device = device)
+    rendered = nl * (fd + fr) # (K, 3, h, w)
+    return torch.clamp(rendered.permute(0,2,3,1), min=0, max=1).cpu()
 
-def main():
+def plan_tiles(height, width, chunk_size, memory_limit_mb):
+    """
+    Splits a memory ceiling (in MB, not counting the input maps) between the uint8 frames of one chunk
+    of lights and the float tensors of one tile. Returns the (possibly reduced) chunk size and the
+    number of rows of a tile.
+    """
+    budget = memory_limit_mb * 1024**2
+    frame_bytes = height * width * 3
+    chunk_size = max(1, min(chunk_size, int(budget // 2 // frame_bytes)))
+    tile_rows = int((budget - chunk_size * frame_bytes) // (RENDER_BYTES_PER_PIXEL_PER_LIGHT * width * chunk_size))
+    return chunk_size, max(1, min(height, tile_rows))
+
+def iter_frames(nml, base, rough, metallic, unit_vectors, chunk_size, device, memory_limit_mb=None):
+    """
+    Yields one uint8 frame (h, w, 3) per light direction in unit_vectors (N, 3).
+    Lights are processed in chunks of 'chunk_size' so that the batched tensors fit in memory;
+    chunk_size=1 is equivalent to rendering the lights one after another.
+    Only the frames of the current chunk are held in memory.
 
-    args = parser.parse_args()
+    With 'memory_limit_mb', the maps stay where they are (e.g. on the cpu) and every chunk is rendered in
+    horizontal tiles that are moved to the device one at a time, so that maps of any resolution can be relit.
+    """
+    chunk_size = max(1, int(chunk_size))
+    height, width = nml.shape[-2:]
+    tile_rows = height
+    if memory_limit_mb is not None:
+        chunk_size, tile_rows = plan_tiles(height, width, chunk_size, memory_limit_mb)
+        print(f"Rendering {chunk_size} lights at a time in tiles of {tile_rows} x {width} pixels")
+    else:
+        nml, base, rough, metallic = nml.to(device), base.to(device), rough.to(device), metallic.to(device)
+    num_lights = unit_vectors.shape[0]
+
+    for start in range(0, num_lights, chunk_size):
+        lights = unit_vectors[start:start + chunk_size]
+        with profiling.span("relight.render_chunk", lights=lights.shape[0]):
+            if tile_rows >= height:
+                rendered = render_light_chunk(nml, base, rough, metallic, lights, device)
+                frames = (255.0 * rendered.numpy()).astype(np.uint8)
+            else:
+                frames = np.empty((lights.shape[0], height, width, 3), dtype=np.uint8)
+                for top in range(0, height, tile_rows):
+                    rows = slice(top, top + tile_rows)
+                    rendered = render_light_chunk(nml[:, :, rows], base[:, :, rows], rough[:, :, rows], metallic[:, :, rows], lights, device)
+                    frames[:, rows] = (255.0 * rendered.numpy()).astype(np.uint8)
+        print_progress_bar(min(start + chunk_size, num_lights), num_lights, prefix='Render images', suffix='', length=30)
+        yield from frames
+
+def precomputed_relighter(nml, base, rough, metallic, unit_vectors, chunk_size, device, memory_limit_mb=None):
+    """
+    A relighting_engine.PrecomputedRelighter of the maps and its chunk size, once checked against render() on
+    a few of the lights, or None if it should not be used (buffers above memory_limit_mb, or a per-pixel
+    difference with render() above ENGINE_TOLERANCE).
+    """
+    height, width = nml.shape[-2:]
+    if memory_limit_mb is not None:
+        chunk_size = relighting_engine.plan_chunk(height * width, chunk_size, memory_limit_mb)
+        if chunk_size is None:
+            print("The precomputed buffers do not fit memory_limit_mb, rendering in tiles")
+            return None
+    with profiling.span("relight.precompute"):
+        relighter = relighting_engine.PrecomputedRelighter(nml, base, rough, metallic, device)
+        probes = unit_vectors[np.linspace(0, unit_vectors.shape[0] - 1, min(NUM_PROBE_LIGHTS, unit_vectors.shape[0])).astype(int)]
+        error = relighter.check(nml, base, rough, metallic, probes)
+    if error > ENGINE_TOLERANCE:
+        print(f"The precomputed engine differs from render() (up to {255 * error:.2f} levels of 255 on a pixel), using render()")
+        return None
+    return relighter, max(1, int(chunk_size))
+
+def iter_precomputed_frames(relighter, unit_vectors, chunk_size):
+    """
+    Yields one uint8 frame (h, w, 3) per light direction, like iter_frames(), from a precomputed relighter.
+    """
+    num_lights = unit_vectors.shape[0]
+    chunks = relighter.render_chunks(unit_vectors, chunk_size)
+    while True:
+        with profiling.span("relight.shade_chunk"):
+            start, frames = next(chunks, (None, None))
+        if frames is None:
+            return
+        print_progress_bar(min(start + chunk_size, num_lights), num_lights, prefix='Render images', suffix='', length=30)
+        yield from frames
+
+def render_frames(nml, base, rough, metallic, unit_vectors, chunk_size, device, memory_limit_mb=None):
+    """
+    List of all the frames of iter_frames().
+    """
+    return list(iter_frames(nml, base, rough, metallic, unit_vectors, chunk_size, device, memory_limit_mb))
+
+def write_output(frames, output_file, encode_workers=1):
+    """
+    Encodes the frames to output_file (.avi or .gif) and reports the frame rate of rendering and encoding.
+    With encode_workers > 1, segments of frames are encoded by worker processes (frame_encoder.encode).
+    The video is encoded to a temporary file renamed to output_file once complete (output_writer.atomic_output).
+    """
+    start = time.perf_counter()
+    with output_writer.atomic_output(output_file) as tmp_file:
+        if encode_workers > 1 and frame_encoder.can_encode(output_file):
+            count = frame_encoder.encode(frames, tmp_file, fps=30, duration=0.05, workers=encode_workers)
+        else:
+            if encode_workers > 1:
+                print("ffmpeg not found, encoding the video in a single process")
+            count = 0
+            def counted(frames):
+                nonlocal count
+                for frame in frames:
+                    count += 1
+                    yield frame
+            if output_file.endswith('.avi'):
+                create_video(counted(frames), tmp_file)
+            else:
+                frame_duration = 0.05  # seconds
+                create_gif_from_numpy_arrays(counted(frames), tmp_file, frame_duration)
+    elapsed = time.perf_counter() - start
+    print(f"Rendered and encoded {count} frames in {elapsed:.3f} sec ({count / max(elapsed, 1e-9):.1f} frames/sec)")
+
+def sparse_index(datadir, shape):
+    """
+    The foreground.ForegroundIndex of the maps of 'datadir' at (height, width) 'shape' if they are rendered
+    sparsely (a mask.png, written by main.py, whose foreground is not most of the frame), otherwise None.
+    """
+    mask = foreground.load_mask(datadir, shape)
+    if mask is None or not mask.any() or mask.mean() > foreground.MAX_SPARSE_FRACTION:
+        return None
+    return foreground.ForegroundIndex(mask)
+
+def relight(datadir, output_format='avi', chunk_size=8, full_resolution=False, memory_limit_mb=None, lights=None, engine='render', dense=False, encode_workers=1,
+            output_dir=None):
+    """
+    Renders the normal and BRDF maps found in 'datadir' under novel directional lights and
+    writes 'output.avi' or 'output.gif' into the same folder (or into 'output_dir').
+    With 'full_resolution' the maps are not downsampled; with 'memory_limit_mb' they are rendered in tiles.
+    'lights' is a file of light directions (see relighting_engine.load_lights), 72 lights at 45 degrees by default.
+    With engine='precomputed' the lights are evaluated on precomputed buffers (see relighting_engine) if they
+    reproduce render().
+    Unless 'dense', only the foreground pixels of mask.png are rendered if it exists (see foreground.py).
+    'encode_workers' > 1 encodes the output in parallel segments (see write_output()).
+    The video is encoded on another thread while the frames are rendered (output_writer.stream()).
+    """
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    # Tiled rendering keeps the full maps on the cpu and only moves tiles to the device
+    map_device = torch.device("cpu") if memory_limit_mb is not None else device
   
-    nml = (cv2.imread(f"{args.datadir}/normal.png")[:, :, ::-1]).astype(np.float32)/255.0
-    base = (cv2.imread(f"{args.datadir}/baseColor.png")[:, :, ::-1]).astype(np.float32)/255.0
-    rough = (cv2.imread(f"{args.datadir}/roughness.png")[:, :, ::-1]).astype(np.float32)/255.0
-    metallic = (cv2.imread(f"{args.datadir}/metallic.png")[:, :, ::-1]).astype(np.float32)/255.0
+    with profiling.span("relight.load_maps"):
+        # The float16 result bundle (main.py --result_bundle) is mapped without decoding; otherwise the PNGs are read
+        bundle = result_bundle.open_bundle(datadir)
+        if bundle is not None and all(name in bundle.maps for name in result_bundle.MAP_NAMES):
+            print(f"Reading the maps from {bundle.path}")
+            nml, base, rough, metallic = (bundle.maps[name] for name in result_bundle.MAP_NAMES)
+        else:
+            nml = (cv2.imread(f"{datadir}/normal.png")[:, :, ::-1]).astype(np.float32)/255.0
+            base = (cv2.imread(f"{datadir}/baseColor.png")[:, :, ::-1]).astype(np.float32)/255.0
+            rough = (cv2.imread(f"{datadir}/roughness.png")[:, :, ::-1]).astype(np.float32)/255.0
+            metallic = (cv2.imread(f"{datadir}/metallic.png")[:, :, ::-1]).astype(np.float32)/255.0
 
-    nml = 2 * torch.Tensor(nml).to(device).permute(2,0,1).unsqueeze(0) - 1
-    base = torch.Tensor(base).to(device).permute(2,0,1).unsqueeze(0)
-    rough = torch.Tensor(rough).to(device).permute(2,0,1).unsqueeze(0)[:,[0],:,:]
-    metallic = torch.Tensor(metallic).to(device).permute(2,0,1).unsqueeze(0)[:,[0],:,:]
+        to_map = lambda x: torch.from_numpy(np.ascontiguousarray(x)).to(map_device, torch.float32).permute(2,0,1).unsqueeze(0)
+        nml = 2 * to_map(nml) - 1
+        base = to_map(base)
+        rough = to_map(rough)[:,[0],:,:]
+        metallic = to_map(metallic)[:,[0],:,:]
 
 
     height, width = nml.shape[-2:]
-    if args.format == 'gif':
+    if output_format == 'gif':
         max_size = 512
-    if args.format == 'avi':
+    if output_format == 'avi':
         max_size = 2048
-    if np.max([height, width]) > max_size:
+    if not full_resolution and np.max([height, width]) > max_size:
         aspect_ratio = width / height if width > height else height / width
         if height > width:
             new_height = max_size
@@ -120,34 +311,55 @@ def main():
 
         nml = F.interpolate(nml, size=(new_width, new_height), mode='bilinear', align_corners=True)
         nml = F.normalize(nml, p=2, dim=1)
-        base = torch.max(torch.min(torch.Tensor([1.0]).to(device), F.interpolate(base, size=(new_width, new_height), mode='bilinear', align_corners=True)),torch.Tensor([0.0]).to(device))
-        rough = torch.max(torch.min(torch.Tensor([1.0]).to(device), F.interpolate(rough, size=(new_width, new_height), mode='bilinear', align_corners=True)),torch.Tensor([0.0]).to(device))
-        metallic = torch.max(torch.min(torch.Tensor([1.0]).to(device), F.interpolate(metallic, size=(new_width, new_height), mode='bilinear', align_corners=True)),torch.Tensor([0.0]).to(device))
+        base = torch.max(torch.min(torch.Tensor([1.0]).to(map_device), F.interpolate(base, size=(new_width, new_height), mode='bilinear', align_corners=True)),torch.Tensor([0.0]).to(map_device))
+        rough = torch.max(torch.min(torch.Tensor([1.0]).to(map_device), F.interpolate(rough, size=(new_width, new_height), mode='bilinear', align_corners=True)),torch.Tensor([0.0]).to(map_device))
+        metallic = torch.max(torch.min(torch.Tensor([1.0]).to(map_device), F.interpolate(metallic, size=(new_width, new_height), mode='bilinear', align_corners=True)),torch.Tensor([0.0]).to(map_device))
                                                                              
-    N = 72  # Number of lighting
-    points = generate_points_with_same_incident_angle(N)
+    if lights is None:
+        N = 72  # Number of lighting
+        points = generate_points_with_same_incident_angle(N)
+    else:
+        points = relighting_engine.load_lights(lights)
     unit_vectors = numpy_to_pytorch(points)
 
-    img_stack = []
-    for k in range(unit_vectors.shape[0]):
-        time.sleep(0.1)
-        print_progress_bar(k+1, unit_vectors.shape[0], prefix='Render images', suffix='', length=30)
-        l = torch.Tensor(unit_vectors[k,:]).reshape(1,3,1)
-        nl, fd, fr = render(nml.to(device), l.to(device), base.to(device), rough.to(device), metallic.to(device), emit = 4.0, device = device)
-        rendered = nl * (fd + fr) # (3, h, w)
-        rendered = torch.clamp(rendered.cpu().permute(0,2,3,1).squeeze(), min=0, max=1).numpy() 
-        img_stack.append((255.0 * rendered).astype(np.uint8))
-
-    # Create a video from the list of images
-    if args.format == 'avi':
-        output_file = f'{args.datadir}/output.avi'
-        create_video(img_stack, output_file)
-
-    if args.format == 'gif':
-        output_gif = f'{args.datadir}/output.gif'
-        frame_duration = 0.05  # seconds
-        create_gif_from_numpy_arrays(img_stack, output_gif, frame_duration)
+    # Sparse mode: the renderers only see the foreground pixels, packed into a smaller image
+    foreground_index = None if dense else sparse_index(datadir, nml.shape[-2:])
+    if foreground_index is not None:
+        print(f"Rendering the {100 * foreground_index.fraction:.1f}% foreground pixels only")
+        nml, base, rough, metallic = (foreground_index.pack(x) for x in (nml, base, rough, metallic))
+
+    # Frames are streamed from the renderer to the video writer, one chunk at a time
+    precomputed = None
+    if engine == 'precomputed':
+        precomputed = precomputed_relighter(nml, base, rough, metallic, unit_vectors, chunk_size, device, memory_limit_mb)
+    if precomputed is not None:
+        relighter, engine_chunk_size = precomputed
+        frames = iter_precomputed_frames(relighter, unit_vectors, engine_chunk_size)
+    else:
+        frames = iter_frames(nml, base, rough, metallic, unit_vectors, chunk_size, device, memory_limit_mb)
+    if foreground_index is not None:
+        # Back to full frames just before encoding
+        frames = foreground_index.iter_unpacked(frames)
+
+    # Create a video from the rendered images, encoded on another thread while the next frames are rendered
+    output_file = os.path.join(output_dir or datadir, f'output.{output_format}')
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    output_writer.stream(lambda frames: write_output(frames, output_file, encode_workers), frames).result()
+
+
+def main(argv=None):
 
+    args = parser.parse_args(argv)
+    if args.trace:
+        profiling.enable()
+    with profiling.span("relight", datadir=str(args.datadir)):
+        relight(args.datadir, output_format=args.format, chunk_size=args.chunk_size,
+                full_resolution=args.full_resolution, memory_limit_mb=args.memory_limit_mb,
+                lights=args.lights, engine=args.engine, dense=args.dense,
+                encode_workers=args.encode_workers, output_dir=args.output_dir)
+    if args.trace:
+        profiling.export(args.trace)
+        profiling.print_summary()
 
 
 if __name__ == '__main__':
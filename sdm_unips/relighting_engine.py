@@ -0,0 +1,165 @@
+"""
+Relighting engine with light-independent precomputation. The shading model of modules.utils.render.render
+(Lambertian diffuse and a GGX microfacet specular term with Schlick's Fresnel and Smith's geometry term,
+viewed from v = (0, 0, 1)) is split into:
+
+- per-pixel buffers that do not depend on the light (normal, diffuse albedo, F0, alpha^2, the view geometry
+  term, ...), computed once and kept on the device,
+- a per-light evaluation, which is a few matrix products and element-wise operations per chunk of lights.
+
+Because render() itself is not part of this module, the engine is a reimplementation of its model: it is only
+used (relighting.py --engine precomputed) once it reproduces render() term for term, i.e. once the diffuse and
+the specular terms of every pixel of a sample agree with those of render() within a per-pixel tolerance
+(check()). Nothing is fitted: if they differ, the caller falls back to render().
+"""
+
+import math
+
+import numpy as np
+import torch
+
+from modules.utils.render import render
+
+# Light intensity of the relit frames (the 'emit' argument of render()), applied by the engine as well
+EMIT = 4.0
+
+# Rough number of bytes per pixel of the precomputed buffers, and per pixel and per light of a chunk
+BUFFER_BYTES_PER_PIXEL = 64
+CHUNK_BYTES_PER_PIXEL_PER_LIGHT = 48
+
+
+def load_lights(path):
+    """
+    Unit light directions (N, 3) from a file:
+
+    - '.lp' files (RTI light positions): the number of lights on the first line, then 'image x y z' lines,
+    - other text files: one light per line, either 'x y z' or 'azimuth elevation' in degrees,
+      separated by spaces or commas ('#' starts a comment).
+    """
+    path = str(path)
+    if path.lower().endswith(".lp"):
+        with open(path) as f:
+            lines = [line.split() for line in f.read().splitlines() if line.strip()]
+        lights = np.array([[float(v) for v in line[-3:]] for line in lines[1:]], dtype=np.float64)
+    else:
+        with open(path) as f:
+            rows = [line.split("#")[0].replace(",", " ").split() for line in f]
+        lights = np.array([[float(v) for v in row] for row in rows if row], dtype=np.float64)
+        if lights.ndim == 2 and lights.shape[1] == 2:
+            azimuth, elevation = np.radians(lights[:, 0]), np.radians(lights[:, 1])
+            lights = np.stack((np.cos(azimuth) * np.cos(elevation), np.sin(azimuth) * np.cos(elevation), np.sin(elevation)), axis=-1)
+    if lights.ndim != 2 or lights.shape[1] != 3 or len(lights) == 0:
+        raise ValueError(f"{path}: expected one light per line ('x y z' or 'azimuth elevation')")
+    lights /= np.linalg.norm(lights, axis=1, keepdims=True)
+    below = int((lights[:, 2] <= 0).sum())
+    if below:
+        print(f"Warning: {below} of the {len(lights)} lights of {path} are below the horizon (black frames)")
+    return lights
+
+
+class PrecomputedRelighter:
+    """
+    Relights maps of shape (1, C, h, w) under any number of directional lights.
+
+    :param nml, base, rough, metallic: Normal (unit vectors), base color, roughness and metallic maps.
+    :param device: Device of the buffers and of the evaluation; the maps are moved there once.
+    :param emit: Light intensity, as the 'emit' argument of render(); it scales both terms.
+    """
+
+    def __init__(self, nml, base, rough, metallic, device, emit=EMIT):
+        self.device = device
+        self.emit = emit
+        self.height, self.width = nml.shape[-2:]
+        to_pixels = lambda x: x.to(device).reshape(x.shape[1], -1).t().contiguous()  # (P, C)
+        n, base, rough, metallic = to_pixels(nml), to_pixels(base), to_pixels(rough), to_pixels(metallic)
+        self.buffers = self._precompute(n, base, rough, metallic, emit)
+
+    @staticmethod
+    def _precompute(n, base, rough, metallic, emit):
+        nv = n[:, 2:3].clamp(min=1e-4)
+        alpha = rough ** 2
+        k = (rough + 1) ** 2 / 8
+        f0 = 0.04 * (1 - metallic) + base * metallic
+        return {
+            "n": n,                                          # (P, 3)
+            "kd": emit * (1 - metallic) * base / math.pi,    # (P, 3) Lambertian term
+            "f0": f0,                                        # (P, 3)
+            "one_minus_f0": 1 - f0,                          # (P, 3)
+            "a2_minus_1": alpha ** 2 - 1,                    # (P, 1)
+            "a2": alpha ** 2,                                # (P, 1)
+            "k": k,                                          # (P, 1)
+            # Smith's view term and the constant factors of the specular term
+            "specular": emit * (nv / (nv * (1 - k) + k)) / (4 * math.pi * nv),  # (P, 1)
+        }
+
+    def _terms(self, lights, buffers=None):
+        """
+        Diffuse and specular radiance (K, P, 3) of the pixels under lights (K, 3) of intensity self.emit.
+        """
+        b = buffers or self.buffers
+        l = lights.to(self.device, torch.float32)
+        v = torch.tensor([0.0, 0.0, 1.0], device=self.device)
+        h = torch.nn.functional.normalize(l + v, dim=1)
+
+        nl = (b["n"] @ l.t()).clamp(min=0)                      # (P, K)
+        nh = (b["n"] @ h.t()).clamp(min=0)
+        fresnel_weight = (1 - h[:, 2].clamp(0, 1)) ** 5          # (K,), v.h = h_z
+        d = b["a2"] / (nh ** 2 * b["a2_minus_1"] + 1) ** 2        # GGX without 1/pi
+        gl = nl / (nl * (1 - b["k"]) + b["k"])
+        specular = (d * gl * b["specular"]).t()[:, :, None]      # (K, P, 1)
+        fresnel = b["f0"][None] + b["one_minus_f0"][None] * fresnel_weight[:, None, None]
+        diffuse = nl.t()[:, :, None] * b["kd"][None]
+        return diffuse, fresnel * specular
+
+    def shade(self, lights):
+        """
+        Rendered pixels (K, P, 3), clamped to [0, 1], for lights (K, 3).
+        """
+        diffuse, specular = self._terms(lights)
+        return (diffuse + specular).clamp(0, 1)
+
+    def check(self, nml, base, rough, metallic, probe_lights, num_pixels=4096, num_glossy_pixels=1024, seed=0):
+        """
+        Compare the engine with render() under probe_lights (K, 3) on 'num_pixels' random pixels of the maps
+        (those given to __init__) and on the 'num_glossy_pixels' pixels of lowest roughness, whose highlights
+        are the sharpest; render() is given the 'emit' of the engine. Returns the largest absolute difference of
+        a diffuse or specular term of one pixel (in units of the [0, 1] output): the engine reproduces render()
+        if it is below one 8-bit level.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        num_pixels = min(num_pixels, self.height * self.width)
+        glossy = torch.topk(-rough.reshape(-1), min(num_glossy_pixels, self.height * self.width)).indices
+        index = torch.unique(torch.cat([torch.randperm(self.height * self.width, generator=generator)[:num_pixels],
+                                        glossy.cpu()])).to(self.device)
+        K = probe_lights.shape[0]
+
+        # The sampled pixels as a 1 x S image for render()
+        sample = lambda x: x.to(self.device).reshape(x.shape[1], -1)[:, index][None, :, None].expand(K, -1, -1, -1)
+        l = probe_lights.to(self.device, torch.float32).reshape(K, 3, 1)
+        nl, fd, fr = render(sample(nml), l, sample(base), sample(rough), sample(metallic), emit=self.emit, device=self.device)
+        to_pixels = lambda x: torch.broadcast_to(x, (K, 3, 1, index.numel())).reshape(K, 3, -1).permute(0, 2, 1)
+        reference_diffuse, reference_specular = to_pixels(nl * fd), to_pixels(nl * fr)
+
+        diffuse, specular = self._terms(probe_lights, {name: value[index] for name, value in self.buffers.items()})
+        return max(float((diffuse - reference_diffuse).abs().max()), float((specular - reference_specular).abs().max()))
+
+    def render_chunks(self, lights, chunk_size):
+        """
+        Yields (first light index, uint8 frames (K, h, w, 3) on the cpu) for chunks of 'chunk_size' lights.
+        """
+        for start in range(0, lights.shape[0], chunk_size):
+            rendered = self.shade(lights[start:start + chunk_size])
+            frames = (255.0 * rendered).to(torch.uint8).reshape(-1, self.height, self.width, 3)
+            yield start, frames.cpu().numpy()
+
+
+def plan_chunk(num_pixels, chunk_size, memory_limit_mb):
+    """
+    Number of lights rendered together so that the buffers and one chunk stay below memory_limit_mb,
+    or None if the buffers alone do not fit (the tiled renderer must be used then).
+    """
+    budget = memory_limit_mb * 1024**2 - num_pixels * BUFFER_BYTES_PER_PIXEL
+    per_light = num_pixels * (CHUNK_BYTES_PER_PIXEL_PER_LIGHT + 3)
+    if budget < per_light:
+        return None
+    return max(1, min(chunk_size, int(budget // per_light)))
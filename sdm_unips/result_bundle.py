@@ -0,0 +1,180 @@
+"""
+Float result bundle: the maps written by the builder (normal.png, baseColor.png, roughness.png, metallic.png)
+kept at float16 precision in one memory-mappable file, 'maps.sdmb', next to the PNGs (which stay as previews).
+
+Layout: the magic b"SDMB", the header length (uint32, little endian) and a JSON header with the shape, the
+offset and number of channels of every map, the offset of the foreground mask and the arguments of the run;
+then the arrays, each aligned on 64 bytes. Maps are (height, width, channels) float16 in [0, 1], RGB, encoded
+like the PNGs (the normal map holds (n + 1) / 2); the mask is (height, width) uint8.
+
+The builder (modules/) writes the maps with cv2.imwrite; main.py hands the arrays it is given to a Recorder,
+which writes the bundles when the run ends, with the mask.png of the input dataset as their mask. Only float
+arrays (in [0, 255], rounded by cv2.imwrite) hold more than the PNGs: maps given already quantized (integer
+arrays) are not recorded, so a bundle never stores 8-bit values as float16.
+"""
+
+import os
+import json
+import struct
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+BUNDLE_NAME = "maps.sdmb"
+MAGIC = b"SDMB"
+VERSION = 1
+ALIGNMENT = 64
+MAP_NAMES = ["normal", "baseColor", "roughness", "metallic"]
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _jsonable(args):
+    """
+    The arguments of a run (argparse namespace or dict) as JSON values.
+    """
+    values = vars(args) if not isinstance(args, dict) else args
+    return {name: value if isinstance(value, (bool, int, float, str, type(None))) else str(value)
+            for name, value in values.items()}
+
+
+def write(path, maps, mask=None, args=None):
+    """
+    Write a bundle of 'maps' (name -> float array (height, width[, channels]) in [0, 1]) to 'path'.
+    The file is written next to its destination and renamed, so readers never see a partial bundle.
+    """
+    maps = {name: np.asarray(value, dtype=np.float16).reshape(value.shape[0], value.shape[1], -1) for name, value in maps.items()}
+    shape = next(iter(maps.values())).shape[:2]
+    header = {"version": VERSION, "shape": list(shape), "dtype": "float16", "maps": {}, "mask": None,
+              "args": _jsonable(args or {})}
+
+    # Offsets are relative to the start of the data, which follows the header
+    offset = 0
+    for name, value in maps.items():
+        header["maps"][name] = {"offset": offset, "channels": value.shape[2]}
+        offset = _aligned(offset + value.nbytes)
+    if mask is not None:
+        header["mask"] = {"offset": offset}
+
+    header_bytes = json.dumps(header).encode()
+    data_start = _aligned(len(MAGIC) + 4 + len(header_bytes))
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        for name, value in maps.items():
+            f.seek(data_start + header["maps"][name]["offset"])
+            f.write(np.ascontiguousarray(value).tobytes())
+        if mask is not None:
+            f.seek(data_start + header["mask"]["offset"])
+            f.write(np.ascontiguousarray(mask, dtype=np.uint8).tobytes())
+    os.replace(temp_path, path)
+
+
+class ResultBundle:
+    """
+    A bundle opened without reading it: 'maps' (name -> float16 array (height, width, channels)) and
+    'mask' ((height, width) uint8 array or None) are views of the memory-mapped file.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a result bundle")
+            header_length, = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_length))
+        data_start = _aligned(len(MAGIC) + 4 + header_length)
+        # Copy-on-write, so that the views can be handed to torch.from_numpy without touching the file
+        self._data = np.memmap(path, dtype=np.uint8, mode="c")
+        height, width = self.header["shape"]
+        self.shape = (height, width)
+        self.args = self.header["args"]
+        self.maps = {}
+        for name, entry in self.header["maps"].items():
+            start = data_start + entry["offset"]
+            count = height * width * entry["channels"]
+            self.maps[name] = self._data[start:start + 2 * count].view(np.float16).reshape(height, width, entry["channels"])
+        self.mask = None
+        if self.header["mask"] is not None:
+            start = data_start + self.header["mask"]["offset"]
+            self.mask = self._data[start:start + height * width].reshape(height, width)
+
+
+def open_bundle(datadir):
+    """
+    The ResultBundle of a result folder, or None if it has none.
+    """
+    path = Path(datadir) / BUNDLE_NAME
+    return ResultBundle(path) if path.exists() else None
+
+
+def _to_unit_rgb(img):
+    """
+    A float image given to cv2.imwrite (BGR in [0, 255]) as float32 RGB in [0, 1].
+    """
+    img = np.clip(np.asarray(img, dtype=np.float32) / 255.0, 0, 1)
+    if img.ndim == 3 and img.shape[2] == 3:
+        img = img[:, :, ::-1]
+    return img
+
+
+def _read_mask(mask_path, shape):
+    """
+    The input mask.png at 'mask_path' as a (height, width) uint8 array (0 or 255) of the given shape.
+    """
+    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+    if mask.shape != tuple(shape):
+        mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+    return (mask > 0).astype(np.uint8) * 255
+
+
+class Recorder:
+    """
+    Collects the maps of a run, handed over explicitly by main.py with record() (output_writer.redirect()
+    passes it every image the builder writes), and writes one bundle per result folder with write().
+    Maps given as integer arrays are already rounded: they are skipped with a warning, and a folder without
+    any float map gets no bundle.
+    """
+
+    def __init__(self, args=None):
+        self.args = args
+        self.recorded = {}
+        self.skipped = []
+        self._lock = threading.Lock()
+
+    def record(self, filename, img):
+        """
+        Keep 'img', written by the builder to 'filename', if it is one of the maps.
+        """
+        path = Path(os.path.abspath(str(filename)))
+        if path.suffix.lower() != ".png" or path.stem not in MAP_NAMES:
+            return
+        with self._lock:
+            if np.issubdtype(np.asarray(img).dtype, np.floating):
+                self.recorded.setdefault(path.parent, {})[path.stem] = _to_unit_rgb(img)
+            else:
+                self.skipped.append(path)
+
+    def write(self, destination=None, masks=None):
+        """
+        Write a bundle into every folder that received maps. 'masks' maps a result folder to the mask.png of
+        its input dataset, which becomes the mask of the bundle (a folder without one has no mask).
+        'destination' maps the path of a written file to where it actually goes (see output_writer.redirect()),
+        or to None if it is written where it was meant to go.
+        """
+        masks = {Path(os.path.abspath(str(folder))): mask_path for folder, mask_path in (masks or {}).items()}
+        for path in self.skipped:
+            print(f"Warning: {path} was written as an integer image (already rounded to 8 bits), it is not added to the result bundle")
+        for folder, maps in self.recorded.items():
+            shape = next(iter(maps.values())).shape[:2]
+            mask = _read_mask(masks[folder], shape) if folder in masks else None
+            path = folder / BUNDLE_NAME
+            if destination is not None:
+                path = Path(destination(path) or path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write(path, maps, mask, self.args)
+            print(f"Result bundle written to {path}")